@@ -0,0 +1,851 @@
+"""RAG聊天服务性能基准测试
+
+用法:
+    python benchmark.py chart [--sizes 100,1000,10000,100000,500000] [--repeat 5]
+    python benchmark.py tools [--tool-delay 0.2] [--llm-delay 0.05] [--repeat 5]
+    python benchmark.py lexical [--docs 100000] [--queries 2000]
+    python benchmark.py quotes [--rows 1000000] [--tick 3] [--appends 5000] [--intervals 1m,5m,1h,1d] [--repeat 5]
+    python benchmark.py batch [--messages 32] [--token-delay 0.01] [--tool-delay 0.1]
+    python benchmark.py startup [--repeat 3] [--load-delay 2.0]
+    python benchmark.py load [--concurrency 16] [--requests 200] [--mix chat=8,chart=1,upload=1]
+                             [--token-delay 0.01] [--tool-delay 0.1]
+                             [--save-baseline FILE] [--baseline FILE] [--tolerance 0.2]
+"""
+import argparse
+import asyncio
+import hashlib
+import importlib.util
+import json
+import math
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_FILE = os.path.join(BASE_DIR, "使用FastAPI基于langchain实现RAG-GUI版本.py")
+APP_MODULE = "rag_app"
+
+
+def load_app():
+    """加载后端主文件（文件名不是合法模块名，按路径导入）"""
+    if APP_MODULE in sys.modules:
+        return sys.modules[APP_MODULE]
+    # 基准测试使用独立的知识库目录，不影响正式数据
+    os.environ.setdefault("KB_DIR", tempfile.mkdtemp(prefix="rag-bench-"))
+    os.chdir(BASE_DIR)
+    # 任务进程池以spawn方式启动，子进程需要能按模块名导入主文件
+    module_dir = tempfile.mkdtemp(prefix="rag-bench-module-")
+    module_file = os.path.join(module_dir, APP_MODULE + ".py")
+    try:
+        os.symlink(APP_FILE, module_file)
+    except (OSError, NotImplementedError):
+        shutil.copyfile(APP_FILE, module_file)
+    sys.path.insert(0, module_dir)
+    spec = importlib.util.spec_from_file_location(APP_MODULE, module_file)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[APP_MODULE] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def best_of(fn, repeat: int) -> float:
+    """多次运行取最短耗时（秒）"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_chart(args):
+    """不同序列长度下三种图表的渲染耗时与SVG大小"""
+    app_mod = load_app()
+    renderers = [
+        ("line", app_mod.generate_mock_line_chart),
+        ("column", app_mod.generate_mock_column_chart),
+        ("bar", app_mod.generate_mock_bar_chart),
+    ]
+    print(f"{'points':>10} " + " ".join(f"{name + ' ms':>10} {name + ' KB':>10}" for name, _ in renderers))
+    for size in [int(s) for s in args.sizes.split(",")]:
+        data = [
+            {"time": str(i), "category": f"c{i}", "value": 100 + 10 * math.sin(i / 50) + (i % 7)}
+            for i in range(size)
+        ]
+        chart_args = {"data": data, "title": "基准测试", "width": 800, "height": 400}
+        cells = []
+        for _, render in renderers:
+            elapsed = best_of(lambda: render(chart_args), args.repeat)
+            cells.append(f"{elapsed * 1000:>10.2f} {len(render(chart_args).encode('utf-8')) / 1024:>10.1f}")
+        print(f"{size:>10} " + " ".join(cells))
+
+
+def scripted_llm(script: dict, delay: float):
+    """按scratchpad中Observation的数量返回预设输出的假LLM"""
+    from langchain_core.language_models.llms import LLM
+
+    class ScriptedLLM(LLM):
+        @property
+        def _llm_type(self) -> str:
+            return "scripted"
+
+        def _call(self, prompt, stop=None, run_manager=None, **kwargs):
+            time.sleep(delay)
+            return script[prompt.count("Observation:")]
+
+        async def _acall(self, prompt, stop=None, run_manager=None, **kwargs):
+            await asyncio.sleep(delay)
+            return script[prompt.count("Observation:")]
+
+    return ScriptedLLM()
+
+
+def stub_tools(delay: float):
+    """与正式工具同名、固定延迟的桩工具"""
+    from langchain_core.tools import tool
+
+    @tool("mairui")
+    def mairui(code: str) -> dict:
+        """获取股票实时行情"""
+        time.sleep(delay)
+        return {"股票代码": code, "当前价格": "1500元"}
+
+    @tool("tavily_search")
+    def tavily_search(query: str) -> str:
+        """搜索新闻"""
+        time.sleep(delay)
+        return f"{query}: 相关新闻若干"
+
+    return [mairui, tavily_search]
+
+
+def bench_tools(args):
+    """同一问题下顺序执行与并行+备忘录执行工具的耗时对比
+
+    顺序模式每轮只调用一个工具（当前Agent的行为），并行模式在一轮中同时请求行情和新闻，
+    随后重复请求的行情由本次运行的备忘录返回。
+    """
+    app_mod = load_app()
+    from langchain.agents import AgentExecutor, create_react_agent
+    from langchain_core.prompts import PromptTemplate
+
+    quote = "Thought: 查询行情\nAction: mairui\nAction Input: 600519"
+    news = "Thought: 搜索新闻\nAction: tavily_search\nAction Input: 贵州茅台 新闻"
+    final = "Thought: 我现在知道最终答案了\nFinal Answer: 贵州茅台当前价格1500元。"
+    both = "Thought: 同时查询行情和新闻\nAction: mairui\nAction Input: 600519\nAction: tavily_search\nAction Input: 贵州茅台 新闻"
+    prompt = PromptTemplate.from_template("{tools}\n{tool_names}\nQuestion: {input}\nThought: {agent_scratchpad}")
+    tools = stub_tools(args.tool_delay)
+
+    sequential_llm = scripted_llm({0: quote, 1: news, 2: quote, 3: final}, args.llm_delay)
+    sequential = AgentExecutor(agent=create_react_agent(sequential_llm, tools, prompt), tools=tools, max_iterations=5)
+    parallel_llm = scripted_llm({0: both, 2: quote, 3: final}, args.llm_delay)
+    output_parser_class, executor_class = app_mod.agent_classes()
+    parallel = executor_class(
+        agent=create_react_agent(parallel_llm, tools, prompt, output_parser=output_parser_class()),
+        tools=tools,
+        max_iterations=5,
+    )
+
+    async def run(executor):
+        app_mod.tool_run_memo.set({})
+        result = await executor.ainvoke({"input": "贵州茅台今天股价和新闻?"})
+        assert "1500" in result["output"], result
+
+    print(f"{'mode':>12} {'ms/answer':>10}")
+    for name, executor in (("sequential", sequential), ("parallel", parallel)):
+        elapsed = best_of(lambda: asyncio.run(run(executor)), args.repeat)
+        print(f"{name:>12} {elapsed * 1000:>10.1f}")
+    print(f"run memo: {app_mod.tool_memo_stats}")
+
+
+LEXICAL_FILLER = "公司营收利润增长同比下降市场行业板块投资风险收益资产负债经营现金流股东分红估值业绩预期产品销售渠道库存政策"
+LEXICAL_NAMES = ["贵州茅台", "五粮液", "宁德时代", "比亚迪", "招商银行", "中国平安", "隆基绿能", "中芯国际"]
+
+
+def lexical_corpus(docs: int, rng: random.Random):
+    """合成语料：常用财经词拼成的正文中夹带公司名和唯一的六位股票代码"""
+    corpus = []
+    for i in range(docs):
+        body = "".join(rng.choice(LEXICAL_FILLER) for _ in range(rng.randint(60, 160)))
+        corpus.append(f"{rng.choice(LEXICAL_NAMES)}({600000 + i}){body}。")
+    return corpus
+
+
+def bench_lexical(args):
+    """BM25倒排索引的构建速度、快照读写耗时和查询延迟"""
+    app_mod = load_app()
+    rng = random.Random(args.seed)
+    corpus = lexical_corpus(args.docs, rng)
+    index = app_mod.LexicalIndex(os.path.join(tempfile.mkdtemp(prefix="rag-bench-lexical-"), "lexical.npz"))
+    start = time.perf_counter()
+    for i in range(0, len(corpus), 4096):
+        index.add(corpus[i:i + 4096])
+    build = time.perf_counter() - start
+    start = time.perf_counter()
+    index.save()
+    save = time.perf_counter() - start
+    start = time.perf_counter()
+    app_mod.LexicalIndex(index.path).load()
+    load = time.perf_counter() - start
+    stats = index.stats()
+    print(f"docs {stats['docs']}, terms {stats['terms']}, postings {stats['postings']}")
+    print(f"build {build:.2f}s ({len(corpus) / build:.0f} docs/s), snapshot save {save * 1000:.0f}ms, load {load * 1000:.0f}ms")
+
+    queries = {
+        "code": lambda doc_id: str(600000 + doc_id),
+        "name+code": lambda doc_id: f"{corpus[doc_id].split('(')[0]} {600000 + doc_id} 营收",
+        "common": lambda doc_id: "".join(rng.sample(LEXICAL_FILLER, 6)),
+    }
+    print(f"{'query':>10} {'p50 ms':>8} {'p99 ms':>8} {'hit@1':>8}")
+    for kind, make_query in queries.items():
+        latencies, hits = [], 0
+        for _ in range(args.queries):
+            doc_id = rng.randrange(args.docs)
+            query = make_query(doc_id)
+            start = time.perf_counter()
+            ids, _ = index.search(query, app_mod.KB_HYBRID_CANDIDATES)
+            latencies.append((time.perf_counter() - start) * 1000)
+            hits += len(ids) > 0 and int(ids[0]) == doc_id
+        # common查询不含代码，命中率仅作对照
+        print(f"{kind:>10} {percentile(latencies, 0.5):>8.3f} {percentile(latencies, 0.99):>8.3f} {hits / args.queries:>8.3f}")
+
+
+def synthetic_quotes(rows: int, tick: int, rng: random.Random):
+    """合成行情快照：每个交易日9:30起每tick秒一个快照，价格随机游走，成交量为当日累计值"""
+    import numpy as np
+    per_day = 4 * 3600 // tick
+    index = np.arange(rows)
+    day_start = np.datetime64("2024-01-02T09:30:00").astype(np.int64)
+    times = day_start + index // per_day * 86400 + index % per_day * tick
+    np_rng = np.random.default_rng(rng.randrange(2 ** 32))
+    prices = 100 * np.exp(np.cumsum(np_rng.normal(0, 0.0005, rows)))
+    ticks = np_rng.integers(0, 50, rows).astype(np.float64)
+    day = index // per_day
+    # 按交易日分段累计
+    cumulative = np.cumsum(ticks)
+    day_first = np.searchsorted(day, day)
+    volumes = cumulative - cumulative[day_first] + ticks[day_first]
+    return {"time": times, "price": prices, "open": prices, "high": prices, "low": prices,
+            "prev_close": prices, "volume": volumes, "amount": volumes * prices * 100}
+
+
+def resample_python(times, prices, interval: int):
+    """逐行循环的对照实现（仅OHLC）"""
+    bars = []
+    for t, p in zip(times.tolist(), prices.tolist()):
+        bucket = t // interval * interval
+        if bars and bars[-1][0] == bucket:
+            bar = bars[-1]
+            bar[2], bar[3], bar[4] = max(bar[2], p), min(bar[3], p), p
+        else:
+            bars.append([bucket, p, p, p, p])
+    return bars
+
+
+def bench_quotes(args):
+    """行情时间序列的追加速度和按区间聚合K线的延迟"""
+    import numpy as np
+    app_mod = load_app()
+    store = app_mod.QuoteStore(tempfile.mkdtemp(prefix="rag-bench-quotes-"))
+    start = time.perf_counter()
+    for i in range(args.appends):
+        stamp = str(np.datetime64("2024-01-02T09:30:00") + np.timedelta64(i, 's')).replace("T", " ")
+        store.append("000001", {"p": 10 + i % 100 / 100, "v": i, "cje": i * 1000, "t": stamp})
+    elapsed = time.perf_counter() - start
+    print(f"append {args.appends} snapshots: {args.appends / elapsed:.0f}/s")
+
+    # 大序列直接按列写文件，与逐条追加得到的文件格式相同
+    columns = synthetic_quotes(args.rows, args.tick, random.Random(args.seed))
+    os.makedirs(os.path.join(store.root, "600519"))
+    for name, (_, dtype, _) in app_mod.QUOTE_COLUMNS.items():
+        columns[name].astype(dtype).tofile(store._path("600519", name))
+    last_day = int(columns["time"][-1]) // 86400 * 86400
+    print(f"series: {args.rows} snapshots every {args.tick}s, {args.rows * args.tick // (4 * 3600)} trading days")
+    print(f"{'interval':>8} {'range':>6} {'bars':>6} {'p50 ms':>8}")
+    for interval in args.intervals.split(","):
+        seconds = app_mod.parse_quote_interval(interval)
+        for label, begin in (("all", None), ("1 day", last_day)):
+            timings = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                bars = app_mod.quote_bars_json(store.history("600519", seconds, begin, None, app_mod.QUOTE_HISTORY_MAX_BARS))
+                timings.append((time.perf_counter() - start) * 1000)
+            print(f"{interval:>8} {label:>6} {len(bars):>6} {percentile(timings, 0.5):>8.2f}")
+    start = time.perf_counter()
+    resample_python(columns["time"], columns["price"], 300)
+    print(f"python loop, 5m over all snapshots: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+
+# 负载测试中假LLM的脚本：先同时请求行情和新闻，拿到观察结果后给出最终回答
+LOAD_SCRIPT = [
+    "Thought: 需要同时查询行情和新闻\nAction: mairui\nAction Input: 600519\n"
+    "Action: tavily_search\nAction Input: 贵州茅台 最新消息",
+    "Thought: 我现在知道最终答案了\nFinal Answer: 贵州茅台（600519）当前价格为1500.00元，较昨日收盘上涨1.20%，"
+    "成交额约45亿元，换手率0.36%。近期新闻显示公司经营稳健，渠道库存处于合理水平，市场对其分红预期保持稳定。"
+    "从走势看股价在1450元至1550元区间震荡，短期波动主要受消费板块整体情绪影响，建议结合自身风险偏好理性看待。",
+]
+LOAD_QUESTIONS = ["贵州茅台今天股价?", "茅台最新消息和行情", "600519现在多少钱", "贵州茅台走势如何"]
+LOAD_TOKEN_CHARS = 3
+
+
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+    """确定性的假Ollama：/api/embed返回哈希向量，/api/generate按脚本逐token流式输出"""
+
+    protocol_version = "HTTP/1.1"
+    token_delay = 0.0
+    # 模型首次被请求时的加载耗时，模拟Ollama冷启动
+    load_delay = 0.0
+    loaded_models = set()
+
+    def log_message(self, *args):
+        pass
+
+    def _load_model(self, model: str):
+        if model not in self.loaded_models:
+            time.sleep(self.load_delay)
+            self.loaded_models.add(model)
+
+    def _send_json(self, obj: dict):
+        data = json.dumps(obj).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_chunk(self, obj: dict):
+        data = (json.dumps(obj) + "\n").encode("utf-8")
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if self.path in ("/api/embed", "/api/generate"):
+            self._load_model(body["model"])
+        if self.path == "/api/embed":
+            texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+            vectors = [[b / 255 for b in hashlib.sha256(t.encode("utf-8")).digest()[:16]] for t in texts]
+            self._send_json({"model": body["model"], "embeddings": vectors})
+        elif self.path == "/api/generate":
+            # 提示词模板里也有Observation:，只统计最后一个Question:之后的scratchpad
+            scratchpad = body.get("prompt", "").rsplit("Question:", 1)[-1]
+            text = LOAD_SCRIPT[min(scratchpad.count("Observation:"), len(LOAD_SCRIPT) - 1)]
+            if not body.get("stream", True):
+                self._send_json({"model": body["model"], "created_at": "2025-01-01T00:00:00Z",
+                                 "response": text[:LOAD_TOKEN_CHARS], "done": True, "done_reason": "length"})
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            try:
+                for i in range(0, len(text), LOAD_TOKEN_CHARS):
+                    if self.token_delay:
+                        time.sleep(self.token_delay)
+                    self._send_chunk({"model": body["model"], "created_at": "2025-01-01T00:00:00Z",
+                                      "response": text[i:i + LOAD_TOKEN_CHARS], "done": False})
+                self._send_chunk({"model": body["model"], "created_at": "2025-01-01T00:00:00Z",
+                                  "response": "", "done": True, "done_reason": "stop"})
+                self.wfile.write(b"0\r\n\r\n")
+            except (BrokenPipeError, ConnectionResetError):
+                # 服务端取消了生成（客户端断开或超时），与真实Ollama一样停止输出
+                self.close_connection = True
+        else:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_fake_ollama(token_delay: float, load_delay: float = 0.0) -> ThreadingHTTPServer:
+    """在后台线程启动假Ollama，并通过OLLAMA_HOST让服务和任务进程都使用它"""
+    handler = type("Handler", (FakeOllamaHandler,), {
+        "token_delay": token_delay, "load_delay": load_delay, "loaded_models": set(),
+    })
+    server = ThreadingHTTPServer(("127.0.0.1", free_port()), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ["OLLAMA_HOST"] = f"http://127.0.0.1:{server.server_address[1]}"
+    return server
+
+
+class StubTavily:
+    """固定延迟的Tavily桩"""
+
+    def __init__(self, delay: float):
+        self.delay = delay
+
+    def search(self, query: str, max_results: int = 3) -> dict:
+        time.sleep(self.delay)
+        return {"query": query, "results": [
+            {"title": f"{query} 新闻{i}", "url": f"https://example.com/{i}", "content": "公司经营稳健。"}
+            for i in range(max_results)
+        ]}
+
+
+def stub_upstreams(app_mod, delay: float):
+    """替换行情和搜索的上游调用，保留缓存和线程池等服务端逻辑"""
+    def fetch_quote(code: str) -> dict:
+        time.sleep(delay)
+        return {"股票名称": "贵州茅台", "当前价格": "1500.00元", "涨跌幅": "1.20%", "股票代码": code}
+
+    app_mod.fetch_mairui_quote = fetch_quote
+    app_mod._tavily_client = StubTavily(delay)
+
+
+def rss_bytes() -> int:
+    """当前进程常驻内存"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        import resource
+        scale = 1 if sys.platform == "darwin" else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+class ServerSampler:
+    """在服务端事件循环内定期采样线程池占用、Agent池等待数和内存"""
+
+    def __init__(self, app_mod, interval: float = 0.02):
+        self.app_mod = app_mod
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        import anyio.to_thread
+        limiter = anyio.to_thread.current_default_thread_limiter()
+        while True:
+            self.samples.append({
+                "threads_borrowed": limiter.borrowed_tokens,
+                "threads_total": limiter.total_tokens,
+                "tool_queue": self.app_mod.tool_executor._work_queue.qsize(),
+                "agent_waiting": self.app_mod.agent_pool.stats()["waiting"],
+                "rss": rss_bytes(),
+            })
+            await asyncio.sleep(self.interval)
+
+    def summary(self) -> dict:
+        if not self.samples:
+            return {}
+        borrowed = [s["threads_borrowed"] for s in self.samples]
+        total = self.samples[-1]["threads_total"]
+        return {
+            "threadpool_limit": total,
+            "threadpool_peak": max(borrowed),
+            "threadpool_mean": round(sum(borrowed) / len(borrowed), 2),
+            "threadpool_saturated_ratio": round(sum(b >= total for b in borrowed) / len(borrowed), 4),
+            "tool_queue_peak": max(s["tool_queue"] for s in self.samples),
+            "agent_waiting_peak": max(s["agent_waiting"] for s in self.samples),
+            "rss_start_mb": round(self.samples[0]["rss"] / 2 ** 20, 1),
+            "rss_peak_mb": round(max(s["rss"] for s in self.samples) / 2 ** 20, 1),
+        }
+
+
+def start_server(app_mod, port: int):
+    """在后台线程运行uvicorn，返回(server, thread)"""
+    import uvicorn
+    config = uvicorn.Config(app_mod.app, host="127.0.0.1", port=port, log_level="warning", lifespan="on")
+    server = uvicorn.Server(config)
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        if not thread.is_alive():
+            raise RuntimeError("服务启动失败")
+        time.sleep(0.05)
+    return server, thread
+
+
+def percentile(values, q: float) -> float:
+    """线性插值百分位数"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    pos = (len(ordered) - 1) * q
+    low = int(pos)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (pos - low)
+
+
+def latency_summary(records) -> dict:
+    ok = [r for r in records if r["ok"]]
+    latencies = [r["latency"] * 1000 for r in ok]
+    summary = {
+        "count": len(records),
+        "errors": len(records) - len(ok),
+        "p50_ms": round(percentile(latencies, 0.50), 2),
+        "p95_ms": round(percentile(latencies, 0.95), 2),
+        "p99_ms": round(percentile(latencies, 0.99), 2),
+        "mean_ms": round(sum(latencies) / len(latencies), 2) if latencies else 0.0,
+    }
+    ttfb = [r["ttfb"] * 1000 for r in ok if r.get("ttfb") is not None]
+    if ttfb:
+        summary["ttfb_p50_ms"] = round(percentile(ttfb, 0.50), 2)
+        summary["ttfb_p95_ms"] = round(percentile(ttfb, 0.95), 2)
+        summary["ttfb_p99_ms"] = round(percentile(ttfb, 0.99), 2)
+    chars = [(r["chars"], r["latency"] - r["ttfb"]) for r in ok if r.get("chars")]
+    if chars:
+        # 中文输出按一个字符约一个token计
+        rates = [n / d for n, d in chars if d > 0]
+        summary["tokens_per_s_p50"] = round(percentile(rates, 0.50), 1)
+        summary["tokens_total"] = sum(n for n, _ in chars)
+    return summary
+
+
+def chart_payload(i: int) -> dict:
+    """少量不同的数据集，模拟前端对同一批图表的重复渲染"""
+    variant = i % 8
+    data = [{"time": str(t), "value": 100 + 10 * math.sin((t + variant * 37) / 40)} for t in range(1000)]
+    return {"server_name": "mcp-server-chart", "tool_name": "generate_line_chart",
+            "args": {"data": data, "title": f"行情{variant}", "width": 800, "height": 400}}
+
+
+async def drive_load(base_url: str, args) -> dict:
+    """按配置的并发度和请求比例压测各接口，返回每个请求的耗时记录"""
+    import httpx
+
+    mix = []
+    for part in args.mix.split(","):
+        name, _, weight = part.partition("=")
+        mix += [name.strip()] * int(weight or 1)
+    rng = random.Random(args.seed)
+    plan = [rng.choice(mix) for _ in range(args.requests)]
+    records = {name: [] for name in set(mix)}
+    next_index = iter(range(args.requests))
+
+    async def chat(client, i):
+        message = LOAD_QUESTIONS[i % len(LOAD_QUESTIONS)]
+        start = time.perf_counter()
+        ttfb = None
+        chars = 0
+        async with client.stream("POST", "/api/chat", json={"message": message}) as response:
+            async for text in response.aiter_text():
+                if ttfb is None:
+                    ttfb = time.perf_counter() - start
+                chars += len(text)
+            ok = response.status_code == 200 and chars > 0
+        return {"ok": ok, "latency": time.perf_counter() - start, "ttfb": ttfb, "chars": chars}
+
+    async def chart(client, i):
+        start = time.perf_counter()
+        response = await client.post("/api/mcp/generate-line-chart", json=chart_payload(i))
+        return {"ok": response.status_code == 200, "latency": time.perf_counter() - start}
+
+    async def upload(client, i):
+        content = ("负载测试文档。" * 200 + f"编号{i}。\n").encode("utf-8")
+        start = time.perf_counter()
+        response = await client.post("/api/upload-documents", files={"files": (f"load-{i}.txt", content, "text/plain")})
+        return {"ok": response.status_code == 200, "latency": time.perf_counter() - start}
+
+    handlers = {"chat": chat, "chart": chart, "upload": upload}
+    unknown = set(mix) - set(handlers)
+    if unknown:
+        raise SystemExit(f"未知的请求类型: {', '.join(sorted(unknown))}")
+
+    async def worker(client):
+        for i in next_index:
+            kind = plan[i]
+            try:
+                record = await handlers[kind](client, i)
+            except Exception as e:
+                print(f"{kind} #{i} failed: {e}")
+                record = {"ok": False, "latency": 0.0}
+            records[kind].append(record)
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=120, limits=limits) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*[worker(client) for _ in range(args.concurrency)])
+        wall = time.perf_counter() - start
+    return {"records": records, "wall": wall}
+
+
+def compare_baseline(results: dict, baseline: dict, tolerance: float) -> list:
+    """与基线比较延迟指标，返回超出容忍度的回归项"""
+    regressions = []
+    print(f"\n{'metric':>28} {'baseline':>10} {'current':>10} {'change':>8}")
+    for kind, summary in results["endpoints"].items():
+        base = baseline["endpoints"].get(kind)
+        if not base:
+            continue
+        for metric in ("p50_ms", "p95_ms", "p99_ms", "ttfb_p95_ms"):
+            if metric not in summary or metric not in base:
+                continue
+            old, new = base[metric], summary[metric]
+            change = (new - old) / old if old else 0.0
+            # 绝对差异很小时视为噪声
+            regressed = change > tolerance and new - old > 5
+            flag = " !" if regressed else ""
+            print(f"{kind + '.' + metric:>28} {old:>10.2f} {new:>10.2f} {change:>+8.1%}{flag}")
+            if regressed:
+                regressions.append(f"{kind}.{metric}")
+    return regressions
+
+
+def bench_load(args):
+    """启动带假LLM和桩工具的服务，在指定并发下压测聊天、上传和图表接口"""
+    # 默认关闭回答缓存，测量的是完整的Agent路径
+    if not args.answer_cache:
+        os.environ["ANSWER_CACHE_TTL"] = "0"
+        os.environ["ANSWER_SEMANTIC_ENABLED"] = "0"
+    fake_ollama = start_fake_ollama(args.token_delay)
+    app_mod = load_app()
+    stub_upstreams(app_mod, args.tool_delay)
+    sampler = ServerSampler(app_mod)
+    app_mod.app.add_event_handler("startup", sampler.start)
+
+    port = free_port()
+    server, thread = start_server(app_mod, port)
+    try:
+        run = asyncio.run(drive_load(f"http://127.0.0.1:{port}", args))
+    finally:
+        server.should_exit = True
+        thread.join(timeout=30)
+        fake_ollama.shutdown()
+
+    results = {
+        "config": {
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "mix": args.mix,
+            "token_delay": args.token_delay,
+            "tool_delay": args.tool_delay,
+            "answer_cache": args.answer_cache,
+            "seed": args.seed,
+        },
+        "wall_s": round(run["wall"], 3),
+        "throughput_rps": round(args.requests / run["wall"], 2),
+        "endpoints": {kind: latency_summary(records) for kind, records in sorted(run["records"].items())},
+        "server": sampler.summary(),
+    }
+
+    print(f"\n{args.requests} requests, concurrency {args.concurrency}: "
+          f"{results['wall_s']}s, {results['throughput_rps']} req/s")
+    print(f"{'endpoint':>8} {'count':>6} {'errors':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} "
+          f"{'ttfb p50':>9} {'ttfb p95':>9} {'tok/s':>7}")
+    for kind, summary in results["endpoints"].items():
+        print(f"{kind:>8} {summary['count']:>6} {summary['errors']:>6} {summary['p50_ms']:>9.1f} "
+              f"{summary['p95_ms']:>9.1f} {summary['p99_ms']:>9.1f} {summary.get('ttfb_p50_ms', 0):>9.1f} "
+              f"{summary.get('ttfb_p95_ms', 0):>9.1f} {summary.get('tokens_per_s_p50', 0):>7.1f}")
+    for key, value in results["server"].items():
+        print(f"{key:>28}: {value}")
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"\n基线已保存到 {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("config") != results["config"]:
+            print("警告：基线的测试配置与本次不同，结果可能不可比")
+        regressions = compare_baseline(results, baseline, args.tolerance)
+        if regressions:
+            print(f"\n性能回归（超过{args.tolerance:.0%}）: {', '.join(regressions)}")
+            sys.exit(1)
+        print("\n未发现性能回归")
+
+
+async def drive_batch(base_url: str, messages: list, upstream_calls: list) -> dict:
+    """先逐个调用/api/chat，再把同样的问题作为一个批量请求发送，分别记录上游行情调用次数"""
+    import httpx
+    async with httpx.AsyncClient(base_url=base_url, timeout=300) as client:
+        start = time.perf_counter()
+        for message in messages:
+            response = await client.post("/api/chat", json={"message": message})
+            response.raise_for_status()
+        sequential = time.perf_counter() - start
+        sequential_calls = len(upstream_calls)
+        start = time.perf_counter()
+        first = None
+        lines = []
+        async with client.stream("POST", "/api/chat/batch", json={"messages": messages}) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if line:
+                    first = first or time.perf_counter() - start
+                    lines.append(json.loads(line))
+        batch = time.perf_counter() - start
+    return {"sequential": sequential, "batch": batch, "first": first, "lines": lines,
+            "upstream": (sequential_calls, len(upstream_calls) - sequential_calls)}
+
+
+def bench_batch(args):
+    """同一组问题逐个请求与批量请求的总耗时和上游调用次数对比"""
+    os.environ["ANSWER_CACHE_TTL"] = "0"
+    os.environ["ANSWER_SEMANTIC_ENABLED"] = "0"
+    # 关闭行情和搜索的TTL缓存，上游调用次数只反映批量请求内的去重
+    os.environ["MAIRUI_QUOTE_TTL"] = "0"
+    os.environ["TAVILY_CACHE_TTL"] = "0"
+    fake_ollama = start_fake_ollama(args.token_delay)
+    app_mod = load_app()
+    stub_upstreams(app_mod, args.tool_delay)
+    upstream_calls = []
+    fetch_quote = app_mod.fetch_mairui_quote
+
+    def counted_fetch(code: str) -> dict:
+        upstream_calls.append(code)
+        return fetch_quote(code)
+
+    app_mod.fetch_mairui_quote = counted_fetch
+    # 每个问题文字不同，批量请求中不会被合并为同一个问题
+    messages = [f"{LOAD_QUESTIONS[i % len(LOAD_QUESTIONS)]}（{i}）" for i in range(args.messages)]
+
+    port = free_port()
+    server, thread = start_server(app_mod, port)
+    try:
+        run = asyncio.run(drive_batch(f"http://127.0.0.1:{port}", messages, upstream_calls))
+    finally:
+        server.should_exit = True
+        thread.join(timeout=30)
+        fake_ollama.shutdown()
+
+    summary = run["lines"][-1]
+    ok = sum(1 for line in run["lines"][:-1] if line["outcome"] == "ok")
+    print(f"{args.messages} messages, batch concurrency {app_mod.CHAT_BATCH_CONCURRENCY}")
+    print(f"{'mode':>10} {'wall s':>8} {'msg/s':>8}")
+    print(f"{'sequential':>10} {run['sequential']:>8.2f} {args.messages / run['sequential']:>8.2f}")
+    print(f"{'batch':>10} {run['batch']:>8.2f} {args.messages / run['batch']:>8.2f}")
+    print(f"speedup {run['sequential'] / run['batch']:.2f}x, first batch result after {run['first'] * 1000:.0f}ms, {ok} ok")
+    print(f"batch tool calls {summary['tool_calls']}, executed {summary['executed_tool_calls']}; "
+          f"quote upstream calls: sequential {run['upstream'][0]}, batch {run['upstream'][1]}")
+
+
+STARTUP_RESULT_PREFIX = "\nSTARTUP_RESULT "
+
+
+def probe_startup(args):
+    """在新进程中测量一次启动：导入耗时、开始监听、/health就绪和首个聊天请求的首字节时间"""
+    import httpx
+
+    start = time.perf_counter()
+    fake_ollama = start_fake_ollama(args.token_delay, args.load_delay)
+    os.environ["WARMUP_ENABLED"] = "0" if args.no_warmup else "1"
+    begin = time.perf_counter()
+    app_mod = load_app()
+    import_ms = (time.perf_counter() - begin) * 1000
+    stub_upstreams(app_mod, 0.0)
+    port = free_port()
+    server, thread = start_server(app_mod, port)
+    listen_ms = (time.perf_counter() - start) * 1000
+    with httpx.Client(base_url=f"http://127.0.0.1:{port}", timeout=120) as client:
+        while client.get("/health").status_code != 200:
+            time.sleep(0.01)
+        ready_ms = (time.perf_counter() - start) * 1000
+        chat_start = time.perf_counter()
+        with client.stream("POST", "/api/chat", json={"message": "贵州茅台今天股价?"}) as response:
+            for _ in response.iter_bytes():
+                break
+        first_chat_ms = (time.perf_counter() - chat_start) * 1000
+    server.should_exit = True
+    thread.join(timeout=30)
+    fake_ollama.shutdown()
+    print(STARTUP_RESULT_PREFIX + json.dumps({
+        "import_ms": round(import_ms, 1),
+        "listen_ms": round(listen_ms, 1),
+        "ready_ms": round(ready_ms, 1),
+        "first_chat_ms": round(first_chat_ms, 1),
+    }))
+
+
+def bench_startup(args):
+    """每次在独立进程中启动服务，对比启动预热与首个请求时才加载的耗时"""
+    import statistics
+    import subprocess
+
+    print(f"{'mode':>10} {'import ms':>10} {'listen ms':>10} {'ready ms':>10} {'1st chat ms':>12}")
+    for mode, extra in (("warmup", []), ("lazy", ["--no-warmup"])):
+        runs = []
+        for _ in range(args.repeat):
+            cmd = [sys.executable, os.path.abspath(__file__), "startup-probe",
+                   "--load-delay", str(args.load_delay), "--token-delay", str(args.token_delay)] + extra
+            output = subprocess.run(cmd, capture_output=True, text=True, check=True).stdout
+            # Agent的verbose输出也在stdout中，按前缀找到结果行
+            result = output[output.rindex(STARTUP_RESULT_PREFIX) + len(STARTUP_RESULT_PREFIX):].splitlines()[0]
+            runs.append(json.loads(result))
+        cells = [statistics.median(run[key] for run in runs) for key in ("import_ms", "listen_ms", "ready_ms", "first_chat_ms")]
+        print(f"{mode:>10} {cells[0]:>10.1f} {cells[1]:>10.1f} {cells[2]:>10.1f} {cells[3]:>12.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RAG聊天服务性能基准测试")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    chart = subparsers.add_parser("chart", help="图表渲染耗时")
+    chart.add_argument("--sizes", default="100,1000,10000,100000,500000")
+    chart.add_argument("--repeat", type=int, default=5)
+    chart.set_defaults(func=bench_chart)
+
+    tools = subparsers.add_parser("tools", help="Agent工具顺序执行与并行执行对比（桩工具）")
+    tools.add_argument("--tool-delay", type=float, default=0.2)
+    tools.add_argument("--llm-delay", type=float, default=0.05)
+    tools.add_argument("--repeat", type=int, default=5)
+    tools.set_defaults(func=bench_tools)
+
+    lexical = subparsers.add_parser("lexical", help="BM25倒排索引构建与查询延迟（合成语料）")
+    lexical.add_argument("--docs", type=int, default=100000)
+    lexical.add_argument("--queries", type=int, default=2000)
+    lexical.add_argument("--seed", type=int, default=0)
+    lexical.set_defaults(func=bench_lexical)
+
+    quotes = subparsers.add_parser("quotes", help="行情时间序列追加与K线聚合延迟（合成数据）")
+    quotes.add_argument("--rows", type=int, default=1000000)
+    quotes.add_argument("--tick", type=int, default=3, help="快照间隔秒数")
+    quotes.add_argument("--appends", type=int, default=5000)
+    quotes.add_argument("--intervals", default="1m,5m,1h,1d")
+    quotes.add_argument("--repeat", type=int, default=5)
+    quotes.add_argument("--seed", type=int, default=0)
+    quotes.set_defaults(func=bench_quotes)
+
+    batch = subparsers.add_parser("batch", help="批量聊天接口与逐个请求的吞吐对比（假LLM、桩工具）")
+    batch.add_argument("--messages", type=int, default=32)
+    batch.add_argument("--token-delay", type=float, default=0.01, help="假LLM每个token的延迟秒数")
+    batch.add_argument("--tool-delay", type=float, default=0.1, help="桩工具的上游延迟秒数")
+    batch.set_defaults(func=bench_batch)
+
+    startup = subparsers.add_parser("startup", help="启动耗时：导入、就绪和首个聊天请求")
+    startup.add_argument("--repeat", type=int, default=3)
+    startup.add_argument("--load-delay", type=float, default=2.0, help="假Ollama首次加载模型的秒数")
+    startup.add_argument("--token-delay", type=float, default=0.0)
+    startup.set_defaults(func=bench_startup)
+
+    probe = subparsers.add_parser("startup-probe", help="（内部）在当前进程中测量一次启动")
+    probe.add_argument("--load-delay", type=float, default=2.0)
+    probe.add_argument("--token-delay", type=float, default=0.0)
+    probe.add_argument("--no-warmup", action="store_true")
+    probe.set_defaults(func=probe_startup)
+
+    load = subparsers.add_parser("load", help="并发压测聊天、上传和图表接口（假LLM、桩工具）")
+    load.add_argument("--concurrency", type=int, default=16)
+    load.add_argument("--requests", type=int, default=200)
+    load.add_argument("--mix", default="chat=8,chart=1,upload=1", help="请求类型及权重")
+    load.add_argument("--token-delay", type=float, default=0.01, help="假LLM每个token的延迟秒数")
+    load.add_argument("--tool-delay", type=float, default=0.1, help="桩工具的上游延迟秒数")
+    load.add_argument("--answer-cache", action="store_true", help="启用回答缓存")
+    load.add_argument("--seed", type=int, default=0)
+    load.add_argument("--save-baseline", metavar="FILE")
+    load.add_argument("--baseline", metavar="FILE", help="与已保存的基线比较，出现回归时退出码为1")
+    load.add_argument("--tolerance", type=float, default=0.2)
+    load.set_defaults(func=bench_load)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,24 @@
+import importlib.util
+import os
+import sys
+import tempfile
+
+import pytest
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_FILE = os.path.join(BASE_DIR, "使用FastAPI基于langchain实现RAG-GUI版本.py")
+APP_MODULE = "rag_gui_app"
+
+
+@pytest.fixture(scope="session")
+def app_mod():
+    """按路径加载后端主文件（文件名不是合法模块名），使用临时知识库目录"""
+    if APP_MODULE in sys.modules:
+        return sys.modules[APP_MODULE]
+    os.environ.setdefault("KB_DIR", tempfile.mkdtemp(prefix="rag-test-"))
+    os.environ.setdefault("WARMUP_ENABLED", "false")
+    spec = importlib.util.spec_from_file_location(APP_MODULE, APP_FILE)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[APP_MODULE] = module
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,81 @@
+import asyncio
+
+import pytest
+
+
+def run(coro_fn):
+    return asyncio.run(coro_fn())
+
+
+def test_round_robin_across_clients(app_mod):
+    """突发请求较多的客户端不会挤占其他客户端：等待队列按客户端轮询出队"""
+    async def scenario():
+        admission = app_mod.AdmissionController(1, 32, 8)
+        running = admission.enqueue("busy")
+        tickets = [admission.enqueue("a") for _ in range(3)] + [admission.enqueue("b"), admission.enqueue("c")]
+        assert [admission.position(t) for t in tickets] == [1, 4, 5, 2, 3]
+        order = []
+        current = running
+        for _ in range(len(tickets)):
+            admission.release(current)
+            current = next(t for t in tickets if t.state == "admitted")
+            order.append((current.client, tickets.index(current)))
+        admission.release(current)
+        return order, admission.stats()
+
+    order, stats = run(scenario)
+    assert [client for client, _ in order] == ["a", "b", "c", "a", "a"]
+    assert stats["in_flight"] == 0 and stats["queued"] == 0
+
+
+def test_queue_full_and_client_limit_are_rejected(app_mod):
+    async def scenario():
+        admission = app_mod.AdmissionController(1, 3, 2)
+        admission.enqueue("x")
+        admission.enqueue("a")
+        admission.enqueue("a")
+        with pytest.raises(app_mod.AdmissionRejected) as client_limit:
+            admission.enqueue("a")
+        admission.enqueue("b")
+        with pytest.raises(app_mod.AdmissionRejected) as queue_full:
+            admission.enqueue("c")
+        return client_limit.value, queue_full.value
+
+    client_limit, queue_full = run(scenario)
+    assert client_limit.reason == "client_limit"
+    assert queue_full.reason == "queue_full"
+    assert queue_full.retry_after >= 1
+
+
+def test_abandoned_ticket_leaves_the_queue(app_mod):
+    async def scenario():
+        admission = app_mod.AdmissionController(1, 4, 4)
+        running = admission.enqueue("x")
+        waiting = admission.enqueue("a")
+        nxt = admission.enqueue("b")
+        admission.release(waiting)
+        admission.release(running)
+        return nxt.state, admission.stats()
+
+    state, stats = run(scenario)
+    assert state == "admitted"
+    assert stats["abandoned"] == 1 and stats["queued"] == 0
+
+
+def test_wait_reports_positions_and_times_out(app_mod, monkeypatch):
+    monkeypatch.setattr(app_mod, "CHAT_QUEUE_TIMEOUT", 0.2)
+    monkeypatch.setattr(app_mod, "CHAT_QUEUE_POLL", 0.05)
+
+    async def scenario():
+        admission = app_mod.AdmissionController(1, 4, 4)
+        admission.enqueue("x")
+        ticket = admission.enqueue("a")
+        positions = []
+        with pytest.raises(asyncio.TimeoutError):
+            async for position in admission.wait(ticket):
+                positions.append(position)
+        return positions, admission.stats()
+
+    positions, stats = run(scenario)
+    assert positions == [1]
+    assert stats["queue_timeouts"] == 1
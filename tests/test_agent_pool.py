@@ -0,0 +1,27 @@
+import asyncio
+import threading
+
+
+def test_agents_are_built_off_the_event_loop(app_mod, monkeypatch):
+    """池中没有空闲Agent时在线程池中构建，借用归还后复用"""
+    threads = []
+
+    def create_agent():
+        threads.append(threading.get_ident())
+        return object()
+
+    monkeypatch.setattr(app_mod, "create_agent", create_agent)
+    pool = app_mod.AgentPool(size=1, timeout=1.0)
+
+    async def borrow_twice():
+        loop_thread = threading.get_ident()
+        async with pool.borrow() as first:
+            pass
+        async with pool.borrow() as second:
+            pass
+        return loop_thread, first, second
+
+    loop_thread, first, second = asyncio.run(borrow_twice())
+    assert first is second
+    assert threads and loop_thread not in threads
+    assert pool.stats()["created"] == 1
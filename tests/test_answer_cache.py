@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+
+@pytest.fixture
+def cache(app_mod, monkeypatch):
+    """所有问题使用同一个向量，语义层只靠数字和代码区分"""
+    cache = app_mod.AnswerCache(16, threshold=0.95, semantic=True)
+    monkeypatch.setattr(cache, "embed", lambda message: np.array([1.0, 0.0], dtype=np.float32))
+    return cache
+
+
+def test_semantic_tier_requires_same_ticker(cache):
+    _, vector = cache.lookup("AAPL现在股价多少")
+    cache.store("AAPL现在股价多少", "AAPL: 190", ["mairui"], vector)
+
+    assert cache.lookup("TSLA现在股价多少")[0] is None
+    assert cache.lookup("AAPL股价现在是多少")[0] == "AAPL: 190"
+    assert cache.stats()["semantic_hits"] == 1
+
+
+def test_semantic_tier_requires_same_stock_code(cache):
+    cache.store("600519的最新价", "1700", ["mairui"], cache.embed(""))
+    assert cache.lookup("000858的最新价")[0] is None
+    assert cache.lookup("600519最新价是多少")[0] == "1700"
+
+
+def test_streaming_cache_hit_skips_admission(app_mod, monkeypatch):
+    """命中回答缓存的请求在准入队列已满时也能直接回放"""
+    import asyncio
+
+    def reject(client):
+        raise app_mod.AdmissionRejected("queue_full", 1)
+
+    monkeypatch.setattr(app_mod.answer_cache, "semantic", False)
+    monkeypatch.setattr(app_mod.admission, "enqueue", reject)
+    app_mod.answer_cache.store("上证指数是多少", "3000点", ["mairui"])
+
+    async def collect(message):
+        return [chunk async for chunk in app_mod.create_streaming_response(message, client="c1")]
+
+    assert "".join(asyncio.run(collect("上证指数是多少"))) == "3000点"
+    assert asyncio.run(collect("深证成指是多少")) == ["服务繁忙，请稍后重试。"]
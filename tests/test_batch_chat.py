@@ -0,0 +1,82 @@
+import asyncio
+import json
+from contextlib import asynccontextmanager
+
+import pytest
+
+
+class SlowAgent:
+    def __init__(self, delay):
+        self.delay = delay
+
+    async def astream(self, inputs, config=None):
+        await asyncio.sleep(self.delay)
+        yield {"output": f"答:{inputs['input']}"}
+
+
+class FakePool:
+    def __init__(self, delay=0.0, exhausted=False):
+        self.delay = delay
+        self.exhausted = exhausted
+
+    @asynccontextmanager
+    async def borrow(self):
+        if self.exhausted:
+            raise FakePool.timeout()
+        yield SlowAgent(self.delay)
+
+
+@pytest.fixture
+def batch_env(app_mod, monkeypatch):
+    monkeypatch.setattr(app_mod, "answer_cache", app_mod.AnswerCache(16, 0.95, False))
+    FakePool.timeout = app_mod.AgentPoolTimeout
+    return app_mod
+
+
+def test_batch_items_have_their_own_admission_quota(app_mod):
+    """客户端自己的排队配额已满时，批量请求的问题仍可按CHAT_BATCH_CONCURRENCY排队"""
+    async def run():
+        admission = app_mod.AdmissionController(1, 32, 1)
+        busy = admission.enqueue("c2")
+        own = admission.enqueue("c1")
+        with pytest.raises(app_mod.AdmissionRejected):
+            admission.enqueue("c1")
+        batch = [admission.enqueue(app_mod.batch_client("c1"), 4) for _ in range(4)]
+        with pytest.raises(app_mod.AdmissionRejected):
+            admission.enqueue(app_mod.batch_client("c1"), 4)
+        # 普通聊天与批量问题轮询出队
+        admission.release(busy)
+        assert own.state == "admitted"
+        admission.release(own)
+        assert batch[0].state == "admitted"
+
+    asyncio.run(run())
+
+
+def test_large_batch_is_not_rejected(batch_env, monkeypatch):
+    app_mod = batch_env
+    monkeypatch.setattr(app_mod, "agent_pool", FakePool(delay=0.01))
+    monkeypatch.setattr(app_mod, "CHAT_BATCH_CONCURRENCY", 4)
+
+    async def run():
+        monkeypatch.setattr(app_mod, "admission", app_mod.AdmissionController(2, 32, 1))
+        return [json.loads(line) async for line in app_mod.create_batch_response(
+            [f"问题{i}" for i in range(12)], app_mod.batch_client("c1"))]
+
+    results = asyncio.run(run())[:-1]
+    assert len(results) == 12
+    assert {r["outcome"] for r in results} == {"ok"}
+
+
+def test_pool_timeout_and_deadline_are_reported_separately(batch_env, monkeypatch):
+    app_mod = batch_env
+    monkeypatch.setattr(app_mod, "CHAT_DEADLINE", 0.1)
+
+    async def answer(pool):
+        monkeypatch.setattr(app_mod, "admission", app_mod.AdmissionController(2, 32, 4))
+        monkeypatch.setattr(app_mod, "agent_pool", pool)
+        return await app_mod.answer_batch_item("问题", app_mod.batch_client("c1"), {})
+
+    assert asyncio.run(answer(FakePool(exhausted=True)))["outcome"] == "pool_timeout"
+    assert asyncio.run(answer(FakePool(delay=1.0)))["outcome"] == "deadline"
+    assert asyncio.run(answer(FakePool(delay=0.0)))["outcome"] == "ok"
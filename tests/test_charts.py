@@ -0,0 +1,47 @@
+from fastapi.testclient import TestClient
+
+
+def test_invalid_chart_request_is_rejected_before_etag_check(app_mod):
+    """携带匹配的If-None-Match时，非法的图表类型或参数也不能返回304"""
+    client = TestClient(app_mod.app)
+    url = "/api/mcp/generate-line-chart"
+    body = {"server_name": "chart", "tool_name": "generate_line_chart", "args": {"data": [{"category": "a", "value": 1}]}}
+    first = client.post(url, json=body)
+    assert first.status_code == 200
+    assert client.post(url, json=body, headers={"If-None-Match": first.headers["etag"]}).status_code == 304
+
+    bad_tool = dict(body, tool_name="generate_pie_chart")
+    etag = f'"{app_mod.RenderCache.key(bad_tool["tool_name"], bad_tool["args"])}"'
+    assert client.post(url, json=bad_tool, headers={"If-None-Match": etag}).status_code == 400
+    assert client.post(url, json=bad_tool, headers={"If-None-Match": "*"}).status_code == 400
+
+    bad_args = dict(body, args={"data": [{"value": "abc"}]})
+    assert client.post(url, json=bad_args, headers={"If-None-Match": "*"}).status_code == 400
+
+
+def test_chart_rendering_runs_off_the_event_loop(app_mod, monkeypatch):
+    """校验、哈希和渲染都不在事件循环线程上执行"""
+    import asyncio
+    import threading
+    from starlette.requests import Request
+
+    threads = {}
+    for name in ("chart_key", "render_chart_entry"):
+        original = getattr(app_mod, name)
+
+        def wrapper(*args, _name=name, _original=original):
+            threads[_name] = threading.get_ident()
+            return _original(*args)
+        monkeypatch.setattr(app_mod, name, wrapper)
+
+    request = app_mod.MCPChartRequest(server_name="chart", tool_name="generate_bar_chart",
+                                      args={"data": [{"category": "x", "value": i} for i in range(5000)]})
+
+    async def run():
+        response = await app_mod.chart_response(request, Request({"type": "http", "headers": []}))
+        return threading.get_ident(), response
+
+    loop_thread, response = asyncio.run(run())
+    assert response.status_code == 200
+    assert set(threads) == {"chart_key", "render_chart_entry"}
+    assert loop_thread not in threads.values()
@@ -0,0 +1,122 @@
+import os
+import sqlite3
+
+import pytest
+
+
+@pytest.fixture
+def kb(app_mod, tmp_path, monkeypatch):
+    """独立的知识库、水位文件和确定性的向量化模型"""
+    from langchain_core.embeddings.fake import DeterministicFakeEmbedding
+    knowledge_base = app_mod.KnowledgeBase(str(tmp_path / "kb"))
+    monkeypatch.setattr(app_mod, "get_knowledge_base", lambda: knowledge_base)
+    monkeypatch.setattr(app_mod, "DB_WATERMARK_PATH", str(tmp_path / "watermarks.json"))
+    monkeypatch.setattr(app_mod, "_embeddings", DeterministicFakeEmbedding(size=16))
+    return knowledge_base
+
+
+@pytest.fixture
+def db(app_mod, tmp_path):
+    path = str(tmp_path / "notes.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE notes (id INTEGER PRIMARY KEY, note TEXT, updated_at TEXT)")
+    conn.executemany("INSERT INTO notes VALUES (?, ?, ?)", [
+        (1, "note1", "2024-01-01 10:00:00"),
+        (2, "note2", "2024-01-01 10:00:01"),
+        (3, "note3", "2024-01-01 10:00:02"),
+    ])
+    conn.commit()
+    yield conn, app_mod.DatabaseConfig(type="sqlite", database=path)
+    conn.close()
+
+
+def live_texts(knowledge_base) -> list:
+    snapshot = knowledge_base.snapshot()
+    texts = []
+    for segment, deleted in snapshot.segments:
+        for i, meta in enumerate(segment.iter_metadata()):
+            if deleted is None or not deleted[i]:
+                texts.append(meta["text"])
+    return sorted(texts)
+
+
+def test_insert_update_and_reimport(app_mod, kb, db):
+    conn, config = db
+    result = app_mod.import_database(config)
+    assert result["rows"] == 3
+    assert kb.count == 3
+
+    # 更新一行、插入一行：再次导入只取这两行，更新的行替换旧文本块
+    conn.execute("UPDATE notes SET note = 'CHANGED', updated_at = '2024-01-01 10:00:05' WHERE id = 2")
+    conn.execute("INSERT INTO notes VALUES (4, 'note4', '2024-01-01 10:00:06')")
+    conn.commit()
+    result = app_mod.import_database(config)
+    assert result["rows"] == 2
+    assert kb.count == 4
+    texts = live_texts(kb)
+    assert any("note: CHANGED" in text for text in texts)
+    assert not any("note: note2" in text for text in texts)
+
+    # 没有变化时不导入任何行
+    assert app_mod.import_database(config)["rows"] == 0
+    assert kb.count == 4
+
+
+def test_rows_sharing_last_watermark_are_not_skipped(app_mod, kb, db):
+    conn, config = db
+    app_mod.import_database(config)
+    # 水位值与上次最后一行相同、主键更大的行在导入之后才提交
+    conn.execute("INSERT INTO notes VALUES (5, 'note5', '2024-01-01 10:00:02')")
+    conn.commit()
+    assert app_mod.import_database(config)["rows"] == 1
+    assert kb.count == 4
+    assert any("note: note5" in text for text in live_texts(kb))
+
+
+def test_table_without_primary_key_deduplicates_boundary_rows(app_mod, kb, tmp_path):
+    path = str(tmp_path / "log.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE log (message TEXT, updated_at TEXT)")
+    conn.executemany("INSERT INTO log VALUES (?, ?)", [("a", "t1"), ("b", "t2")])
+    conn.commit()
+    config = app_mod.DatabaseConfig(type="sqlite", database=path)
+    app_mod.import_database(config)
+    conn.execute("INSERT INTO log VALUES ('c', 't2')")
+    conn.commit()
+    # 取水位>=t2的行，t2的旧文本块先删除再写入
+    app_mod.import_database(config)
+    conn.close()
+    texts = live_texts(kb)
+    assert len(texts) == 3
+    assert sum("message: b" in text for text in texts) == 1
+
+
+def test_missing_sqlite_file_is_an_error_and_not_created(app_mod, tmp_path):
+    path = tmp_path / "typo.db"
+    config = app_mod.DatabaseConfig(type="sqlite", database=str(path))
+    with pytest.raises(ValueError):
+        app_mod.open_db_connection(config)
+    assert not path.exists()
+
+
+def test_sqlite_is_opened_read_only(app_mod, db):
+    _, config = db
+    conn = app_mod.open_db_connection(config)
+    with pytest.raises(sqlite3.OperationalError):
+        conn.execute("CREATE TABLE t (x)")
+    conn.close()
+
+
+def test_row_locator_finds_rows_across_batches(app_mod, kb, db):
+    """重新同步时旧文本块的位置从临时SQLite索引中查找"""
+    _, config = db
+    app_mod.import_database(config)
+    source = f"{config.database}.notes"
+    locator = app_mod.RowLocator(source)
+    try:
+        assert kb.delete_rows(source, ["1"], locator) == 1
+        assert kb.delete_rows(source, ["2", "3", "404"], locator) == 2
+    finally:
+        locator.close()
+    assert kb.count == 0
+    assert not os.path.exists(locator.path)
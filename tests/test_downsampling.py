@@ -0,0 +1,39 @@
+import re
+
+import numpy as np
+
+
+def test_lttb_keeps_endpoints_and_threshold_points(app_mod):
+    values = np.sin(np.linspace(0, 20, 10000)) + np.random.default_rng(0).normal(0, 0.1, 10000)
+    indices = app_mod.lttb_indices(values, 400)
+    assert len(indices) == 400
+    assert indices[0] == 0 and indices[-1] == 9999
+    assert np.all(np.diff(indices) > 0)
+
+
+def test_lttb_keeps_peaks(app_mod):
+    values = np.zeros(5000)
+    values[1234] = 100.0
+    values[3456] = -100.0
+    indices = app_mod.lttb_indices(values, 50)
+    assert 1234 in indices and 3456 in indices
+
+
+def test_lttb_returns_all_points_below_threshold(app_mod):
+    values = np.arange(10, dtype=np.float64)
+    assert app_mod.lttb_indices(values, 50).tolist() == list(range(10))
+    assert app_mod.lttb_indices(values, 2).tolist() == list(range(10))
+
+
+def test_bucket_means(app_mod):
+    means, starts = app_mod.bucket_means(np.arange(10, dtype=np.float64), 5)
+    assert means.tolist() == [0.5, 2.5, 4.5, 6.5, 8.5]
+    assert starts.tolist() == [0, 2, 4, 6, 8]
+
+
+def test_line_chart_point_count_bounded_by_plot_width(app_mod):
+    data = [{"category": str(i), "value": float(i % 97)} for i in range(100000)]
+    svg = app_mod.generate_mock_line_chart({"data": data, "width": 500, "height": 300})
+    points = re.search(r'<polyline points="([^"]+)"', svg).group(1).split()
+    assert len(points) == 400
+    assert points[0].startswith("0.00,") and points[-1].startswith("400.00,")
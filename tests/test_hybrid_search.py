@@ -0,0 +1,15 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+def test_concurrent_searches_are_all_counted(app_mod, tmp_path):
+    """线程池中并发检索时查询计数不丢失"""
+    kb = app_mod.KnowledgeBase(str(tmp_path / "kb"))
+    texts = [f"文档{i} 贵州茅台 营业收入 {i}" for i in range(50)]
+    kb.add(np.random.default_rng(0).random((50, 8)), [{"text": t, "source": "s.txt"} for t in texts])
+    vector = np.ones(8, dtype=np.float32)
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(lambda _: kb.hybrid_search("贵州茅台", vector, 5), range(400)))
+    assert all(len(r) == 5 for r in results)
+    assert kb.lexical_stats()["queries"] == 400
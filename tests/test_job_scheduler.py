@@ -0,0 +1,62 @@
+import asyncio
+from concurrent.futures.process import BrokenProcessPool
+
+
+def test_requeued_database_job_without_password_fails(app_mod, tmp_path):
+    """重启后内存中的密码已丢失，重新排队的数据库任务应直接失败而不是用空密码连接"""
+    store = app_mod.JobStore(str(tmp_path / "jobs.db"))
+
+    async def run():
+        scheduler = app_mod.JobScheduler(store, workers=1)
+        job_id = await scheduler.submit("database", "mysql://db", {"type": "mysql", "database": "db"}, secret="secret")
+        assert store.claim_next()["id"] == job_id
+
+        # 模拟服务重启：新调度器没有密码，运行中的任务重新排队
+        restarted = app_mod.JobScheduler(store, workers=1)
+        assert store.requeue_interrupted() == 1
+        await restarted._dispatch(store.claim_next())
+        return job_id, restarted
+
+    job_id, restarted = asyncio.run(run())
+    job = store.get(job_id)
+    assert job["status"] == "failed"
+    assert "密码" in job["error"]
+    assert not restarted._running
+
+
+class FakeExecutor:
+    def __init__(self):
+        self.shut_down = False
+
+    def submit(self, *args):
+        raise AssertionError("unused")
+
+    def shutdown(self, wait=True):
+        self.shut_down = True
+
+
+def test_broken_pool_is_replaced_once(app_mod, tmp_path, monkeypatch):
+    """进程池损坏时所有运行中的任务都失败，但只重建一个新池并关闭旧池"""
+    store = app_mod.JobStore(str(tmp_path / "jobs.db"))
+    scheduler = app_mod.JobScheduler(store, workers=3)
+    created = []
+    monkeypatch.setattr(scheduler, "_create_executor", lambda: created.append(FakeExecutor()) or created[-1])
+    broken = FakeExecutor()
+    scheduler._executor = broken
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        job_ids = [await scheduler.submit("rebuild", f"job{i}", {}) for i in range(3)]
+        assert all(store.claim_next() for _ in job_ids)
+        tasks = []
+        for job_id in job_ids:
+            future = loop.create_future()
+            future.set_exception(BrokenProcessPool("worker died"))
+            tasks.append(asyncio.create_task(scheduler._finish(job_id, broken, future)))
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+    assert len(created) == 1
+    assert scheduler._executor is created[0]
+    assert broken.shut_down
+    assert all(job["status"] == "pending" and "工作进程" in job["error"] for job in store.list())
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+
+DIM = 8
+
+
+def vectors(n, offset=0):
+    """每个文本块的向量在不同方向上，查询向量与哪个块相同就命中哪个"""
+    rng = np.random.default_rng(offset)
+    return rng.normal(size=(n, DIM)).astype(np.float32)
+
+
+@pytest.fixture
+def kb(app_mod, tmp_path, monkeypatch):
+    monkeypatch.setattr(app_mod, "KB_MERGE_FACTOR", 2)
+    monkeypatch.setattr(app_mod, "KB_RETIRE_GRACE", 0.0)
+    return app_mod.KnowledgeBase(str(tmp_path / "kb"))
+
+
+def add_file(kb, name, n, offset):
+    vecs = vectors(n, offset)
+    kb.add(vecs, [{"text": f"{name} 第{i}段", "source": name, "chunk": i} for i in range(n)])
+    return vecs
+
+
+def live_sources(kb):
+    snapshot = kb.snapshot()
+    sources = []
+    for segment, deleted in snapshot.segments:
+        for i, meta in enumerate(segment.iter_metadata()):
+            if deleted is None or not deleted[i]:
+                sources.append(meta["source"])
+    return sorted(set(sources))
+
+
+def test_delete_writes_tombstones_and_search_skips_them(kb):
+    a = add_file(kb, "a.txt", 5, 1)
+    add_file(kb, "b.txt", 5, 2)
+    assert kb.count == 10
+    assert kb.search(a[3], 1)[0]["source"] == "a.txt"
+
+    assert kb.delete_source("a.txt") == 5
+    assert kb.count == 5
+    # 分段本身不变，只有墓碑
+    assert kb.stats()["segments"] == 2
+    assert all(hit["source"] == "b.txt" for hit in kb.search(a[3], 5))
+    assert kb.delete_source("a.txt") == 0
+
+
+def test_compaction_keeps_live_rows_and_results_after_manifest_swap(kb):
+    files = {name: add_file(kb, name, 4, i) for i, name in enumerate(["a.txt", "b.txt", "c.txt", "d.txt"])}
+    kb.delete_source("b.txt")
+    before = kb.snapshot()
+    expected = {name: kb.search(vecs[2], 1)[0]["text"] for name, vecs in files.items() if name != "b.txt"}
+
+    assert kb.maybe_compact() >= 1
+    stats = kb.stats()
+    assert stats["segments"] < 4
+    assert stats["live"] == stats["rows"] == 12
+    assert live_sources(kb) == ["a.txt", "c.txt", "d.txt"]
+    # 新清单发布后检索结果不变，已删除的行不会因合并复活
+    for name, text in expected.items():
+        assert kb.search(files[name][2], 1)[0]["text"] == text
+    assert all(hit["source"] != "b.txt" for hit in kb.search(files["b.txt"][2], 12))
+    # 合并前取得的快照仍可读
+    assert before.live == 12
+
+
+def test_delete_after_compaction_targets_the_new_segment(kb):
+    add_file(kb, "a.txt", 3, 1)
+    add_file(kb, "b.txt", 3, 2)
+    kb.maybe_compact()
+    assert kb.stats()["segments"] == 1
+    assert kb.delete_source("a.txt") == 3
+    assert live_sources(kb) == ["b.txt"]
+    assert kb.count == 3
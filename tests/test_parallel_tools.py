@@ -0,0 +1,70 @@
+import asyncio
+
+import pytest
+
+
+@pytest.fixture
+def make_executor(app_mod):
+    """假LLM按顺序给出回复，quote工具记录每次实际执行"""
+    from langchain.agents import create_react_agent
+    from langchain_core.language_models.fake import FakeListLLM
+    from langchain_core.prompts import PromptTemplate
+    from langchain_core.tools import tool
+
+    calls = []
+
+    @tool
+    async def quote(code: str) -> str:
+        """查询行情"""
+        calls.append(code)
+        await asyncio.sleep(0.05)
+        return f"{code}: 1500"
+
+    prompt = PromptTemplate.from_template("{tools}\n{tool_names}\n{input}\n{agent_scratchpad}")
+    parser_class, executor_class = app_mod.agent_classes()
+
+    def make(responses):
+        agent = create_react_agent(FakeListLLM(responses=responses), [quote], prompt, output_parser=parser_class())
+        return executor_class(agent=agent, tools=[quote], handle_parsing_errors=True, max_iterations=3)
+
+    return make, calls
+
+
+def two_quotes(code):
+    return (f"Thought: 需要行情\nAction: quote\nAction Input: {code}\n"
+            f"Action: quote\nAction Input: {code}")
+
+
+def test_identical_actions_in_one_step_run_once(app_mod, make_executor):
+    make, calls = make_executor
+    executor = make([two_quotes("600519"), "Thought: 好了\nFinal Answer: 1500"])
+
+    async def run():
+        app_mod.tool_run_memo.set({})
+        return await executor.ainvoke({"input": "茅台"})
+
+    assert asyncio.run(run())["output"] == "1500"
+    assert calls == ["600519"]
+
+
+def test_concurrent_runs_sharing_a_memo_deduplicate(app_mod, make_executor):
+    make, calls = make_executor
+    memo = {}
+
+    async def run_one(code):
+        app_mod.tool_run_memo.set(memo)
+        executor = make([two_quotes(code), "Thought: 好了\nFinal Answer: ok"])
+        return await executor.ainvoke({"input": code})
+
+    async def run():
+        return await asyncio.gather(run_one("600519"), run_one("600519"), run_one("000001"))
+
+    asyncio.run(run())
+    assert sorted(calls) == ["000001", "600519"]
+
+
+def test_without_memo_every_action_runs(app_mod, make_executor):
+    make, calls = make_executor
+    executor = make([two_quotes("600519"), "Thought: 好了\nFinal Answer: 1500"])
+    asyncio.run(executor.ainvoke({"input": "茅台"}))
+    assert calls == ["600519", "600519"]
@@ -0,0 +1,57 @@
+import numpy as np
+
+
+def t(app_mod, value):
+    return app_mod.parse_quote_time(value)
+
+
+def test_resample_ohlc_bucket_boundaries(app_mod):
+    """恰好落在区间边界上的快照属于新区间"""
+    times = np.array([t(app_mod, s) for s in [
+        "2024-01-02 09:30:00", "2024-01-02 09:31:00", "2024-01-02 09:34:59",
+        "2024-01-02 09:35:00", "2024-01-02 09:36:00", "2024-01-02 09:45:00"]], dtype=np.int64)
+    prices = np.array([10.0, 12.0, 9.0, 11.0, 13.0, 8.0])
+    volumes = np.array([1.0, 2.0, 3.0, 4.0, 5.0, 6.0])
+    bars = app_mod.resample_ohlc(times, prices, volumes, volumes * 10, 300)
+    assert app_mod.format_quote_times(bars["time"]) == [
+        "2024-01-02 09:30:00", "2024-01-02 09:35:00", "2024-01-02 09:45:00"]
+    assert bars["open"].tolist() == [10.0, 11.0, 8.0]
+    assert bars["high"].tolist() == [12.0, 13.0, 8.0]
+    assert bars["low"].tolist() == [9.0, 11.0, 8.0]
+    assert bars["close"].tolist() == [9.0, 13.0, 8.0]
+    assert bars["volume"].tolist() == [6.0, 9.0, 6.0]
+    assert bars["amount"].tolist() == [60.0, 90.0, 60.0]
+    assert bars["samples"].tolist() == [3, 2, 1]
+
+
+def test_resample_ohlc_empty(app_mod):
+    empty = np.zeros(0)
+    bars = app_mod.resample_ohlc(np.zeros(0, dtype=np.int64), empty, empty, empty, 60)
+    assert all(len(values) == 0 for values in bars.values())
+
+
+def test_interval_deltas_restart_across_days(app_mod):
+    times = np.array([t(app_mod, s) for s in [
+        "2024-01-02 14:59:00", "2024-01-02 15:00:00", "2024-01-03 09:30:00", "2024-01-03 09:31:00"]])
+    cumulative = np.array([100.0, 150.0, 20.0, 35.0])
+    assert app_mod.interval_deltas(cumulative, times).tolist() == [100.0, 50.0, 20.0, 15.0]
+    previous = (t(app_mod, "2024-01-02 14:58:00"), 90.0)
+    assert app_mod.interval_deltas(cumulative, times, previous).tolist() == [10.0, 50.0, 20.0, 15.0]
+
+
+def test_history_deltas_at_range_start(app_mod, tmp_path):
+    """从区间中间开始取K线时，第一个快照的增量相对于区间前一个快照计算"""
+    store = app_mod.QuoteStore(str(tmp_path))
+    for minute, (price, volume) in enumerate([(10.0, 100), (11.0, 130), (12.0, 170), (9.0, 220)]):
+        assert store.append("600000", {"t": f"2024-01-02 09:3{minute}:00", "p": price, "v": volume,
+                                       "cje": volume * 10})
+    assert not store.append("600000", {"t": "2024-01-02 09:33:00", "p": 9.5, "v": 230})
+    start = t(app_mod, "2024-01-02 09:32:00")
+    bars = store.history("600000", 120, start=start)
+    assert bars["volume"].tolist() == [90.0]
+    assert bars["open"].tolist() == [12.0] and bars["close"].tolist() == [9.0]
+    full = store.history("600000", 120)
+    assert full["volume"].tolist() == [130.0, 90.0]
+    limited = store.history("600000", 60, limit=2)
+    assert limited["close"].tolist() == [12.0, 9.0]
+    assert limited["volume"].tolist() == [40.0, 50.0]
@@ -0,0 +1,26 @@
+import os
+import subprocess
+import sys
+
+from conftest import APP_FILE, APP_MODULE
+
+IMPORT_CHECK = f"""
+import importlib.util, sys
+spec = importlib.util.spec_from_file_location({APP_MODULE!r}, {APP_FILE!r})
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+print("numpy" in sys.modules)
+"""
+
+
+def test_import_creates_no_files(tmp_path):
+    """导入模块不创建知识库目录、SQLite文件，也不导入numpy"""
+    kb_dir = tmp_path / "kb"
+    env = dict(os.environ, KB_DIR=str(kb_dir), WARMUP_ENABLED="false")
+    env.pop("QUOTE_STORE_DIR", None)
+    env.pop("PROFILE_DIR", None)
+    result = subprocess.run([sys.executable, "-c", IMPORT_CHECK], env=env, cwd=tmp_path,
+                            capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip().splitlines()[-1] == "False"
+    assert not kb_dir.exists()
@@ -0,0 +1,36 @@
+import pytest
+from fastapi.testclient import TestClient
+
+
+@pytest.fixture
+def client(app_mod, tmp_path, monkeypatch):
+    """临时构建目录：index.html和一个可压缩的哈希命名脚本"""
+    (tmp_path / "static" / "js").mkdir(parents=True)
+    (tmp_path / "index.html").write_text("<html>" + "<div></div>" * 200 + "</html>")
+    (tmp_path / "static" / "js" / "main.94f72dd6.js").write_text("console.log('x');\n" * 200)
+    static_bundle = app_mod.StaticBundle(str(tmp_path))
+    monkeypatch.setattr(app_mod, "get_static_bundle", lambda: static_bundle)
+    return TestClient(app_mod.app)
+
+
+def test_each_encoding_has_its_own_etag(client):
+    url = "/static/js/main.94f72dd6.js"
+    identity = client.get(url, headers={"Accept-Encoding": "identity"})
+    gzipped = client.get(url, headers={"Accept-Encoding": "gzip"})
+    assert gzipped.headers["content-encoding"] == "gzip"
+    assert gzipped.headers["vary"] == "Accept-Encoding"
+    assert identity.headers["etag"] != gzipped.headers["etag"]
+    assert gzipped.headers["etag"].endswith('-gz"')
+    # 用压缩版本的ETag请求未压缩版本不能得到304
+    revalidate = client.get(url, headers={"Accept-Encoding": "identity", "If-None-Match": gzipped.headers["etag"]})
+    assert revalidate.status_code == 200
+    revalidate = client.get(url, headers={"Accept-Encoding": "gzip", "If-None-Match": gzipped.headers["etag"]})
+    assert revalidate.status_code == 304
+
+
+def test_missing_asset_is_404_but_routes_fall_back(client):
+    assert client.get("/static/js/missing.js").status_code == 404
+    assert client.get("/favicon.ico").status_code == 404
+    route = client.get("/chat/history")
+    assert route.status_code == 200
+    assert route.text.startswith("<html>")
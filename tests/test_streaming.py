@@ -0,0 +1,70 @@
+import asyncio
+
+
+def collect(app_mod, q):
+    async def run():
+        return [chunk async for chunk in app_mod.coalesce_tokens(q)]
+    return run()
+
+
+def test_suppressed_reasoning_keeps_stream_alive(app_mod, monkeypatch):
+    """final模式下推理阶段超过空闲超时也不会结束响应"""
+    monkeypatch.setattr(app_mod, "STREAM_TOKEN_TIMEOUT", 0.2)
+    monkeypatch.setattr(app_mod, "STREAM_HEARTBEAT_INTERVAL", 0.05)
+
+    async def run():
+        q = asyncio.Queue(maxsize=16)
+        callback = app_mod.QueueCallback(q, final_only=True)
+
+        async def produce():
+            for _ in range(10):
+                await callback.on_llm_new_token("Thought: 查询行情 ")
+                await asyncio.sleep(0.06)
+            for token in ("Final Answer:", " 上涨", "1%"):
+                await callback.on_llm_new_token(token)
+            await q.put(None)
+
+        producer = asyncio.create_task(produce())
+        chunks = await collect(app_mod, q)
+        await producer
+        return chunks
+
+    assert "".join(asyncio.run(run())) == "上涨1%"
+
+
+def feed(app_mod, tokens, final_only=True):
+    """把token依次交给QueueCallback，返回转发到队列的非心跳内容"""
+    async def run():
+        q = asyncio.Queue()
+        callback = app_mod.QueueCallback(q, final_only=final_only)
+        await callback.on_llm_start({}, [])
+        for token in tokens:
+            await callback.on_llm_new_token(token)
+        items = []
+        while not q.empty():
+            items.append(q.get_nowait())
+        return [item for item in items if item], callback
+    return asyncio.run(run())
+
+
+def test_final_answer_marker_split_across_tokens(app_mod):
+    tokens = ["Thought: 我知道了\n", "Fin", "al Ans", "wer", ":", " 茅台", "收盘1700元"]
+    items, callback = feed(app_mod, tokens)
+    assert "".join(items) == "茅台收盘1700元"
+    assert callback.final_streamed
+
+
+def test_marker_and_answer_in_one_token(app_mod):
+    items, _ = feed(app_mod, ["Thought: ok\nFinal Answer: 上涨", "2%"])
+    assert items == ["上涨", "2%"]
+
+
+def test_no_marker_forwards_nothing_in_final_mode(app_mod):
+    items, callback = feed(app_mod, ["Action: mairui\n", "Action Input: 600519"])
+    assert items == []
+    assert not callback.final_streamed
+
+
+def test_raw_mode_forwards_every_token(app_mod):
+    items, _ = feed(app_mod, ["Thought", ": x"], final_only=False)
+    assert items == ["Thought", ": x"]
@@ -0,0 +1,49 @@
+import threading
+import time
+
+
+class CountingTavily:
+    """记录调用次数的Tavily桩，调用时等待以便并发请求重叠"""
+
+    def __init__(self, delay: float = 0.2):
+        self.delay = delay
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def search(self, query, max_results=3):
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.delay)
+        return {"query": query, "results": [{"title": query, "content": str(self.calls)}]}
+
+
+def test_concurrent_identical_searches_hit_upstream_once(app_mod, monkeypatch):
+    stub = CountingTavily()
+    monkeypatch.setattr(app_mod, "_tavily_client", stub)
+    monkeypatch.setattr(app_mod, "search_cache", app_mod.TTLCache(60, 16))
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(app_mod.cached_search("贵州茅台 最新消息")))
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert stub.calls == 1
+    assert len(results) == 8 and all(result is results[0] for result in results)
+    stats = app_mod.search_cache.stats()
+    assert stats["misses"] == 1 and stats["coalesced"] == 7
+
+
+def test_entry_is_reloaded_after_ttl(app_mod, monkeypatch):
+    stub = CountingTavily(delay=0)
+    monkeypatch.setattr(app_mod, "_tavily_client", stub)
+    monkeypatch.setattr(app_mod, "search_cache", app_mod.TTLCache(0.1, 16))
+    first = app_mod.cached_search("宁德时代")
+    assert app_mod.cached_search("宁德时代 ") is first
+    assert stub.calls == 1
+    time.sleep(0.15)
+    second = app_mod.cached_search("宁德时代")
+    assert stub.calls == 2
+    assert second is not first
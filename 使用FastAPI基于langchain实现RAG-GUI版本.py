@@ -1,28 +1,69 @@
-import uvicorn
-from fastapi import FastAPI, HTTPException, UploadFile, File
+from __future__ import annotations
+
+from fastapi import FastAPI, HTTPException, UploadFile, File, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, FileResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse, FileResponse, JSONResponse, Response
 from pydantic import BaseModel
 from typing import List, Optional
 # import gradio as gr  # 已移除Gradio依赖
-from langchain.callbacks.base import BaseCallbackHandler
-from langchain.callbacks.manager import CallbackManager
-from langchain.agents import create_react_agent, AgentExecutor
+# langchain.agents、langchain_ollama、tavily、requests、numpy较重，在首次使用（或启动预热）时才导入
+from langchain_core.callbacks import AsyncCallbackHandler
+from langchain_core.agents import AgentAction, AgentStep
 from langchain_core.tools import tool
 from langchain_core.prompts import PromptTemplate
 from typing import Any
-import queue
+from contextlib import asynccontextmanager, contextmanager
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import array
+import asyncio
+import codecs
+import contextvars
+import gzip
+import hashlib
+import html
+import io
+import mimetypes
+import multiprocessing
+import sqlite3
 import threading
-import requests
-from tavily import TavilyClient
+import time
+import unicodedata
+import uuid
+import re
+import shutil
 from datetime import datetime
 import json
+import math
 import os
 import subprocess
 import tempfile
+import urllib.parse
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """启动时在线程池创建知识库、任务表等全局对象，再启动后台任务；关闭时按相反顺序停止
+
+    这些对象会创建目录、打开SQLite文件、索引前端构建产物，不在导入模块时创建。
+    """
+    for create in (get_knowledge_base, get_embedding_cache, get_job_store, get_quote_store, get_static_bundle):
+        await run_in_threadpool(create)
+    await start_job_scheduler()
+    await start_kb_watcher()
+    await start_quote_poll()
+    await start_warm_up()
+    try:
+        yield
+    finally:
+        await stop_warm_up()
+        await stop_quote_poll()
+        await stop_kb_watcher()
+        await stop_job_scheduler()
+
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -37,72 +78,344 @@ app.add_middleware(
 # 请求模型
 class ChatRequest(BaseModel):
     message: str
+    # final: 只流式输出Final Answer部分; raw: 输出包括Thought/Action在内的全部token
+    stream_mode: str = 'final'
+
+class BatchChatRequest(BaseModel):
+    # 批量请求只返回Final Answer
+    messages: List[str]
 
 class DatabaseConfig(BaseModel):
     type: str
-    host: str
-    port: str
+    host: str = ''
+    port: str = ''
     database: str
-    username: str
-    password: str
+    username: str = ''
+    password: str = ''
+    # 要导入的表，为空时导入全部表
+    tables: Optional[List[str]] = None
+    # 增量同步依据的列，为空时优先使用updated_at，否则使用主键
+    watermark_column: Optional[str] = None
 
 class ModelScopeConfig(BaseModel):
     dataset_name: str
     subset_name: Optional[str] = None
     split: str = 'train'
     cache_dir: Optional[str] = None
+    # 要提取的文本字段，为空时使用所有字符串字段
+    text_fields: Optional[List[str]] = None
+    max_rows: Optional[int] = None
 
 
-# 为React前端创建流式响应函数
-def create_streaming_response(message: str):
-    """创建流式响应生成器"""
-    try:
-        agent_executor, q = create_agent()
-        
-        def run_agent():
-            try:
-                response = agent_executor.invoke({
-                    "input": message,
-                    "handle_parsing_errors": True
-                })
-                if response and "output" in response:
-                    output = response["output"]
-                    if "PARSING_ERROR" in output:
-                        q.put("抱歉，我理解有误。请使用更清晰的方式描述您的问题。")
-                    else:
-                        # 按字符分割输出以实现流式效果
-                        for char in output:
-                            q.put(char)
-                else:
-                    q.put("无法获取有效响应")
-            except Exception as e:
-                print(f"Agent error: {e}")
-                q.put("处理请求时发生错误，请稍后重试。")
-            finally:
-                q.put(None)  # 结束标记
-        
-        # 启动代理线程
-        thread = threading.Thread(target=run_agent)
-        thread.daemon = True
-        thread.start()
-        
-        # 生成流式响应
-        while True:
-            try:
-                token = q.get(timeout=30.0)
-                if token is None:
-                    break
-                yield token
-            except queue.Empty:
+# 流式响应配置
+STREAM_QUEUE_SIZE = int(os.getenv("STREAM_QUEUE_SIZE", "256"))
+STREAM_TOKEN_TIMEOUT = float(os.getenv("STREAM_TOKEN_TIMEOUT", "30"))
+STREAM_FLUSH_CHARS = int(os.getenv("STREAM_FLUSH_CHARS", "16"))
+STREAM_FLUSH_INTERVAL = float(os.getenv("STREAM_FLUSH_INTERVAL", "0.05"))
+# final模式下被过滤的推理token以空字符串心跳告知消费端，最短发送间隔（秒）
+STREAM_HEARTBEAT_INTERVAL = float(os.getenv("STREAM_HEARTBEAT_INTERVAL", "1"))
+# 单个聊天请求从开始生成到结束的最长时间
+CHAT_DEADLINE = float(os.getenv("CHAT_DEADLINE", "120"))
+
+
+def format_stream_chunk(text: str, sse: bool) -> str:
+    """按输出格式包装一段文本"""
+    if sse:
+        return f"data: {json.dumps({'text': text}, ensure_ascii=False)}\n\n"
+    return text
+
+
+async def coalesce_tokens(q: asyncio.Queue):
+    """合并队列中的token，累计到STREAM_FLUSH_CHARS个字符或等待STREAM_FLUSH_INTERVAL秒后输出一次
+
+    空字符串是心跳，只重置STREAM_TOKEN_TIMEOUT空闲计时，不输出内容。
+    """
+    loop = asyncio.get_running_loop()
+    buffer = []
+    buffered = 0
+    deadline = None
+    while True:
+        timeout = STREAM_TOKEN_TIMEOUT if deadline is None else max(0.0, deadline - loop.time())
+        try:
+            token = await asyncio.wait_for(q.get(), timeout=timeout)
+        except asyncio.TimeoutError:
+            if deadline is None:
                 print("Response timeout")
                 break
-            except Exception as e:
-                print(f"Stream error: {e}")
-                break
-                
+            token = ""  # 到达刷新时间
+        if token is None:
+            break
+        if token:
+            buffer.append(token)
+            buffered += len(token)
+            if deadline is None:
+                deadline = loop.time() + STREAM_FLUSH_INTERVAL
+        if buffer and (buffered >= STREAM_FLUSH_CHARS or loop.time() >= deadline):
+            yield "".join(buffer)
+            buffer = []
+            buffered = 0
+            deadline = None
+    if buffer:
+        yield "".join(buffer)
+
+
+# 为React前端创建流式响应函数
+async def create_streaming_response(message: str, stream_mode: str = 'final', sse: bool = False,
+                                    client: Optional[str] = None):
+    """创建流式响应生成器
+
+    Agent通过astream在事件循环上运行，token经有界asyncio.Queue传给响应，
+    队列满时生成端等待（背压），不再为每个请求占用线程。
+    命中回答缓存时直接回放，不经过准入控制；
+    否则指定client时先排队，SSE模式下排队位置以queue事件发送。
+    """
+    q = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+    callback = QueueCallback(q, final_only=(stream_mode == 'final'))
+    tracer = TracingCallback()
+    trace = {"outcome": "ok"}
+    cancel_event = threading.Event()
+    # 回答缓存只保存Final Answer，raw模式需要完整推理过程，不使用缓存
+    use_cache = stream_mode == 'final'
+
+    async def run_agent():
+        try:
+            output = None
+            tools_used = set()
+            tool_run_memo.set({})
+            run_cancel_event.set(cancel_event)
+            # 从池中借用预构建的Agent，本次请求的回调通过config传入
+            async with agent_pool.borrow() as agent_executor:
+                async for chunk in agent_executor.astream(
+                    {
+                        "input": message,
+                        "handle_parsing_errors": True
+                    },
+                    config={"callbacks": [callback, tracer]}
+                ):
+                    for action in chunk.get("actions", []):
+                        tools_used.add(action.tool)
+                    if "output" in chunk:
+                        output = chunk["output"]
+            tracer.finish()
+            if output is None:
+                trace["outcome"] = "no_output"
+                text = "无法获取有效响应"
+            elif "PARSING_ERROR" in output:
+                trace["outcome"] = "parse_error"
+                text = "抱歉，我理解有误。请使用更清晰的方式描述您的问题。"
+            else:
+                if use_cache:
+                    await run_in_threadpool(answer_cache.store, message, output, tools_used, vector)
+                # Final Answer已在生成过程中流式输出时不再重复发送
+                text = "" if callback.final_streamed else output
+        except asyncio.CancelledError:
+            # 超过CHAT_DEADLINE时由本函数自己结束响应，其余取消（客户端断开）直接传播
+            if trace["outcome"] != "deadline":
+                raise
+            text = "回答超时，请简化问题后重试。"
+        except AgentPoolTimeout:
+            print("Agent pool timeout")
+            trace["outcome"] = "pool_timeout"
+            text = "服务繁忙，请稍后重试。"
+        except Exception as e:
+            print(f"Agent error: {e}")
+            trace["outcome"] = "error"
+            text = "处理请求时发生错误，请稍后重试。"
+        if text:
+            await q.put(text)
+        await q.put(None)  # 结束标记
+
+    start = time.perf_counter()
+    first_byte = True
+    completed = False
+    ticket = None
+    task = None
+    deadline = None
+    vector = None
+
+    def cancel_agent(reason: str):
+        """停止Agent运行：取消任务（关闭到Ollama的流式连接），未开始的工具调用不再执行"""
+        if task is None or task.done():
+            return
+        trace["outcome"] = reason
+        cancel_event.set()
+        tracer.record_cancel(reason, time.perf_counter() - start)
+        task.cancel()
+
+    try:
+        cached = None
+        if use_cache:
+            cached, vector = await run_in_threadpool(answer_cache.lookup, message)
+        if cached is not None:
+            trace["outcome"] = "cache_hit"
+            CHAT_FIRST_BYTE.observe(time.perf_counter() - start)
+            # 命中时按流式输出的粒度回放
+            for i in range(0, len(cached), STREAM_FLUSH_CHARS):
+                yield format_stream_chunk(cached[i:i + STREAM_FLUSH_CHARS], sse)
+            completed = True
+        else:
+            if client is not None:
+                try:
+                    ticket = admission.enqueue(client)
+                    async for position in admission.wait(ticket):
+                        if sse:
+                            yield f"event: queue\ndata: {json.dumps({'position': position})}\n\n"
+                except (AdmissionRejected, asyncio.TimeoutError):
+                    trace["outcome"] = "rejected"
+                    completed = True
+                    yield format_stream_chunk("服务繁忙，请稍后重试。", sse)
+                    return
+            task = asyncio.create_task(run_agent())
+            deadline = asyncio.get_running_loop().call_later(CHAT_DEADLINE, cancel_agent, "deadline")
+            async for text in coalesce_tokens(q):
+                if first_byte:
+                    CHAT_FIRST_BYTE.observe(time.perf_counter() - start)
+                    first_byte = False
+                yield format_stream_chunk(text, sse)
+            completed = True
     except Exception as e:
         print(f"Streaming response error: {e}")
-        yield "处理消息时发生错误，请稍后重试。"
+        trace["outcome"] = "error"
+        completed = True
+        yield format_stream_chunk("处理消息时发生错误，请稍后重试。", sse)
+    finally:
+        if deadline is not None:
+            deadline.cancel()
+        # 客户端断开或等待token超时时停止Agent，避免继续占用模型和工具
+        cancel_agent("stream_timeout" if completed else "disconnect")
+        if ticket is not None:
+            admission.release(ticket)
+        if not completed and trace["outcome"] != "disconnect":
+            trace["outcome"] = "cancelled"
+        CHAT_REQUESTS.inc(outcome=trace["outcome"])
+        CHAT_DURATION.observe(time.perf_counter() - start)
+    if sse:
+        yield "event: done\ndata: {}\n\n"
+
+
+async def answer_batch_item(message: str, client: str, memo: dict) -> dict:
+    """批量请求中的一个问题：经准入控制后运行Agent，返回最终回答和用到的工具
+
+    client为batch_client()分组，同一批最多CHAT_BATCH_CONCURRENCY个问题同时排队。
+    """
+    start = time.perf_counter()
+    tracer = TracingCallback()
+    cancel_event = threading.Event()
+    result = {"outcome": "ok", "answer": "", "tools": []}
+    ticket = None
+
+    async def run_agent():
+        output = None
+        tool_run_memo.set(memo)
+        run_cancel_event.set(cancel_event)
+        async with agent_pool.borrow() as agent_executor:
+            async for chunk in agent_executor.astream(
+                {"input": message, "handle_parsing_errors": True},
+                config={"callbacks": [tracer]}
+            ):
+                result["tools"].extend(action.tool for action in chunk.get("actions", []))
+                if "output" in chunk:
+                    output = chunk["output"]
+        tracer.finish()
+        return output
+
+    try:
+        # 命中回答缓存的问题不占用生成槽位
+        cached, vector = await run_in_threadpool(answer_cache.lookup, message)
+        if cached is not None:
+            result.update(outcome="cache_hit", answer=cached)
+            return result
+        try:
+            ticket = admission.enqueue(client, CHAT_BATCH_CONCURRENCY)
+            async for _ in admission.wait(ticket):
+                pass
+        except (AdmissionRejected, asyncio.TimeoutError):
+            result.update(outcome="rejected", answer="服务繁忙，请稍后重试。")
+            return result
+        task = asyncio.create_task(run_agent())
+        try:
+            finished, _ = await asyncio.wait({task}, timeout=CHAT_DEADLINE)
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        if not finished:
+            cancel_event.set()
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            tracer.record_cancel("deadline", time.perf_counter() - start)
+            result.update(outcome="deadline", answer="回答超时，请简化问题后重试。")
+            return result
+        try:
+            output = task.result()
+        except AgentPoolTimeout:
+            print("Agent pool timeout")
+            result.update(outcome="pool_timeout", answer="服务繁忙，请稍后重试。")
+            return result
+        if output is None:
+            result.update(outcome="no_output", answer="无法获取有效响应")
+        elif "PARSING_ERROR" in output:
+            result.update(outcome="parse_error", answer="抱歉，我理解有误。请使用更清晰的方式描述您的问题。")
+        else:
+            result["answer"] = output
+            await run_in_threadpool(answer_cache.store, message, output, set(result["tools"]), vector)
+        return result
+    except asyncio.CancelledError:
+        # 客户端断开，停止尚未开始的工具调用
+        cancel_event.set()
+        tracer.record_cancel("disconnect", time.perf_counter() - start)
+        result["outcome"] = "disconnect"
+        raise
+    except Exception as e:
+        print(f"Batch agent error: {e}")
+        result.update(outcome="error", answer="处理请求时发生错误，请稍后重试。")
+        return result
+    finally:
+        if ticket is not None:
+            admission.release(ticket)
+        result["elapsed_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        CHAT_REQUESTS.inc(outcome=result["outcome"])
+        CHAT_DURATION.observe(time.perf_counter() - start)
+
+
+async def create_batch_response(messages: List[str], client: str):
+    """并发回答一组问题，按完成顺序逐行输出NDJSON
+
+    规范化后相同的问题只回答一次；所有问题共享一个工具备忘录，
+    多个问题用到的相同工具调用（例如同一代码的行情）只执行一次。
+    最后一行是汇总，tool_calls为各问题的工具调用总数，executed_tool_calls为实际执行的次数。
+    """
+    start = time.perf_counter()
+    memo = {}
+    groups = OrderedDict()
+    for index, message in enumerate(messages):
+        groups.setdefault(normalize_question(message), []).append(index)
+    pending = deque(groups.values())
+    done = asyncio.Queue()
+    tool_calls = 0
+
+    async def worker():
+        while pending:
+            indices = pending.popleft()
+            await done.put((indices, await answer_batch_item(messages[indices[0]], client, memo)))
+
+    workers = [asyncio.create_task(worker()) for _ in range(min(len(groups), CHAT_BATCH_CONCURRENCY))]
+    try:
+        for _ in range(len(groups)):
+            indices, result = await done.get()
+            tool_calls += len(result["tools"])
+            for index in indices:
+                yield json.dumps({"index": index, "message": messages[index], **result}, ensure_ascii=False) + "\n"
+        yield json.dumps({
+            "done": True,
+            "count": len(messages),
+            "unique": len(groups),
+            "tool_calls": tool_calls,
+            "executed_tool_calls": len(memo),
+            "elapsed_ms": round((time.perf_counter() - start) * 1000, 1),
+        }, ensure_ascii=False) + "\n"
+    finally:
+        for task in workers:
+            task.cancel()
 
 
 # API端点
@@ -113,43 +426,139 @@ async def root():
 
 @app.get("/health")
 async def health_check():
-    """健康检查端点"""
-    return {"status": "healthy", "service": "RAG Chat API"}
+    """健康检查端点，启动预热完成前返回503"""
+    if not startup_state["ready"]:
+        return JSONResponse(status_code=503, content={
+            "status": "starting",
+            "service": "RAG Chat API",
+            "stage": startup_state["stage"],
+            "error": startup_state["error"],
+        })
+    return {"status": "healthy", "service": "RAG Chat API", "startup_ms": startup_state.get("ready_ms")}
+
+@app.get("/api/agent-pool/stats")
+async def agent_pool_stats():
+    """Agent池占用与等待时间统计"""
+    return agent_pool.stats()
+
+@app.get("/api/embedding-cache/stats")
+async def embedding_cache_stats():
+    """向量缓存命中统计"""
+    return get_embedding_cache().stats()
+
+@app.get("/api/lexical-index/stats")
+async def lexical_index_stats():
+    """BM25倒排索引规模与查询耗时"""
+    return await run_in_threadpool(get_knowledge_base().lexical_stats)
+
+@app.get("/api/knowledge-base/stats")
+async def knowledge_base_stats():
+    """知识库版本、分段、删除和合并统计"""
+    return get_knowledge_base().stats()
+
+@app.get("/api/tool-cache/stats")
+async def tool_cache_stats():
+    """工具调用缓存命中统计"""
+    return {"mairui": quote_cache.stats(), "tavily_search": search_cache.stats(), "run_memo": dict(tool_memo_stats)}
+
+@app.get("/api/quote-store/stats")
+async def quote_store_stats():
+    """本地行情时间序列的股票数、行数和写入统计"""
+    return await run_in_threadpool(get_quote_store().stats)
+
+@app.get("/api/admission/stats")
+async def admission_stats():
+    """聊天准入控制：生成中和排队中的请求数"""
+    return admission.stats()
+
+@app.get("/api/answer-cache/stats")
+async def answer_cache_stats():
+    """回答缓存精确/语义命中统计"""
+    return answer_cache.stats()
+
+@app.get("/api/render-cache/stats")
+async def render_cache_stats():
+    """图表渲染缓存命中与节省字节统计"""
+    return render_cache.stats()
 
 @app.post("/api/chat")
-async def chat_endpoint(request: ChatRequest):
-    """处理聊天请求的API端点"""
+async def chat_endpoint(request: ChatRequest, http_request: Request):
+    """处理聊天请求的API端点，Accept为text/event-stream时以SSE格式输出"""
     if not request.message.strip():
         raise HTTPException(status_code=400, detail="消息不能为空")
+    if request.stream_mode not in ('final', 'raw'):
+        raise HTTPException(status_code=400, detail=f"不支持的流式模式: {request.stream_mode}")
     
+    sse = "text/event-stream" in http_request.headers.get("accept", "")
+    client = client_id(http_request)
+    # 等待队列已满时立即拒绝，而不是让请求排到超时
+    try:
+        admission.check(client)
+    except AdmissionRejected as e:
+        raise HTTPException(
+            status_code=429,
+            detail="服务繁忙，请稍后重试。",
+            headers={"Retry-After": str(e.retry_after)}
+        )
     return StreamingResponse(
-        create_streaming_response(request.message),
-        media_type="text/plain",
+        create_streaming_response(request.message, request.stream_mode, sse, client),
+        media_type="text/event-stream" if sse else "text/plain",
         headers={
             "Cache-Control": "no-cache",
             "Connection": "keep-alive",
         }
     )
 
+@app.post("/api/chat/batch")
+async def chat_batch_endpoint(request: BatchChatRequest, http_request: Request):
+    """批量聊天：并发回答多个问题，以NDJSON按完成顺序返回最终回答"""
+    messages = request.messages
+    if not messages:
+        raise HTTPException(status_code=400, detail="消息列表不能为空")
+    if len(messages) > CHAT_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"单次最多 {CHAT_BATCH_MAX} 个问题")
+    if any(not message.strip() for message in messages):
+        raise HTTPException(status_code=400, detail="消息不能为空")
+    client = batch_client(client_id(http_request))
+    try:
+        admission.check(client, CHAT_BATCH_CONCURRENCY)
+    except AdmissionRejected as e:
+        raise HTTPException(
+            status_code=429,
+            detail="服务繁忙，请稍后重试。",
+            headers={"Retry-After": str(e.retry_after)}
+        )
+    return StreamingResponse(
+        create_batch_response(messages, client),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache"}
+    )
+
 @app.post("/api/upload-documents")
-async def upload_documents(files: List[UploadFile] = File(...)):
-    """上传文档到知识库"""
+async def upload_documents(files: List[UploadFile] = File(...), priority: int = 10):
+    """上传文档到知识库
+
+    文件分块写入暂存目录后提交为后台任务，解析、分块和向量化在任务进程池中进行。
+    """
     try:
         uploaded_files = []
         for file in files:
-            # 这里可以添加文档处理逻辑
-            # 例如：解析文档内容，向量化，存储到向量数据库等
-            content = await file.read()
+            path, size = await spool_upload(file)
+            job_id = await get_job_scheduler().submit(
+                "upload", file.filename or "", {"path": path, "filename": file.filename or ""}, priority
+            )
             uploaded_files.append({
                 "filename": file.filename,
-                "size": len(content),
-                "type": file.content_type
+                "size": size,
+                "type": file.content_type,
+                "job_id": job_id
             })
             
         return {
             "success": True,
-            "message": f"成功上传 {len(files)} 个文档",
-            "files": uploaded_files
+            "message": f"成功上传 {len(files)} 个文档，正在后台导入知识库",
+            "files": uploaded_files,
+            "job_ids": [f["job_id"] for f in uploaded_files]
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"文档上传失败: {str(e)}")
@@ -158,54 +567,96 @@ async def upload_documents(files: List[UploadFile] = File(...)):
 async def test_db_connection(config: DatabaseConfig):
     """测试数据库连接"""
     try:
-        # 这里可以添加实际的数据库连接测试逻辑
-        # 根据不同的数据库类型使用相应的连接库
-        if config.type == "mysql":
-            # 模拟MySQL连接测试
-            pass
-        elif config.type == "postgresql":
-            # 模拟PostgreSQL连接测试
-            pass
-        elif config.type == "sqlite":
-            # 模拟SQLite连接测试
-            pass
-            
+        tables = await run_in_threadpool(check_db_connection, config)
         return {
             "success": True,
-            "message": "数据库连接测试成功"
+            "message": f"数据库连接测试成功，共 {len(tables)} 张表",
+            "tables": tables
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"数据库连接测试失败: {str(e)}")
 
 @app.post("/api/connect-database")
-async def connect_database(config: DatabaseConfig):
-    """连接数据库并导入数据到知识库"""
+async def connect_database(config: DatabaseConfig, priority: int = 0):
+    """连接数据库并在后台增量导入数据到知识库，立即返回任务ID"""
     try:
-        # 这里可以添加实际的数据库连接和数据导入逻辑
-        # 例如：连接数据库，查询数据，处理并存储到向量数据库
-        
+        await run_in_threadpool(check_db_connection, config)
+        payload = config.dict()
+        password = payload.pop("password")
+        job_id = await get_job_scheduler().submit("database", database_key(config), payload, priority, secret=password)
         return {
             "success": True,
-            "message": "数据库连接成功，数据已导入知识库",
-            "documentsCount": 100  # 模拟导入的文档数量
+            "message": "数据库连接成功，正在后台导入数据到知识库",
+            "job_id": job_id,
+            "documentsCount": 0
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"数据库连接失败: {str(e)}")
 
 @app.post("/api/clear-knowledge-base")
 async def clear_knowledge_base():
-    """清空知识库"""
+    """清空知识库
+
+    发布一个不含任何分段的新版本，正在进行的查询继续使用旧快照读完，旧分段过了保留期后删除。
+    """
     try:
-        # 这里可以添加清空知识库的逻辑
-        # 例如：删除向量数据库中的所有数据
-        
+        removed = await run_in_threadpool(get_knowledge_base().clear)
+        answer_cache.clear()
         return {
             "success": True,
-            "message": "知识库已清空"
+            "message": "知识库已清空",
+            "removedChunks": removed
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"清空知识库失败: {str(e)}")
 
+class DeleteDocumentsRequest(BaseModel):
+    source: str
+
+@app.post("/api/delete-documents")
+async def delete_documents(request: DeleteDocumentsRequest):
+    """按来源（上传的文件名、数据库表等）删除知识库中的文本块"""
+    try:
+        deleted = await run_in_threadpool(get_knowledge_base().delete_source, request.source)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"删除文档失败: {str(e)}")
+    if deleted == 0:
+        raise HTTPException(status_code=404, detail=f"知识库中没有来源为 {request.source} 的文档")
+    return {
+        "success": True,
+        "message": f"已删除 {deleted} 个文本块",
+        "deleted": deleted
+    }
+
+@app.post("/api/rebuild-knowledge-base")
+async def rebuild_knowledge_base(priority: int = 0):
+    """用当前向量化模型在后台重建知识库，完成后原子替换，期间查询继续使用旧索引"""
+    try:
+        job_id = await get_job_scheduler().submit("rebuild", EMBEDDING_MODEL, {}, priority)
+        return {
+            "success": True,
+            "message": "正在后台重建知识库",
+            "job_id": job_id
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"重建知识库失败: {str(e)}")
+
+@app.get("/api/quotes/{code}/history")
+async def quote_history(code: str, interval: str = "5m", start: Optional[str] = None, end: Optional[str] = None,
+                        limit: int = 0):
+    """按区间聚合本地记录的行情快照为K线，不请求上游；limit为返回的最多根数（0为上限QUOTE_HISTORY_MAX_BARS）"""
+    try:
+        seconds = parse_quote_interval(interval)
+        start_time = parse_quote_time(start) if start else None
+        end_time = parse_quote_time(end) if end else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"参数错误: {str(e)}")
+    limit = min(limit, QUOTE_HISTORY_MAX_BARS) if limit > 0 else QUOTE_HISTORY_MAX_BARS
+    bars = await run_in_threadpool(get_quote_store().history, code, seconds, start_time, end_time, limit)
+    if bars is None:
+        raise HTTPException(status_code=404, detail=f"本地没有 {code} 的行情记录")
+    return {"success": True, "code": code, "interval": interval, "bars": quote_bars_json(bars)}
+
 # MCP图表生成请求模型
 class MCPChartRequest(BaseModel):
     server_name: str
@@ -213,44 +664,32 @@ class MCPChartRequest(BaseModel):
     args: dict
 
 @app.post("/api/mcp/generate-line-chart")
-async def generate_line_chart(request: MCPChartRequest):
+async def generate_line_chart(request: MCPChartRequest, http_request: Request):
     """生成线图"""
     try:
-        # 调用MCP服务器生成图表
-        result = await call_mcp_server(
-            request.server_name,
-            request.tool_name,
-            request.args
-        )
-        return result
+        return await chart_response(request, http_request)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"生成线图失败: {str(e)}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"生成线图失败: {str(e)}")
 
 @app.post("/api/mcp/generate-column-chart")
-async def generate_column_chart(request: MCPChartRequest):
+async def generate_column_chart(request: MCPChartRequest, http_request: Request):
     """生成柱状图"""
     try:
-        # 调用MCP服务器生成图表
-        result = await call_mcp_server(
-            request.server_name,
-            request.tool_name,
-            request.args
-        )
-        return result
+        return await chart_response(request, http_request)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"生成柱状图失败: {str(e)}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"生成柱状图失败: {str(e)}")
 
 @app.post("/api/mcp/generate-bar-chart")
-async def generate_bar_chart(request: MCPChartRequest):
+async def generate_bar_chart(request: MCPChartRequest, http_request: Request):
     """生成条形图"""
     try:
-        # 调用MCP服务器生成图表
-        result = await call_mcp_server(
-            request.server_name,
-            request.tool_name,
-            request.args
-        )
-        return result
+        return await chart_response(request, http_request)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"生成条形图失败: {str(e)}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"生成条形图失败: {str(e)}")
 
@@ -278,162 +717,359 @@ async def call_mcp_server(server_name: str, tool_name: str, args: dict):
     try:
         # 这里需要实际调用MCP服务器
         # 由于MCP服务器通常通过命令行或特定协议调用，这里提供一个模拟实现
-        
-        # 模拟生成SVG图表内容
-        if tool_name == 'generate_line_chart':
-            svg_content = generate_mock_line_chart(args)
-        elif tool_name == 'generate_column_chart':
-            svg_content = generate_mock_column_chart(args)
-        elif tool_name == 'generate_bar_chart':
-            svg_content = generate_mock_bar_chart(args)
-        else:
-            raise ValueError(f"不支持的图表类型: {tool_name}")
-            
-        return svg_content
+        return (await run_in_threadpool(render_chart, tool_name, args))["svg"]
     except Exception as e:
         raise Exception(f"MCP服务器调用失败: {str(e)}")
 
+
+# 图表渲染缓存配置
+RENDER_CACHE_MAX_BYTES = int(os.getenv("RENDER_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+
+
+class RenderCache:
+    """按(tool_name, args)规范化哈希缓存图表渲染结果，按总字节数限制的LRU"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.render_bytes_saved = 0
+        self.transfer_bytes_saved = 0
+
+    @staticmethod
+    def key(tool_name: str, args: dict) -> str:
+        canonical = json.dumps([tool_name, args], sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=str)
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self.render_bytes_saved += len(entry["body"])
+            return entry
+
+    def peek_size(self, key: str) -> int:
+        with self._lock:
+            entry = self._entries.get(key)
+            return len(entry["body"]) if entry is not None else 0
+
+    def put(self, key: str, entry: dict):
+        size = len(entry["body"])
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old["body"])
+            self._entries[key] = entry
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted["body"])
+
+    def record_not_modified(self, size: int):
+        with self._lock:
+            self.not_modified += 1
+            self.transfer_bytes_saved += size
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "not_modified": self.not_modified,
+                "render_bytes_saved": self.render_bytes_saved,
+                "transfer_bytes_saved": self.transfer_bytes_saved,
+            }
+
+
+render_cache = RenderCache(RENDER_CACHE_MAX_BYTES)
+
+
+CHART_TOOL_NAMES = ('generate_line_chart', 'generate_column_chart', 'generate_bar_chart')
+
+
+def validate_chart_request(tool_name: str, args: dict):
+    """检查图表类型和参数，不合法时抛出ValueError"""
+    if tool_name not in CHART_TOOL_NAMES:
+        raise ValueError(f"不支持的图表类型: {tool_name}")
+    data = args.get('data', [])
+    if not isinstance(data, list) or not all(isinstance(item, dict) for item in data):
+        raise ValueError("data必须是对象数组")
+    for item in data:
+        try:
+            float(item.get('value', 0) or 0)
+        except (TypeError, ValueError):
+            raise ValueError(f"数据值不是数字: {item.get('value')!r}") from None
+    for name in ('width', 'height'):
+        value = args.get(name, 1)
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+            raise ValueError(f"{name}必须是正数")
+
+
+def chart_key(tool_name: str, args: dict) -> str:
+    """校验参数并计算缓存键，数据点多时耗时与渲染相当"""
+    validate_chart_request(tool_name, args)
+    return RenderCache.key(tool_name, args)
+
+
+def render_chart_entry(tool_name: str, args: dict, key: str) -> dict:
+    """渲染（参数已校验）并写入缓存，结果包含svg、JSON响应体和ETag"""
+    renderers = {
+        'generate_line_chart': generate_mock_line_chart,
+        'generate_column_chart': generate_mock_column_chart,
+        'generate_bar_chart': generate_mock_bar_chart,
+    }
+    svg = renderers[tool_name](args)
+    entry = {"svg": svg, "body": json.dumps(svg, ensure_ascii=False).encode('utf-8'), "etag": f'"{key}"'}
+    render_cache.put(key, entry)
+    return entry
+
+
+def render_chart(tool_name: str, args: dict) -> dict:
+    """渲染图表，命中缓存时直接返回"""
+    key = chart_key(tool_name, args)
+    return render_cache.get(key) or render_chart_entry(tool_name, args, key)
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match是否包含当前ETag"""
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates or f"W/{etag}" in candidates
+
+
+async def chart_response(request: MCPChartRequest, http_request: Request) -> Response:
+    """返回图表，客户端已有相同内容时返回304
+
+    ETag由请求参数决定，因此无需渲染即可判断是否未修改；
+    先校验参数，非法请求不会因携带ETag而得到304。
+    校验、哈希和渲染在线程池中执行，ETag比较和缓存查找留在事件循环上。
+    """
+    key = await run_in_threadpool(chart_key, request.tool_name, request.args)
+    etag = f'"{key}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(http_request.headers.get("if-none-match"), etag):
+        render_cache.record_not_modified(render_cache.peek_size(key))
+        return Response(status_code=304, headers=headers)
+    entry = render_cache.get(key)
+    if entry is None:
+        entry = await run_in_threadpool(render_chart_entry, request.tool_name, request.args, key)
+    return Response(content=entry["body"], media_type="application/json", headers=headers)
+
+# 图表渲染配置
+CHART_MARGIN = 50
+# 数据点不超过该数量时才绘制圆点
+CHART_MAX_MARKERS = 60
+# 每根柱子至少占用的像素
+CHART_MIN_BAR_PIXELS = 2
+CHART_MAX_LABELS = 30
+
+
+def chart_series(data: list):
+    """提取数值序列和分类标签"""
+    import numpy as np
+    values = np.fromiter((float(item.get('value', 0) or 0) for item in data), dtype=np.float64, count=len(data))
+    return values, [item.get('category', '') for item in data]
+
+
+def lttb_indices(values: np.ndarray, threshold: int) -> np.ndarray:
+    """Largest-Triangle-Three-Buckets降采样，返回保留点的下标（x取下标）"""
+    import numpy as np
+    n = len(values)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    # 首尾点固定，中间点均分为threshold - 2个桶
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    x = np.arange(n, dtype=np.float64)
+    prev = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], max(edges[i + 1], edges[i] + 1)
+        # 下一个桶的均值点（最后一个桶使用终点）
+        if i + 2 < len(edges):
+            next_start, next_end = edges[i + 1], max(edges[i + 2], edges[i + 1] + 1)
+            avg_x = x[next_start:next_end].mean()
+            avg_y = values[next_start:next_end].mean()
+        else:
+            avg_x, avg_y = x[-1], values[-1]
+        px, py = x[prev], values[prev]
+        areas = np.abs((px - avg_x) * (values[start:end] - py) - (px - x[start:end]) * (avg_y - py))
+        prev = start + int(np.argmax(areas))
+        selected[i + 1] = prev
+    return selected
+
+
+def bucket_means(values: np.ndarray, buckets: int):
+    """把序列均分为buckets段取均值，返回(均值, 每段起始下标)"""
+    import numpy as np
+    n = len(values)
+    if buckets >= n:
+        return values, np.arange(n)
+    starts = np.linspace(0, n, buckets + 1).astype(np.int64)[:-1]
+    sums = np.add.reduceat(values, starts)
+    counts = np.diff(np.append(starts, n))
+    return sums / counts, starts
+
+
+def write_chart_frame(buf: io.StringIO, width: int, height: int, title: str):
+    """写入背景、标题和坐标轴"""
+    buf.write(f'<svg width="{width}" height="{height}" xmlns="http://www.w3.org/2000/svg">')
+    buf.write('<rect width="100%" height="100%" fill="white" stroke="#ddd" stroke-width="1"/>')
+    buf.write(f'<text x="{width // 2}" y="30" text-anchor="middle" font-family="Arial" font-size="16" font-weight="bold">{html.escape(str(title))}</text>')
+    buf.write(f'<g transform="translate({CHART_MARGIN}, {CHART_MARGIN})">')
+    buf.write(f'<line x1="0" y1="0" x2="0" y2="{height - 100}" stroke="#333" stroke-width="2"/>')
+    buf.write(f'<line x1="0" y1="{height - 100}" x2="{width - 100}" y2="{height - 100}" stroke="#333" stroke-width="2"/>')
+
+
+def scale_values(values: np.ndarray, extent: float) -> np.ndarray:
+    """按最大值把数值映射到[0, extent]"""
+    max_value = float(values.max()) if len(values) else 0.0
+    return values / (max_value or 1.0) * extent
+
+
 def generate_mock_line_chart(args):
-    """生成模拟线图SVG"""
+    """生成模拟线图SVG，数据点多于绘图区像素宽度时用LTTB降采样"""
+    import numpy as np
     data = args.get('data', [])
     title = args.get('title', '线图')
     width = args.get('width', 500)
     height = args.get('height', 300)
-    
-    # 生成简单的SVG线图
-    svg = f'''<svg width="{width}" height="{height}" xmlns="http://www.w3.org/2000/svg">
-        <rect width="100%" height="100%" fill="white" stroke="#ddd" stroke-width="1"/>
-        <text x="{width//2}" y="30" text-anchor="middle" font-family="Arial" font-size="16" font-weight="bold">{title}</text>
-        <g transform="translate(50, 50)">
-            <line x1="0" y1="0" x2="0" y2="{height-100}" stroke="#333" stroke-width="2"/>
-            <line x1="0" y1="{height-100}" x2="{width-100}" y2="{height-100}" stroke="#333" stroke-width="2"/>
-    '''
-    
+    plot_width, plot_height = width - 100, height - 100
+
+    buf = io.StringIO()
+    write_chart_frame(buf, width, height, title)
     if data:
-        # 计算点的位置
-        max_value = max([item['value'] for item in data])
-        points = []
-        for i, item in enumerate(data):
-            x = (i / (len(data) - 1)) * (width - 100) if len(data) > 1 else (width - 100) / 2
-            y = (height - 100) - (item['value'] / max_value) * (height - 100)
-            points.append(f"{x},{y}")
-        
-        # 绘制线条
-        svg += f'<polyline points="{" ".join(points)}" fill="none" stroke="#4F46E5" stroke-width="3"/>'
-        
-        # 绘制点
-        for i, point in enumerate(points):
-            x, y = point.split(',')
-            svg += f'<circle cx="{x}" cy="{y}" r="4" fill="#4F46E5"/>'
-    
-    svg += '</g></svg>'
-    return svg
+        values, _ = chart_series(data)
+        n = len(values)
+        indices = lttb_indices(values, max(int(plot_width), 3))
+        xs = indices / (n - 1) * plot_width if n > 1 else np.full(len(indices), plot_width / 2)
+        ys = plot_height - scale_values(values, plot_height)[indices]
+        points = " ".join(f"{x:.2f},{y:.2f}" for x, y in zip(xs.tolist(), ys.tolist()))
+        buf.write(f'<polyline points="{points}" fill="none" stroke="#4F46E5" stroke-width="3"/>')
+        if len(indices) <= CHART_MAX_MARKERS:
+            for x, y in zip(xs.tolist(), ys.tolist()):
+                buf.write(f'<circle cx="{x:.2f}" cy="{y:.2f}" r="4" fill="#4F46E5"/>')
+    buf.write('</g></svg>')
+    return buf.getvalue()
+
 
 def generate_mock_column_chart(args):
-    """生成模拟柱状图SVG"""
+    """生成模拟柱状图SVG，柱子过密时按桶取均值合并"""
     data = args.get('data', [])
     title = args.get('title', '柱状图')
     width = args.get('width', 500)
     height = args.get('height', 300)
-    
-    svg = f'''<svg width="{width}" height="{height}" xmlns="http://www.w3.org/2000/svg">
-        <rect width="100%" height="100%" fill="white" stroke="#ddd" stroke-width="1"/>
-        <text x="{width//2}" y="30" text-anchor="middle" font-family="Arial" font-size="16" font-weight="bold">{title}</text>
-        <g transform="translate(50, 50)">
-            <line x1="0" y1="0" x2="0" y2="{height-100}" stroke="#333" stroke-width="2"/>
-            <line x1="0" y1="{height-100}" x2="{width-100}" y2="{height-100}" stroke="#333" stroke-width="2"/>
-    '''
-    
+    plot_width, plot_height = width - 100, height - 100
+
+    buf = io.StringIO()
+    write_chart_frame(buf, width, height, title)
     if data:
-        max_value = max([item['value'] for item in data])
-        bar_width = (width - 100) / len(data) * 0.8
-        
-        for i, item in enumerate(data):
-            x = i * (width - 100) / len(data) + (width - 100) / len(data) * 0.1
-            bar_height = (item['value'] / max_value) * (height - 100)
-            y = (height - 100) - bar_height
-            
-            svg += f'<rect x="{x}" y="{y}" width="{bar_width}" height="{bar_height}" fill="#10B981"/>'
-            svg += f'<text x="{x + bar_width/2}" y="{height-80}" text-anchor="middle" font-family="Arial" font-size="12">{item.get("category", "")})</text>'
-    
-    svg += '</g></svg>'
-    return svg
+        values, categories = chart_series(data)
+        values, starts = bucket_means(values, max(int(plot_width // CHART_MIN_BAR_PIXELS), 1))
+        count = len(values)
+        slot = plot_width / count
+        bar_width = slot * 0.8
+        bar_heights = scale_values(values, plot_height)
+        label_step = -(-count // CHART_MAX_LABELS)
+        for i, (bar_height, start) in enumerate(zip(bar_heights.tolist(), starts.tolist())):
+            x = i * slot + slot * 0.1
+            buf.write(f'<rect x="{x:.2f}" y="{plot_height - bar_height:.2f}" width="{bar_width:.2f}" height="{bar_height:.2f}" fill="#10B981"/>')
+            if i % label_step == 0:
+                buf.write(f'<text x="{x + bar_width / 2:.2f}" y="{height - 80}" text-anchor="middle" font-family="Arial" font-size="12">{html.escape(str(categories[start]))}</text>')
+    buf.write('</g></svg>')
+    return buf.getvalue()
+
 
 def generate_mock_bar_chart(args):
-    """生成模拟条形图SVG"""
+    """生成模拟条形图SVG，条形过密时按桶取均值合并"""
     data = args.get('data', [])
     title = args.get('title', '条形图')
     width = args.get('width', 500)
     height = args.get('height', 300)
-    
-    svg = f'''<svg width="{width}" height="{height}" xmlns="http://www.w3.org/2000/svg">
-        <rect width="100%" height="100%" fill="white" stroke="#ddd" stroke-width="1"/>
-        <text x="{width//2}" y="30" text-anchor="middle" font-family="Arial" font-size="16" font-weight="bold">{title}</text>
-        <g transform="translate(50, 50)">
-            <line x1="0" y1="0" x2="0" y2="{height-100}" stroke="#333" stroke-width="2"/>
-            <line x1="0" y1="{height-100}" x2="{width-100}" y2="{height-100}" stroke="#333" stroke-width="2"/>
-    '''
-    
+    plot_width, plot_height = width - 100, height - 100
+
+    buf = io.StringIO()
+    write_chart_frame(buf, width, height, title)
     if data:
-        max_value = max([item['value'] for item in data])
-        bar_height = (height - 100) / len(data) * 0.8
-        
-        for i, item in enumerate(data):
-            y = i * (height - 100) / len(data) + (height - 100) / len(data) * 0.1
-            bar_width = (item['value'] / max_value) * (width - 100)
-            
-            svg += f'<rect x="0" y="{y}" width="{bar_width}" height="{bar_height}" fill="#F59E0B"/>'
-            svg += f'<text x="-10" y="{y + bar_height/2 + 4}" text-anchor="end" font-family="Arial" font-size="12">{item.get("category", "")}</text>'
-    
-    svg += '</g></svg>'
-    return svg
+        values, categories = chart_series(data)
+        values, starts = bucket_means(values, max(int(plot_height // CHART_MIN_BAR_PIXELS), 1))
+        count = len(values)
+        slot = plot_height / count
+        bar_height = slot * 0.8
+        bar_widths = scale_values(values, plot_width)
+        label_step = -(-count // CHART_MAX_LABELS)
+        for i, (bar_width, start) in enumerate(zip(bar_widths.tolist(), starts.tolist())):
+            y = i * slot + slot * 0.1
+            buf.write(f'<rect x="0" y="{y:.2f}" width="{bar_width:.2f}" height="{bar_height:.2f}" fill="#F59E0B"/>')
+            if i % label_step == 0:
+                buf.write(f'<text x="-10" y="{y + bar_height / 2 + 4:.2f}" text-anchor="end" font-family="Arial" font-size="12">{html.escape(str(categories[start]))}</text>')
+    buf.write('</g></svg>')
+    return buf.getvalue()
 
 @app.post("/api/connect-modelscope")
-async def connect_modelscope(config: ModelScopeConfig):
-    """连接ModelScope数据集并导入到知识库"""
+async def connect_modelscope(config: ModelScopeConfig, priority: int = 0):
+    """连接ModelScope数据集并在后台导入到知识库，立即返回任务ID"""
     try:
-        # 导入ModelScope相关库
-        try:
-            from modelscope.msdatasets import MsDataset
-        except ImportError:
+        import importlib.util
+        if importlib.util.find_spec("modelscope") is None:
             raise HTTPException(status_code=500, detail="ModelScope库未安装，请先安装：pip install modelscope")
-        
-        # 加载数据集
-        dataset_params = {
-            'dataset_name': config.dataset_name,
-            'split': config.split
-        }
-        
-        if config.subset_name:
-            dataset_params['subset_name'] = config.subset_name
-        if config.cache_dir:
-            dataset_params['cache_dir'] = config.cache_dir
-            
-        # 加载数据集
-        ds = MsDataset.load(**dataset_params)
-        
-        # 获取数据集信息
-        dataset_info = {
-            "dataset_name": config.dataset_name,
-            "subset_name": config.subset_name,
-            "split": config.split,
-            "total_samples": len(ds) if hasattr(ds, '__len__') else "未知",
-            "features": list(ds.features.keys()) if hasattr(ds, 'features') else []
-        }
-        
-        # 这里可以添加数据集处理和向量化的逻辑
-        # 例如：提取文本内容，分块，向量化，存储到向量数据库
-        
+
+        job_id = await get_job_scheduler().submit("modelscope", config.dataset_name, config.dict(), priority)
+
         return {
             "success": True,
-            "message": f"成功连接ModelScope数据集: {config.dataset_name}",
-            "dataset_info": dataset_info,
-            "documentsCount": len(ds) if hasattr(ds, '__len__') else 0
+            "message": f"已开始导入ModelScope数据集: {config.dataset_name}",
+            "job_id": job_id,
+            "documentsCount": 0
         }
-        
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"连接ModelScope数据集失败: {str(e)}")
 
+@app.get("/api/modelscope/jobs/{job_id}")
+async def get_modelscope_job(job_id: str):
+    """查询ModelScope导入任务进度"""
+    return await get_job(job_id)
+
+@app.get("/api/jobs")
+async def list_jobs(status: Optional[str] = None, limit: int = 50):
+    """列出知识库导入任务"""
+    return {"success": True, "jobs": await run_in_threadpool(get_job_store().list, status, limit)}
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    """查询任务状态与进度"""
+    job = await run_in_threadpool(get_job_store().get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return job
+
+@app.post("/api/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str):
+    """取消任务，运行中的任务在下一个批次边界停止"""
+    status = await get_job_scheduler().cancel(job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return {"success": True, "job_id": job_id, "status": status}
+
 @app.get("/api/modelscope/datasets")
 async def get_popular_datasets():
     """获取热门ModelScope数据集列表"""
@@ -474,97 +1110,3223 @@ async def get_popular_datasets():
         raise HTTPException(status_code=500, detail=f"获取数据集列表失败: {str(e)}")
 
 
-# 定义工具
-@tool("tavily_search")
-def tavily_search(query: str) -> dict:
-    """使用Tavily搜索引擎搜索信息.
-    query: 搜索查询词
-    """
-    client = TavilyClient(api_key="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")
-    return client.search(query, max_results=3)
+# 知识库配置
+KB_DIR = os.getenv("KB_DIR", "knowledge_base")
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "bge-m3")
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "32"))
+CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "500"))
+CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "50"))
+KB_TOP_K = int(os.getenv("KB_TOP_K", "4"))
+KB_ANN_MIN_SIZE = int(os.getenv("KB_ANN_MIN_SIZE", "50000"))
+KB_ANN_NPROBE = int(os.getenv("KB_ANN_NPROBE", "8"))
+KB_SCAN_BLOCK = 65536
+EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "20000"))
+# 混合检索时向量检索和BM25检索各取的候选数，按倒数排名融合(RRF)
+KB_HYBRID_CANDIDATES = int(os.getenv("KB_HYBRID_CANDIDATES", "20"))
+KB_RRF_K = 60
+BM25_K1 = 1.2
+BM25_B = 0.75
+# 导入时每积累这么多文本块提交一个知识库分段
+KB_SEGMENT_ROWS = int(os.getenv("KB_SEGMENT_ROWS", "1024"))
+# 同一层级的分段达到该数量时合并为一个
+KB_MERGE_FACTOR = int(os.getenv("KB_MERGE_FACTOR", "8"))
+# 已删除行超过该比例的分段单独重写
+KB_COMPACT_DELETED_RATIO = float(os.getenv("KB_COMPACT_DELETED_RATIO", "0.3"))
+KB_REFRESH_INTERVAL = float(os.getenv("KB_REFRESH_INTERVAL", "0.5"))
+KB_COMPACT_INTERVAL = float(os.getenv("KB_COMPACT_INTERVAL", "60"))
+# 被替换的分段保留这么多秒再删除，让仍在使用旧快照的查询读完
+KB_RETIRE_GRACE = float(os.getenv("KB_RETIRE_GRACE", "60"))
+# 中断的写入留下的临时目录超过该秒数后清理
+KB_ORPHAN_TTL = 24 * 3600
+# 中文按相邻两字切分，数字（如股票代码600519）和英文单词整体作为一个词
+LEXICAL_TOKEN_PATTERN = re.compile(r"[0-9]+(?:\.[0-9]+)?|[a-z]+|[\u3400-\u9fff]+")
+SPOOL_CHUNK_SIZE = 1024 * 1024
+TEXT_READ_SIZE = 64 * 1024
+TEXT_EXTENSIONS = ('.txt', '.md', '.markdown')
+# 分块时优先在这些字符后断开
+SENTENCE_ENDINGS = "。！？；\n.!?;"
 
 
-@tool("mairui")
-def mairui_api(code: str) -> dict:
-    """查询股票实时行情.
-    code: 股票代码(如000001)
-    字段说明：
-    fm: 五分钟涨跌幅（%）
-    h: 最高价（元）
-    hs: 换手（%）
-    lb: 量比（%）
-    l: 最低价（元）
-    lt: 流通市值（元）
-    o: 开盘价（元）
-    pe: 市盈率
-    pc: 涨跌幅（%）
-    p: 当前价格（元）
-    sz: 总市值（元）
-    cje: 成交额（元）
-    ud: 涨跌额（元）
-    v: 成交量（手）
-    yc: 昨日收盘价（元）
-    zf: 振幅（%）
-    zs: 涨速（%）
-    """
-    api_key = "00F373EB-1FC8-4F31-A34C-F496BA4B87C2"
-    url = f"http://api.mairui.club/hsrl/ssjy/{code}/{api_key}"
-    try:
-        response = requests.get(url)
-        result = response.json()
+def lexical_tokens(text: str) -> List[str]:
+    """切分用于BM25的词：中文相邻两字一组，数字和英文单词整体保留"""
+    tokens = []
+    for match in LEXICAL_TOKEN_PATTERN.finditer(unicodedata.normalize("NFKC", text).lower()):
+        word = match.group()
+        if len(word) > 1 and word[0] >= "\u3400":
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+        else:
+            tokens.append(word)
+    return tokens
 
-        if not isinstance(result, dict):
-            return {"error": "API返回格式错误"}
 
-        if result.get('msg') == 'ok' and result.get('data'):
-            data = result['data']
-            return {
-                "股票名称": data.get('name', '未知'),
-                "当前价格": f"{data.get('p', 0)}元",
-                "涨跌幅": f"{data.get('pc', 0)}%",
-                "涨跌额": f"{data.get('ud', 0)}元",
-                "成交量": f"{data.get('v', 0)}手",
-                "成交额": f"{data.get('cje', 0)}元",
-                "振幅": f"{data.get('zf', 0)}%",
-                "最高": f"{data.get('h', 0)}元",
-                "最低": f"{data.get('l', 0)}元",
-                "今开": f"{data.get('o', 0)}元",
-                "昨收": f"{data.get('yc', 0)}元",
-                "量比": f"{data.get('lb', 0)}",
-                "换手率": f"{data.get('hs', 0)}%",
-                "市盈率": data.get('pe', 0),
-                "总市值": f"{data.get('sz', 0)}元",
-                "流通市值": f"{data.get('lt', 0)}元",
-                "涨速": f"{data.get('zs', 0)}%",
-                "60日涨跌幅": f"{data.get('zdf60', 0)}%",
-                "年初至今涨跌幅": f"{data.get('zdfnc', 0)}%",
-                "更新时间": data.get('t', datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
-            }
-        return {"error": "获取数据失败，API返回错误"}
+def query_term_weights(query: str) -> dict:
+    """查询中各词出现的次数，作为该词的权重"""
+    weights = {}
+    for token in lexical_tokens(query):
+        weights[token] = weights.get(token, 0) + 1
+    return weights
 
-    except requests.RequestException as e:
-        return {"error": f"网络请求失败: {str(e)}"}
-    except json.JSONDecodeError as e:
-        return {"error": f"数据解析失败: {str(e)}"}
-    except Exception as e:
-        return {"error": f"未知错误: {str(e)}"}
 
+def bm25_scores(weight: float, tf: np.ndarray, doc_lens: np.ndarray, avg_len: float) -> np.ndarray:
+    """一个词在若干文档中的BM25得分，weight为查询词权重与idf之积"""
+    import numpy as np
+    tf = tf.astype(np.float32)
+    norm = BM25_K1 * (1 - BM25_B + BM25_B * doc_lens / avg_len)
+    return (weight * (BM25_K1 + 1) * tf / (tf + norm)).astype(np.float32)
 
-class QueueCallback(BaseCallbackHandler):
-    """自定义回调处理器"""
 
-    def __init__(self, q: queue.Queue):
-        self.q = q
+class LexicalIndex:
+    """内存中的BM25倒排索引
 
-    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
-        self.q.put(token)
+    每个词的倒排表是两个紧凑数组（文档id为uint32、词频为uint16），文档长度同样按数组存放，
+    查询时直接以numpy视图读取，不为每个文档创建Python对象。文档按id顺序增量追加，
+    写完的索引保存为lexical.npz，每个知识库分段一份。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self.postings = {}
+        self.doc_lens = array.array('I')
+        self.total_len = 0
+
+    @property
+    def count(self) -> int:
+        return len(self.doc_lens)
+
+    def doc_freq(self, term: str) -> int:
+        entry = self.postings.get(term)
+        return len(entry[0]) if entry is not None else 0
+
+    def add(self, texts: List[str]):
+        """追加一批文档，id依次为当前文档数、当前文档数+1..."""
+        with self._lock:
+            for text in texts:
+                doc_id = len(self.doc_lens)
+                tokens = lexical_tokens(text)
+                freqs = {}
+                for token in tokens:
+                    freqs[token] = freqs.get(token, 0) + 1
+                for term, freq in freqs.items():
+                    entry = self.postings.get(term)
+                    if entry is None:
+                        entry = self.postings[term] = (array.array('I'), array.array('H'))
+                    entry[0].append(doc_id)
+                    entry[1].append(min(freq, 65535))
+                self.doc_lens.append(len(tokens))
+                self.total_len += len(tokens)
+
+    def search(self, query: str, k: int = KB_TOP_K, collection: Optional[tuple] = None,
+               deleted: Optional[np.ndarray] = None):
+        """返回BM25得分最高的k个(id数组, 得分数组)
+
+        collection为(文档数, 平均长度, {词: 文档频率})时按整个知识库的统计量打分，使各分段的得分可以比较；
+        deleted为已删除文档的布尔掩码。
+        """
+        import numpy as np
+        query_terms = query_term_weights(query)
+        with self._lock:
+            count = len(self.doc_lens)
+            entries = [(term, self.postings[term], weight) for term, weight in query_terms.items() if term in self.postings]
+            if count and entries:
+                ids, scores = self._score(entries, count, k, collection or (count, self.total_len / count, None), deleted)
+        if not count or not entries:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        return top_k(ids, scores, k)
+
+    def _score(self, entries, count: int, k: int, collection: tuple, deleted: Optional[np.ndarray]):
+        """累加各查询词的BM25得分，返回未删除的候选(id数组, 得分数组)（持有锁时调用，返回的数组不引用倒排表内存）
+
+        涉及的倒排项远少于文档数时只合并这些项；否则累加到按文档id索引的稠密数组后直接取前k，
+        避免对长倒排表排序去重。
+        """
+        import numpy as np
+        total_docs, avg_len, doc_freqs = collection
+        doc_lens = np.frombuffer(self.doc_lens, dtype=np.uint32)
+        dense = sum(len(doc_ids) for _, (doc_ids, _), _ in entries) * 8 >= count
+        totals = np.zeros(count, dtype=np.float32) if dense else None
+        id_parts, score_parts = [], []
+        for term, (doc_ids, freqs), weight in entries:
+            postings = np.frombuffer(doc_ids, dtype=np.uint32)
+            df = doc_freqs[term] if doc_freqs else len(postings)
+            idf = math.log(1 + (total_docs - df + 0.5) / (df + 0.5))
+            scores = bm25_scores(weight * idf, np.frombuffer(freqs, dtype=np.uint16), doc_lens[postings], avg_len)
+            if dense:
+                # 同一倒排表中文档id不重复，可以直接按下标累加
+                totals[postings] += scores
+            else:
+                id_parts.append(postings.astype(np.int64))
+                score_parts.append(scores)
+        if dense:
+            if deleted is not None:
+                totals[deleted] = 0
+            ids = np.argpartition(-totals, k)[:k] if count > k else np.arange(count)
+            ids = ids[totals[ids] > 0]
+            return ids, totals[ids]
+        ids, inverse = np.unique(np.concatenate(id_parts), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(score_parts)).astype(np.float32)
+        if deleted is not None:
+            keep = ~deleted[ids]
+            ids, scores = ids[keep], scores[keep]
+        return ids, scores
+
+    def save(self):
+        """把当前索引写成快照（先写临时文件再替换）"""
+        import numpy as np
+        with self._lock:
+            terms = list(self.postings)
+            lengths = np.fromiter((len(self.postings[term][0]) for term in terms), dtype=np.int64, count=len(terms))
+            snapshot = {
+                "terms": np.frombuffer("\n".join(terms).encode('utf-8'), dtype=np.uint8),
+                "offsets": np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64),
+                "doc_ids": np.frombuffer(b"".join(self.postings[term][0].tobytes() for term in terms), dtype=np.uint32),
+                "freqs": np.frombuffer(b"".join(self.postings[term][1].tobytes() for term in terms), dtype=np.uint16),
+                "doc_lens": np.array(self.doc_lens, dtype=np.uint32),
+            }
+        tmp_path = self.path + ".tmp.npz"
+        np.savez(tmp_path, **snapshot)
+        os.replace(tmp_path, self.path)
+
+    def load(self):
+        """加载save写出的索引文件"""
+        import numpy as np
+        with np.load(self.path) as data:
+            snapshot = {name: data[name] for name in data.files}
+        doc_lens = snapshot["doc_lens"]
+        terms = snapshot["terms"].tobytes().decode('utf-8').split("\n") if len(snapshot["terms"]) else []
+        offsets, doc_ids, freqs = snapshot["offsets"], snapshot["doc_ids"], snapshot["freqs"]
+        postings = {}
+        for i, term in enumerate(terms):
+            start, end = offsets[i], offsets[i + 1]
+            postings[term] = (array.array('I', doc_ids[start:end].tobytes()), array.array('H', freqs[start:end].tobytes()))
+        with self._lock:
+            self.postings = postings
+            self.doc_lens = array.array('I', doc_lens.tobytes())
+            self.total_len = int(doc_lens.sum())
+
+    def stats(self) -> dict:
+        with self._lock:
+            docs, terms = len(self.doc_lens), len(self.postings)
+            postings = sum(len(doc_ids) for doc_ids, _ in self.postings.values())
+            total_len = self.total_len
+        return {
+            "docs": docs,
+            "terms": terms,
+            "postings": postings,
+            "total_len": total_len,
+            "avg_doc_len": round(total_len / docs, 1) if docs else 0,
+        }
+
+
+class FileLock:
+    """跨进程互斥的文件锁"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._thread_lock = threading.Lock()
+        self._file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def acquire(self, blocking: bool = True) -> bool:
+        """获取锁；blocking为False且锁被占用时立即返回False"""
+        if not self._thread_lock.acquire(blocking):
+            return False
+        file = open(self.path, 'a+b')
+        try:
+            if os.name == 'nt':
+                import msvcrt
+                file.seek(0)
+                msvcrt.locking(file.fileno(), msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(file.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except OSError:
+            file.close()
+            self._thread_lock.release()
+            if blocking:
+                raise
+            return False
+        self._file = file
+        return True
+
+    def release(self):
+        try:
+            if os.name == 'nt':
+                import msvcrt
+                self._file.seek(0)
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        finally:
+            self._file.close()
+            self._file = None
+            self._thread_lock.release()
+
+
+def file_stamp(path: str):
+    """文件的(修改时间, 大小)，不存在时为None"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def normalize_vectors(vectors: np.ndarray) -> np.ndarray:
+    """按行归一化，使内积等于余弦相似度"""
+    import numpy as np
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return (vectors / np.maximum(norms, 1e-12)).astype(np.float32)
+
+
+def top_k(ids: np.ndarray, scores: np.ndarray, k: int):
+    """返回得分最高的k个(id, 分数)，按分数降序"""
+    import numpy as np
+    if len(scores) > k:
+        idx = np.argpartition(-scores, k)[:k]
+        ids, scores = ids[idx], scores[idx]
+    order = np.argsort(-scores)
+    return ids[order], scores[order]
+
+
+class KBSegment:
+    """知识库中一个不可变的分段
+
+    目录中包含已归一化的float32向量vectors.f32、逐行元数据meta.jsonl及其偏移meta.idx、
+    BM25倒排索引lexical.npz和各来源的行数sources.json，行数达到KB_ANN_MIN_SIZE时还有IVF索引ivf.npz。
+    分段写完后只读，删除记录在清单引用的墓碑文件中，合并时才物理移除。
+    """
+
+    def __init__(self, path: str, rows: int, dim: int):
+        import numpy as np
+        self.path = path
+        self.name = os.path.basename(path)
+        self.rows = rows
+        self.dim = dim
+        self.meta_path = os.path.join(path, "meta.jsonl")
+        self.vectors = np.memmap(os.path.join(path, "vectors.f32"), dtype=np.float32, mode='r', shape=(rows, dim))
+        self.offsets = np.fromfile(os.path.join(path, "meta.idx"), dtype=np.uint64, count=rows)
+        self.ann = None
+        ann_path = os.path.join(path, "ivf.npz")
+        if os.path.exists(ann_path):
+            with np.load(ann_path) as data:
+                self.ann = {name: data[name] for name in data.files}
+        self._lexical = None
+        self._lexical_lock = threading.Lock()
+
+    def get_metadata(self, local_id: int) -> dict:
+        """按行号随机读取一条元数据"""
+        with open(self.meta_path, 'rb') as f:
+            f.seek(int(self.offsets[local_id]))
+            return json.loads(f.readline())
+
+    def iter_metadata(self):
+        """按行号顺序读取全部元数据"""
+        with open(self.meta_path, 'rb') as f:
+            for _ in range(self.rows):
+                yield json.loads(f.readline())
+
+    def sources(self) -> dict:
+        """各来源的行数"""
+        with open(os.path.join(self.path, "sources.json"), 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def lexical(self) -> "LexicalIndex":
+        """BM25倒排索引，首次使用时加载"""
+        with self._lexical_lock:
+            if self._lexical is None:
+                index = LexicalIndex(os.path.join(self.path, "lexical.npz"))
+                index.load()
+                self._lexical = index
+            return self._lexical
+
+    def search(self, query: np.ndarray, k: int, deleted: Optional[np.ndarray] = None):
+        """返回分段内与查询向量最相似的k个(行号数组, 相似度数组)，跳过已删除的行"""
+        import numpy as np
+        if self.ann is not None:
+            ids, scores = self._search_ann(query, k, deleted)
+        else:
+            ids, scores = self._scan(query, k, deleted)
+        keep = np.isfinite(scores)
+        return ids[keep], scores[keep]
+
+    def _scan(self, query: np.ndarray, k: int, deleted: Optional[np.ndarray]):
+        """分块暴力扫描"""
+        import numpy as np
+        best_ids = np.empty(0, dtype=np.int64)
+        best_scores = np.empty(0, dtype=np.float32)
+        for block_start in range(0, self.rows, KB_SCAN_BLOCK):
+            block_end = min(block_start + KB_SCAN_BLOCK, self.rows)
+            scores = self.vectors[block_start:block_end] @ query
+            if deleted is not None:
+                scores[deleted[block_start:block_end]] = -np.inf
+            ids, scores = top_k(np.arange(block_start, block_end), scores, k)
+            best_ids, best_scores = top_k(
+                np.concatenate([best_ids, ids]), np.concatenate([best_scores, scores]), k
+            )
+        return best_ids, best_scores
+
+    def _search_ann(self, query: np.ndarray, k: int, deleted: Optional[np.ndarray]):
+        """只扫描与查询最接近的KB_ANN_NPROBE个簇"""
+        import numpy as np
+        centroids, lists, offsets = self.ann["centroids"], self.ann["ids"], self.ann["offsets"]
+        nprobe = min(KB_ANN_NPROBE, len(centroids))
+        probe, _ = top_k(np.arange(len(centroids)), centroids @ query, nprobe)
+        candidates = np.sort(np.concatenate([lists[offsets[c]:offsets[c + 1]] for c in probe]))
+        if deleted is not None:
+            candidates = candidates[~deleted[candidates]]
+        return top_k(candidates, self.vectors[candidates] @ query, k)
+
+
+def build_ivf(matrix: np.ndarray, iterations: int = 10) -> dict:
+    """对矩阵中的全部向量训练IVF索引（抽样k-means + 分块分配）"""
+    import numpy as np
+    count = len(matrix)
+    nlist = max(1, int(np.sqrt(count)))
+    rng = np.random.default_rng(0)
+    sample_size = min(count, max(nlist * 64, 10000), 100000)
+    sample = np.asarray(matrix[np.sort(rng.choice(count, sample_size, replace=False))])
+    centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assign = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, sample)
+        filled = np.bincount(assign, minlength=nlist) > 0
+        centroids[filled] = normalize_vectors(sums[filled])
+
+    assign = np.empty(count, dtype=np.int64)
+    for block_start in range(0, count, KB_SCAN_BLOCK):
+        block_end = min(block_start + KB_SCAN_BLOCK, count)
+        assign[block_start:block_end] = np.argmax(matrix[block_start:block_end] @ centroids.T, axis=1)
+    ids = np.argsort(assign, kind='stable').astype(np.int64)
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=nlist))]).astype(np.int64)
+    print(f"IVF index built: {count} vectors, {nlist} lists")
+    return {"centroids": centroids, "ids": ids, "offsets": offsets}
+
+
+class SegmentWriter:
+    """在临时目录中逐批写入一个新分段，由KnowledgeBase在文件锁内改名并加入清单"""
+
+    def __init__(self, segments_dir: str, dim: int):
+        self.name = f"seg-{time.time_ns():x}-{uuid.uuid4().hex[:6]}"
+        self.segments_dir = segments_dir
+        self.tmp_path = os.path.join(segments_dir, ".tmp-" + self.name)
+        os.makedirs(self.tmp_path)
+        self.dim = dim
+        self.rows = 0
+        self.entry = None
+        self._vectors = open(os.path.join(self.tmp_path, "vectors.f32"), 'wb')
+        self._meta = open(os.path.join(self.tmp_path, "meta.jsonl"), 'wb')
+        self._offsets = open(os.path.join(self.tmp_path, "meta.idx"), 'wb')
+        self._offset = 0
+        self._lexical = LexicalIndex(os.path.join(self.tmp_path, "lexical.npz"))
+        self._sources = {}
+
+    def append(self, vectors: np.ndarray, metadatas: List[dict]):
+        """追加一批已归一化的向量及其元数据"""
+        import numpy as np
+        self._vectors.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+        offsets = []
+        for meta in metadatas:
+            line = (json.dumps(meta, ensure_ascii=False) + "\n").encode('utf-8')
+            self._meta.write(line)
+            offsets.append(self._offset)
+            self._offset += len(line)
+            source = meta.get("source", "")
+            self._sources[source] = self._sources.get(source, 0) + 1
+        self._offsets.write(np.asarray(offsets, dtype=np.uint64).tobytes())
+        self._lexical.add([meta["text"] for meta in metadatas])
+        self.rows += len(metadatas)
+
+    def finish(self) -> dict:
+        """关闭数据文件并写入索引，返回清单条目"""
+        import numpy as np
+        self._close()
+        self._lexical.save()
+        with open(os.path.join(self.tmp_path, "sources.json"), 'w', encoding='utf-8') as f:
+            json.dump(self._sources, f, ensure_ascii=False)
+        if self.rows >= KB_ANN_MIN_SIZE:
+            matrix = np.memmap(os.path.join(self.tmp_path, "vectors.f32"), dtype=np.float32, mode='r',
+                               shape=(self.rows, self.dim))
+            np.savez(os.path.join(self.tmp_path, "ivf.npz"), **build_ivf(matrix))
+            del matrix
+        self.entry = {"name": self.name, "rows": self.rows, "tombstones": None, "deleted": 0}
+        return self.entry
+
+    def install(self):
+        """把临时目录改为正式分段目录（在清单文件锁内调用）"""
+        os.rename(self.tmp_path, os.path.join(self.segments_dir, self.name))
+
+    def abort(self):
+        self._close()
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+    def _close(self):
+        for f in (self._vectors, self._meta, self._offsets):
+            f.close()
+
+
+class KBSnapshot:
+    """某个清单版本的只读视图，发布后不再修改，查询期间不受写入、合并和清空的影响
+
+    全局id为分段在清单中的起始行号加分段内行号，只在同一个快照内有效。
+    """
+
+    def __init__(self, manifest: dict, segments: list):
+        import numpy as np
+        self.version = manifest["version"]
+        self.data_version = manifest["data_version"]
+        self.dim = manifest["dim"]
+        self.model = manifest["model"]
+        self.compactions = manifest["compactions"]
+        self.rebuilds = manifest["rebuilds"]
+        # [(分段, 已删除行的布尔掩码或None)]
+        self.segments = segments
+        self.bases = np.cumsum([0] + [segment.rows for segment, _ in segments])
+        self.rows = int(self.bases[-1])
+        self.live = self.rows - sum(int(deleted.sum()) for _, deleted in segments if deleted is not None)
+
+    def get_metadata(self, doc_id: int) -> dict:
+        import numpy as np
+        index = int(np.searchsorted(self.bases, doc_id, side='right')) - 1
+        segment, _ = self.segments[index]
+        return segment.get_metadata(doc_id - int(self.bases[index]))
+
+    def search_ids(self, query_vector, k: int = KB_TOP_K):
+        """返回全部分段中与查询向量最相似的k个(全局id数组, 相似度数组)"""
+        import numpy as np
+        id_parts = [np.empty(0, dtype=np.int64)]
+        score_parts = [np.empty(0, dtype=np.float32)]
+        if self.live:
+            query = normalize_vectors(np.asarray(query_vector, dtype=np.float32).reshape(1, -1))[0]
+            for (segment, deleted), base in zip(self.segments, self.bases):
+                ids, scores = segment.search(query, k, deleted)
+                id_parts.append(ids + base)
+                score_parts.append(scores)
+        return top_k(np.concatenate(id_parts), np.concatenate(score_parts), k)
+
+    def lexical_search(self, query: str, k: int = KB_TOP_K):
+        """返回BM25得分最高的k个(全局id数组, 得分数组)，idf和平均长度按全部分段统计"""
+        import numpy as np
+        id_parts = [np.empty(0, dtype=np.int64)]
+        score_parts = [np.empty(0, dtype=np.float32)]
+        indexes = [(segment.lexical(), deleted, base) for (segment, deleted), base in zip(self.segments, self.bases)]
+        docs = sum(index.count for index, _, _ in indexes)
+        if self.live and docs:
+            total_len = sum(index.total_len for index, _, _ in indexes)
+            doc_freqs = {
+                term: sum(index.doc_freq(term) for index, _, _ in indexes)
+                for term in query_term_weights(query)
+            }
+            for index, deleted, base in indexes:
+                ids, scores = index.search(query, k, (docs, total_len / docs, doc_freqs), deleted)
+                id_parts.append(ids + base)
+                score_parts.append(scores)
+        return top_k(np.concatenate(id_parts), np.concatenate(score_parts), k)
+
+
+def compaction_plan(entries: List[dict]) -> List[dict]:
+    """选出下一组要合并的分段，没有时返回空列表
+
+    已删除行比例达到KB_COMPACT_DELETED_RATIO的分段单独重写；否则按存活行数分层
+    （第t层不超过KB_SEGMENT_ROWS*KB_MERGE_FACTOR^t行），合并最先凑满KB_MERGE_FACTOR个分段的一层，
+    分段数随总行数对数增长。
+    """
+    for entry in entries:
+        if entry["deleted"] and entry["deleted"] >= entry["rows"] * KB_COMPACT_DELETED_RATIO:
+            return [entry]
+    tiers = {}
+    for entry in entries:
+        live = entry["rows"] - entry["deleted"]
+        tier, limit = 0, KB_SEGMENT_ROWS
+        while live > limit:
+            tier += 1
+            limit *= KB_MERGE_FACTOR
+        tiers.setdefault(tier, []).append(entry)
+    for tier in sorted(tiers):
+        if len(tiers[tier]) >= KB_MERGE_FACTOR:
+            return tiers[tier][:KB_MERGE_FACTOR]
+    return []
+
+
+def empty_manifest() -> dict:
+    """新知识库的清单"""
+    return {
+        "version": 0, "data_version": 0, "dim": None, "model": EMBEDDING_MODEL,
+        "segments": [], "retired": [], "compactions": 0, "rebuilds": 0,
+    }
+
+
+class RowLocator:
+    """某个来源的 行 -> (分段, 行号) 索引，保存在临时SQLite文件中
+
+    重新同步百万行的表时按批次查找旧文本块，内存占用与来源的行数无关；每个分段的元数据只扫描一次。
+    """
+
+    BATCH = 10000
+    # 单条语句的参数个数上限（旧版本SQLite为999）
+    MAX_PARAMS = 500
+
+    def __init__(self, source: str):
+        self.source = source
+        fd, self.path = tempfile.mkstemp(prefix="kb-rows-", suffix=".sqlite")
+        os.close(fd)
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=OFF")
+        self._db.execute("PRAGMA synchronous=OFF")
+        self._db.execute("CREATE TABLE locations (segment TEXT NOT NULL, row TEXT NOT NULL, id INTEGER NOT NULL)")
+        self._db.execute("CREATE INDEX locations_row ON locations (segment, row)")
+        self._indexed = set()
+
+    def _index(self, segment):
+        batch = []
+        for i, meta in enumerate(segment.iter_metadata()):
+            if meta.get("source") == self.source:
+                batch.append((segment.name, str(meta.get("row")), i))
+                if len(batch) >= self.BATCH:
+                    self._db.executemany("INSERT INTO locations VALUES (?, ?, ?)", batch)
+                    batch = []
+        if batch:
+            self._db.executemany("INSERT INTO locations VALUES (?, ?, ?)", batch)
+        self._db.commit()
+        self._indexed.add(segment.name)
+
+    def find(self, segment, rows) -> List[int]:
+        """segment中属于rows的行号"""
+        if segment.name not in self._indexed:
+            self._index(segment)
+        rows = list(rows)
+        ids = []
+        for start in range(0, len(rows), self.MAX_PARAMS):
+            part = rows[start:start + self.MAX_PARAMS]
+            ids.extend(row[0] for row in self._db.execute(
+                f"SELECT id FROM locations WHERE segment = ? AND row IN ({', '.join('?' * len(part))})",
+                (segment.name, *part)
+            ))
+        return ids
+
+    def close(self):
+        self._db.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class KnowledgeBase:
+    """由不可变分段组成的持久化知识库
+
+    manifest.json记录当前版本的分段列表和各分段的墓碑文件（已删除的行号）。追加、删除、合并、
+    清空和重建都是先写好新文件，再在文件锁内原子替换清单；读取方只在发布新快照时切换引用，
+    查询从不等待写入。被替换的分段保留KB_RETIRE_GRACE秒后删除，仍在使用旧快照的查询可以读完。
+    导入和合并运行在任务工作进程中，服务进程的后台线程发现新版本后先加载好索引再发布快照。
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.manifest_path = os.path.join(root, "manifest.json")
+        self.segments_dir = os.path.join(root, "segments")
+        self.tombstones_dir = os.path.join(root, "tombstones")
+        os.makedirs(self.segments_dir, exist_ok=True)
+        os.makedirs(self.tombstones_dir, exist_ok=True)
+        self._file_lock = FileLock(os.path.join(root, ".lock"))
+        self._compact_lock = FileLock(os.path.join(root, ".compact.lock"))
+        self._refresh_lock = threading.Lock()
+        self._snapshot = None
+        self._manifest_stamp = None
+        self._segments = {}
+        self._masks = {}
+        self._watcher = None
+        self._stop = threading.Event()
+        # 检索在线程池中并发执行，统计计数需要加锁
+        self._stats_lock = threading.Lock()
+        self.lexical_queries = 0
+        self.lexical_seconds = 0.0
+        self.lexical_max_seconds = 0.0
+        with self._file_lock:
+            if not os.path.exists(self.manifest_path):
+                self._save_manifest(empty_manifest())
+
+    def _load_manifest(self) -> dict:
+        with open(self.manifest_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _save_manifest(self, manifest: dict):
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _commit(self, mutate, data_changed: bool = True):
+        """在文件锁内读取最新清单并修改，mutate返回False时不写入"""
+        with self._file_lock:
+            manifest = self._load_manifest()
+            result = mutate(manifest)
+            if result is False:
+                return False
+            manifest["version"] += 1
+            if data_changed:
+                manifest["data_version"] += 1
+            self._save_manifest(manifest)
+            return result
+
+    def _load_tombstones(self, entry: dict) -> np.ndarray:
+        import numpy as np
+        if entry["tombstones"] is None:
+            return np.empty(0, dtype=np.int64)
+        return np.load(os.path.join(self.tombstones_dir, entry["tombstones"])).astype(np.int64)
+
+    def _write_tombstones(self, entry: dict, deleted: np.ndarray, manifest: dict) -> dict:
+        """写一个新的墓碑文件（旧文件进入待删除列表），返回更新后的清单条目"""
+        import numpy as np
+        name = f"{entry['name']}.{manifest['version'] + 1}.npy"
+        np.save(os.path.join(self.tombstones_dir, name), np.unique(deleted).astype(np.uint32))
+        self._retire(manifest, [], [entry])
+        return {**entry, "tombstones": name, "deleted": int(len(np.unique(deleted)))}
+
+    @staticmethod
+    def _retire(manifest: dict, segments: List[dict], tombstones: List[dict]):
+        now = time.time()
+        manifest["retired"].extend({"path": os.path.join("segments", entry["name"]), "at": now} for entry in segments)
+        manifest["retired"].extend(
+            {"path": os.path.join("tombstones", entry["tombstones"]), "at": now}
+            for entry in segments + tombstones if entry["tombstones"]
+        )
+
+    # ---- 读取 ----
+
+    def refresh(self):
+        """清单变化时构建并发布新快照，新分段的倒排索引在发布前加载好，查询不会读到已回收的文件"""
+        import numpy as np
+        stamp = file_stamp(self.manifest_path)
+        if stamp == self._manifest_stamp and self._snapshot is not None:
+            return
+        with self._refresh_lock:
+            stamp = file_stamp(self.manifest_path)
+            if stamp == self._manifest_stamp and self._snapshot is not None:
+                return
+            manifest = self._load_manifest()
+            segments = {}
+            masks = {}
+            for entry in manifest["segments"]:
+                segment = self._segments.get(entry["name"])
+                if segment is None:
+                    segment = KBSegment(os.path.join(self.segments_dir, entry["name"]), entry["rows"], manifest["dim"])
+                    segment.lexical()
+                segments[entry["name"]] = segment
+                if entry["tombstones"] is not None:
+                    mask = self._masks.get(entry["tombstones"])
+                    if mask is None:
+                        mask = np.zeros(entry["rows"], dtype=bool)
+                        mask[self._load_tombstones(entry)] = True
+                    masks[entry["tombstones"]] = mask
+            snapshot = KBSnapshot(manifest, [
+                (segments[entry["name"]], masks.get(entry["tombstones"])) for entry in manifest["segments"]
+            ])
+            self._segments, self._masks = segments, masks
+            self._snapshot = snapshot
+            self._manifest_stamp = stamp
+
+    def snapshot(self) -> KBSnapshot:
+        """当前发布的快照；没有后台刷新线程时（工作进程、脚本）按需刷新"""
+        if self._watcher is None or self._snapshot is None:
+            self.refresh()
+        return self._snapshot
+
+    @property
+    def count(self) -> int:
+        return self.snapshot().live
+
+    @property
+    def version(self) -> int:
+        """内容版本，追加、删除、清空和重建时变化，合并不改变"""
+        return self.snapshot().data_version
+
+    @property
+    def dim(self) -> Optional[int]:
+        return self.snapshot().dim
+
+    def get_metadata(self, doc_id: int) -> dict:
+        return self.snapshot().get_metadata(doc_id)
+
+    def search_ids(self, query_vector, k: int = KB_TOP_K):
+        return self.snapshot().search_ids(query_vector, k)
+
+    def search(self, query_vector, k: int = KB_TOP_K) -> List[dict]:
+        """返回与查询向量最相似的k条文本块"""
+        snapshot = self.snapshot()
+        ids, scores = snapshot.search_ids(query_vector, k)
+        return [
+            {**snapshot.get_metadata(int(doc_id)), "score": round(float(score), 4)}
+            for doc_id, score in zip(ids, scores)
+        ]
+
+    def hybrid_search(self, query: str, query_vector=None, k: int = KB_TOP_K) -> List[dict]:
+        """向量检索与BM25检索各取KB_HYBRID_CANDIDATES条，按倒数排名融合后返回前k条
+
+        query_vector为None（如向量化模型不可用）时只使用BM25结果。两路检索使用同一个快照。
+        """
+        snapshot = self.snapshot()
+        start = time.perf_counter()
+        results = [("bm25", snapshot.lexical_search(query, KB_HYBRID_CANDIDATES))]
+        elapsed = time.perf_counter() - start
+        with self._stats_lock:
+            self.lexical_queries += 1
+            self.lexical_seconds += elapsed
+            self.lexical_max_seconds = max(self.lexical_max_seconds, elapsed)
+        if query_vector is not None:
+            results.append(("score", snapshot.search_ids(query_vector, KB_HYBRID_CANDIDATES)))
+        fused = {}
+        ranked = {"score": {}, "bm25": {}}
+        for name, (ids, scores) in results:
+            for rank, (doc_id, score) in enumerate(zip(ids.tolist(), scores.tolist())):
+                fused[doc_id] = fused.get(doc_id, 0.0) + 1.0 / (KB_RRF_K + rank + 1)
+                ranked[name][doc_id] = round(score, 4)
+        best = sorted(fused, key=lambda doc_id: (-fused[doc_id], doc_id))[:k]
+        return [
+            {
+                **snapshot.get_metadata(doc_id),
+                "score": ranked["score"].get(doc_id),
+                "bm25": ranked["bm25"].get(doc_id),
+                "rrf": round(fused[doc_id], 4),
+            }
+            for doc_id in best
+        ]
+
+    # ---- 写入 ----
+
+    def add(self, vectors, metadatas: List[dict]):
+        """把一批向量（归一化后存储）及其元数据写成一个新分段并发布"""
+        import numpy as np
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.ndim != 2 or len(vectors) != len(metadatas):
+            raise ValueError("向量与元数据数量不一致")
+        if not metadatas:
+            return
+        dim = int(vectors.shape[1])
+        current = self._load_manifest()["dim"]
+        if current is not None and current != dim:
+            raise ValueError(f"向量维度不一致: {dim} != {current}")
+        writer = SegmentWriter(self.segments_dir, dim)
+        try:
+            writer.append(normalize_vectors(vectors), metadatas)
+            entry = writer.finish()
+        except BaseException:
+            writer.abort()
+            raise
+
+        def append(manifest):
+            if manifest["dim"] is None:
+                manifest["dim"] = dim
+            elif manifest["dim"] != dim:
+                return False
+            writer.install()
+            manifest["segments"].append(entry)
+
+        if self._commit(append) is False:
+            writer.abort()
+            raise ValueError("向量维度与知识库不一致")
+
+    def delete_source(self, source: str) -> int:
+        """删除某个来源的全部文本块，返回删除的块数
+
+        只为涉及的分段写新的墓碑文件，分段本身不变，删除比例过高的分段由合并重写。
+        """
+        def find(segment):
+            return [i for i, meta in enumerate(segment.iter_metadata()) if meta.get("source") == source]
+
+        return self._delete_matching(source, find)
+
+    def delete_rows(self, source: str, rows, locator: Optional[RowLocator] = None) -> int:
+        """删除某个来源中指定行（元数据中的row）的全部文本块，返回删除的块数
+
+        locator为调用方跨批次复用的RowLocator，未提供时临时建立一个。
+        """
+        rows = set(rows)
+        owned = locator is None
+        if owned:
+            locator = RowLocator(source)
+        try:
+            return self._delete_matching(source, lambda segment: locator.find(segment, rows))
+        finally:
+            if owned:
+                locator.close()
+
+    def _delete_matching(self, source: str, find) -> int:
+        """为find(segment)返回的行写墓碑；期间涉及的分段被合并替换时按新快照重新查找"""
+        import numpy as np
+        while True:
+            matches = {}
+            for segment, _ in self.snapshot().segments:
+                if source not in segment.sources():
+                    continue
+                ids = find(segment)
+                if ids:
+                    matches[segment.name] = np.asarray(ids, dtype=np.int64)
+            if not matches:
+                return 0
+            stale = False
+
+            def mark(manifest):
+                nonlocal stale
+                positions = {entry["name"]: i for i, entry in enumerate(manifest["segments"])}
+                if any(name not in positions for name in matches):
+                    stale = True
+                    return False
+                removed = 0
+                for name, ids in matches.items():
+                    entry = manifest["segments"][positions[name]]
+                    old = self._load_tombstones(entry)
+                    merged = np.union1d(old, ids)
+                    if len(merged) > len(old):
+                        removed += len(merged) - len(old)
+                        manifest["segments"][positions[name]] = self._write_tombstones(entry, merged, manifest)
+                return removed or False
+
+            removed = self._commit(mark)
+            self.refresh()
+            if not stale:
+                return removed or 0
+
+    def clear(self) -> int:
+        """发布一个不含任何分段的新版本，返回清除的块数；旧分段过了保留期后删除"""
+        def empty(manifest):
+            removed = sum(entry["rows"] - entry["deleted"] for entry in manifest["segments"])
+            self._retire(manifest, manifest["segments"], [])
+            manifest.update(segments=[], dim=None, model=EMBEDDING_MODEL)
+            return removed
+
+        removed = self._commit(empty)
+        self.refresh()
+        return removed
+
+    def _replace(self, inputs: List[dict], writer: Optional[SegmentWriter], kept: List[np.ndarray],
+                 counter: str, data_changed: bool = False, **fields) -> bool:
+        """用writer写好的分段原子替换inputs（开始时看到的清单条目），kept[i]为第i个输入写入新分段的行号
+
+        输入分段已被其他操作移除（如清空）时放弃；期间新增的删除按kept映射到新分段的行号上。
+        """
+        import numpy as np
+        def swap(manifest):
+            current = {entry["name"]: entry for entry in manifest["segments"]}
+            if any(entry["name"] not in current for entry in inputs):
+                return False
+            deleted = []
+            base = 0
+            for entry, rows in zip(inputs, kept):
+                now = current[entry["name"]]
+                if now["tombstones"] != entry["tombstones"]:
+                    newly = np.setdiff1d(self._load_tombstones(now), self._load_tombstones(entry))
+                    deleted.append(base + np.searchsorted(rows, newly))
+                base += len(rows)
+            names = {entry["name"] for entry in inputs}
+            segments = [entry for entry in manifest["segments"] if entry["name"] not in names]
+            if writer is not None:
+                entry = writer.entry
+                if deleted:
+                    entry = self._write_tombstones(entry, np.concatenate(deleted), manifest)
+                writer.install()
+                segments.append(entry)
+            self._retire(manifest, [current[name] for name in names], [])
+            manifest["segments"] = segments
+            manifest[counter] += 1
+            manifest.update(fields)
+
+        if self._commit(swap, data_changed) is False:
+            if writer is not None:
+                writer.abort()
+            return False
+        return True
+
+    def _copy_live_rows(self, entry: dict, dim: int, write):
+        """按行号顺序读出一个分段中未删除的行，每KB_SEGMENT_ROWS行调用一次write(向量, 元数据)，返回保留的行号"""
+        import numpy as np
+        segment = KBSegment(os.path.join(self.segments_dir, entry["name"]), entry["rows"], dim)
+        live = np.ones(entry["rows"], dtype=bool)
+        live[self._load_tombstones(entry)] = False
+        ids, metadatas = [], []
+        for local_id, meta in enumerate(segment.iter_metadata()):
+            if not live[local_id]:
+                continue
+            meta.pop("id", None)
+            ids.append(local_id)
+            metadatas.append(meta)
+            if len(ids) >= KB_SEGMENT_ROWS:
+                write(segment.vectors[ids], metadatas)
+                ids, metadatas = [], []
+        if ids:
+            write(segment.vectors[ids], metadatas)
+        return np.flatnonzero(live)
+
+    def maybe_compact(self) -> int:
+        """按compaction_plan反复合并分段，返回合并次数；其他进程正在合并或重建时直接返回0"""
+        if not self._compact_lock.acquire(blocking=False):
+            return 0
+        merged = 0
+        try:
+            while True:
+                manifest = self._load_manifest()
+                inputs = compaction_plan(manifest["segments"])
+                if not inputs:
+                    break
+                start = time.perf_counter()
+                writer = SegmentWriter(self.segments_dir, manifest["dim"])
+                try:
+                    kept = [self._copy_live_rows(entry, manifest["dim"], writer.append) for entry in inputs]
+                    if writer.rows:
+                        writer.finish()
+                    else:
+                        writer.abort()
+                        writer = None
+                except BaseException:
+                    if writer is not None:
+                        writer.abort()
+                    raise
+                rows = writer.rows if writer is not None else 0
+                if not self._replace(inputs, writer, kept, "compactions"):
+                    break
+                merged += 1
+                print(f"Compacted {len(inputs)} segments into {rows} rows in {time.perf_counter() - start:.2f}s")
+        finally:
+            self._compact_lock.release()
+        if merged:
+            self.collect_garbage()
+        return merged
+
+    def rebuild(self, job=None) -> dict:
+        """用当前向量化模型重新向量化全部未删除的文本块，写成一个新分段后原子替换现有分段
+
+        重建期间新上传的分段保留，期间的删除映射到新分段上；持有合并锁，期间不进行合并。
+        """
+        start = time.perf_counter()
+        with self._compact_lock:
+            manifest = self._load_manifest()
+            inputs = manifest["segments"]
+            writers = []
+            kept = []
+
+            def write(_, metadatas):
+                for i in range(0, len(metadatas), EMBED_BATCH_SIZE):
+                    batch = metadatas[i:i + EMBED_BATCH_SIZE]
+                    vectors = embed_texts([meta["text"] for meta in batch])
+                    if not writers:
+                        writers.append(SegmentWriter(self.segments_dir, int(vectors.shape[1])))
+                    writers[0].append(normalize_vectors(vectors), batch)
+                    if job is not None:
+                        job.checkpoint(chunks=len(batch))
+
+            try:
+                for entry in inputs:
+                    kept.append(self._copy_live_rows(entry, manifest["dim"], write))
+                writer = writers[0] if writers else None
+                if writer is not None:
+                    writer.finish()
+            except BaseException:
+                for writer in writers:
+                    writer.abort()
+                raise
+            dim = writer.dim if writer is not None else None
+            if not self._replace(inputs, writer, kept, "rebuilds", data_changed=True, model=EMBEDDING_MODEL, dim=dim):
+                raise RuntimeError("重建期间知识库已被清空或修改，已放弃本次重建")
+        self.collect_garbage()
+        chunks = writer.rows if writer is not None else 0
+        elapsed = time.perf_counter() - start
+        return {
+            "chunks": chunks,
+            "segments": len(inputs),
+            "elapsed": round(elapsed, 3),
+            "chunksPerSecond": round(chunks / elapsed, 2) if elapsed > 0 else 0.0
+        }
+
+    def collect_garbage(self):
+        """删除过了保留期的已替换分段和墓碑文件、清单未引用的分段目录以及中断写入留下的临时目录"""
+        now = time.time()
+        expired = []
+
+        def prune(manifest):
+            referenced = {entry["name"] for entry in manifest["segments"]}
+            referenced.update(os.path.basename(item["path"]) for item in manifest["retired"])
+            for name in os.listdir(self.segments_dir):
+                path = os.path.join(self.segments_dir, name)
+                if name.startswith(".tmp-"):
+                    if now - os.path.getmtime(path) > KB_ORPHAN_TTL:
+                        expired.append(path)
+                elif name not in referenced:
+                    expired.append(path)
+            keep = []
+            for item in manifest["retired"]:
+                if now - item["at"] >= KB_RETIRE_GRACE:
+                    expired.append(os.path.join(self.root, item["path"]))
+                else:
+                    keep.append(item)
+            if len(keep) == len(manifest["retired"]):
+                return False
+            manifest["retired"] = keep
+
+        self._commit(prune, data_changed=False)
+        for path in expired:
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            elif os.path.exists(path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    # ---- 服务进程后台线程 ----
+
+    def start_watcher(self):
+        """启动后台线程：发现新版本后预加载并发布快照，定期合并分段、清理过期文件"""
+        if self._watcher is not None:
+            return
+        self._stop.clear()
+        self._watcher = threading.Thread(target=self._watch, name="kb-watcher", daemon=True)
+        self._watcher.start()
+
+    def stop_watcher(self):
+        self._stop.set()
+        if self._watcher is not None:
+            self._watcher.join(timeout=5)
+            self._watcher = None
+
+    def _watch(self):
+        last_compact = time.monotonic()
+        while True:
+            try:
+                self.refresh()
+                if time.monotonic() - last_compact >= KB_COMPACT_INTERVAL:
+                    last_compact = time.monotonic()
+                    self.maybe_compact()
+                    self.collect_garbage()
+            except Exception as e:
+                print(f"Knowledge base watcher error: {e}")
+            if self._stop.wait(KB_REFRESH_INTERVAL):
+                return
+
+    def stats(self) -> dict:
+        snapshot = self.snapshot()
+        return {
+            "version": snapshot.version,
+            "data_version": snapshot.data_version,
+            "model": snapshot.model,
+            "dim": snapshot.dim,
+            "segments": len(snapshot.segments),
+            "segment_rows": [segment.rows for segment, _ in snapshot.segments],
+            "rows": snapshot.rows,
+            "live": snapshot.live,
+            "deleted": snapshot.rows - snapshot.live,
+            "compactions": snapshot.compactions,
+            "rebuilds": snapshot.rebuilds,
+        }
+
+    def lexical_stats(self) -> dict:
+        indexes = [segment.lexical().stats() for segment, _ in self.snapshot().segments]
+        docs = sum(index["docs"] for index in indexes)
+        with self._stats_lock:
+            queries, seconds, max_seconds = self.lexical_queries, self.lexical_seconds, self.lexical_max_seconds
+        return {
+            "segments": len(indexes),
+            "docs": docs,
+            "terms": sum(index["terms"] for index in indexes),
+            "postings": sum(index["postings"] for index in indexes),
+            "avg_doc_len": round(sum(index["total_len"] for index in indexes) / docs, 1) if docs else 0,
+            "queries": queries,
+            "avg_query_ms": round(seconds / queries * 1000, 3) if queries else 0,
+            "max_query_ms": round(max_seconds * 1000, 3),
+        }
+
+
+def lazy_singleton(factory):
+    """返回首次调用时才创建对象的访问函数，创建目录、打开SQLite等工作不在导入模块时进行"""
+    lock = threading.Lock()
+    instance = []
+
+    def get():
+        if not instance:
+            with lock:
+                if not instance:
+                    instance.append(factory())
+        return instance[0]
+    return get
+
+
+get_knowledge_base = lazy_singleton(lambda: KnowledgeBase(KB_DIR))
+_embeddings = None
+
+
+def get_embeddings():
+    """延迟创建Ollama向量化模型"""
+    global _embeddings
+    if _embeddings is None:
+        from langchain_ollama import OllamaEmbeddings
+        _embeddings = OllamaEmbeddings(model=EMBEDDING_MODEL, keep_alive=OLLAMA_KEEP_ALIVE)
+    return _embeddings
+
+
+class EmbeddingCache:
+    """内容寻址的向量缓存：内存LRU在前，SQLite磁盘存储在后
+
+    键为(模型名, 规范化文本)的sha256，相同文本在任何导入来源中只向量化一次。
+    """
+
+    def __init__(self, path: str, max_entries: int):
+        self.max_entries = max_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        # 缓存丢失只需重新向量化，不需要每次提交都落盘同步
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB)")
+        self._db.commit()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(model: str, text: str) -> str:
+        return hashlib.sha256(f"{model}\0{text}".encode('utf-8')).hexdigest()
+
+    def _remember(self, key: str, vector: np.ndarray):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def get_many(self, keys: List[str]) -> dict:
+        """查询一批键，返回命中的{键: 向量}"""
+        import numpy as np
+        found = {}
+        with self._lock:
+            missing = []
+            for key in keys:
+                vector = self._memory.get(key)
+                if vector is not None:
+                    self._memory.move_to_end(key)
+                    found[key] = vector
+                    self.memory_hits += 1
+                else:
+                    missing.append(key)
+            for start in range(0, len(missing), 500):
+                part = missing[start:start + 500]
+                rows = self._db.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(part))})", part
+                ).fetchall()
+                for key, blob in rows:
+                    vector = np.frombuffer(blob, dtype=np.float32)
+                    self._remember(key, vector)
+                    found[key] = vector
+                    self.disk_hits += 1
+            self.misses += sum(1 for key in missing if key not in found)
+        return found
+
+    def put_many(self, items: dict):
+        with self._lock:
+            for key, vector in items.items():
+                self._remember(key, vector)
+            self._db.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                [(key, vector.tobytes()) for key, vector in items.items()]
+            )
+            self._db.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_entries": len(self._memory),
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_ratio": round((self.memory_hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+            }
+
+
+get_embedding_cache = lazy_singleton(
+    lambda: EmbeddingCache(os.path.join(KB_DIR, "embedding_cache.sqlite"), EMBED_CACHE_SIZE))
+
+
+def normalize_text(text: str) -> str:
+    """规范化文本：全半角统一并折叠空白"""
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+def embed_texts(texts: List[str]) -> np.ndarray:
+    """批量向量化文本，命中缓存的文本不再调用模型"""
+    import numpy as np
+    texts = [normalize_text(text) for text in texts]
+    keys = [EmbeddingCache.key(EMBEDDING_MODEL, text) for text in texts]
+    found = get_embedding_cache().get_many(keys)
+    pending = {}
+    for key, text in zip(keys, texts):
+        if key not in found and key not in pending:
+            pending[key] = text
+    if pending:
+        vectors = get_embeddings().embed_documents(list(pending.values()))
+        computed = {key: np.asarray(vector, dtype=np.float32) for key, vector in zip(pending, vectors)}
+        get_embedding_cache().put_many(computed)
+        found.update(computed)
+    return np.stack([found[key] for key in keys])
+
+
+async def spool_upload(file: UploadFile):
+    """将上传文件分块写入临时文件，返回(路径, 字节数)"""
+    suffix = os.path.splitext(file.filename or "")[1]
+    size = 0
+    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix, dir=JOB_SPOOL_DIR) as out:
+        while True:
+            data = await file.read(SPOOL_CHUNK_SIZE)
+            if not data:
+                break
+            out.write(data)
+            size += len(data)
+    return out.name, size
+
+
+def iter_document_text(path: str, filename: str):
+    """按页或按块逐段产出文档文本"""
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == '.pdf':
+        try:
+            from pypdf import PdfReader
+        except ImportError:
+            raise ValueError("pypdf库未安装，请先安装：pip install pypdf")
+        reader = PdfReader(path)
+        for page in reader.pages:
+            text = page.extract_text() or ""
+            if text:
+                yield text
+    elif ext in TEXT_EXTENSIONS:
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(TEXT_READ_SIZE)
+                if not data:
+                    break
+                yield decoder.decode(data)
+        tail = decoder.decode(b'', final=True)
+        if tail:
+            yield tail
+    else:
+        raise ValueError(f"不支持的文件类型: {ext or filename}")
+
+
+def split_text_stream(pieces, chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP):
+    """将流式文本切分为相互重叠的文本块，只在内存中保留不足一块的文本"""
+    buffer = ""
+    for piece in pieces:
+        buffer += piece
+        pos = 0
+        while len(buffer) - pos >= chunk_size:
+            end = pos + chunk_size
+            # 在块的后半部分寻找句子边界
+            for i in range(end - 1, pos + chunk_size // 2, -1):
+                if buffer[i] in SENTENCE_ENDINGS:
+                    end = i + 1
+                    break
+            chunk = buffer[pos:end].strip()
+            if chunk:
+                yield chunk
+            pos = max(end - overlap, pos + 1)
+        buffer = buffer[pos:]
+    chunk = buffer.strip()
+    if chunk:
+        yield chunk
+
+
+def ingest_documents(documents, job=None) -> int:
+    """将(文本, 元数据)按EMBED_BATCH_SIZE分批向量化，每KB_SEGMENT_ROWS块提交为知识库的一个分段，返回块数
+
+    传入job时每提交一个分段记录一次进度；每批向量化后检查取消，已向量化但未提交的块留在向量缓存中，
+    续传时不必重新调用模型。每次提交后按需合并小分段。
+    """
+    import numpy as np
+    count = 0
+    batch = []
+    vectors = []
+    metadatas = []
+
+    def embed():
+        vectors.append(embed_texts([text for text, _ in batch]))
+        metadatas.extend({**meta, "text": text} for text, meta in batch)
+        batch.clear()
+        if job is not None:
+            job.checkpoint()
+
+    def commit():
+        get_knowledge_base().add(np.concatenate(vectors), metadatas)
+        if job is not None:
+            job.checkpoint(chunks=len(metadatas))
+        vectors.clear()
+        metadatas.clear()
+        get_knowledge_base().maybe_compact()
+
+    for document in documents:
+        batch.append(document)
+        count += 1
+        if len(batch) >= EMBED_BATCH_SIZE:
+            embed()
+            if len(metadatas) >= KB_SEGMENT_ROWS:
+                commit()
+    if batch:
+        embed()
+    if metadatas:
+        commit()
+    return count
+
+
+def ingest_texts(texts, source_metadata: dict, job=None, skip: int = 0) -> int:
+    """将同一来源的文本块分批向量化写入知识库，跳过前skip块（断点续传），返回新写入的块数"""
+    return ingest_documents(
+        ((text, {**source_metadata, "chunk": i}) for i, text in enumerate(texts) if i >= skip),
+        job
+    )
+
+
+def ingest_file(path: str, filename: str, job=None) -> dict:
+    """解析、分块并向量化一个已落盘的文件"""
+    start = time.perf_counter()
+    skip = job.resume_chunks if job is not None else 0
+    try:
+        chunks = skip + ingest_texts(
+            split_text_stream(iter_document_text(path, filename)),
+            {"source": filename},
+            job,
+            skip
+        )
+    except ValueError as e:
+        return {"chunks": 0, "error": str(e)}
+    elapsed = time.perf_counter() - start
+    return {
+        "chunks": chunks,
+        "elapsed": round(elapsed, 3),
+        "chunksPerSecond": round(chunks / elapsed, 2) if elapsed > 0 else 0.0
+    }
+
+
+# 数据库导入配置
+DB_IMPORT_BATCH_SIZE = int(os.getenv("DB_IMPORT_BATCH_SIZE", "1000"))
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+DB_WATERMARK_PATH = os.path.join(KB_DIR, "db_watermarks.json")
+
+
+def database_key(config: DatabaseConfig) -> str:
+    """标识一个数据库连接目标（不含密码）"""
+    return f"{config.type}://{config.username}@{config.host}:{config.port}/{config.database}"
+
+
+def open_db_connection(config: DatabaseConfig):
+    """按数据库类型建立连接"""
+    if config.type == "sqlite":
+        # 只读打开，路径写错时报错而不是新建一个空数据库
+        if not os.path.isfile(config.database):
+            raise ValueError(f"SQLite数据库文件不存在: {config.database}")
+        uri = f"file:{urllib.parse.quote(os.path.abspath(config.database))}?mode=ro"
+        return sqlite3.connect(uri, uri=True, check_same_thread=False)
+    elif config.type == "mysql":
+        try:
+            import pymysql
+        except ImportError:
+            raise ValueError("pymysql库未安装，请先安装：pip install pymysql")
+        return pymysql.connect(
+            host=config.host, port=int(config.port or 3306), user=config.username,
+            password=config.password, database=config.database, charset='utf8mb4'
+        )
+    elif config.type == "postgresql":
+        try:
+            import psycopg2
+        except ImportError:
+            raise ValueError("psycopg2库未安装，请先安装：pip install psycopg2-binary")
+        return psycopg2.connect(
+            host=config.host, port=int(config.port or 5432), user=config.username,
+            password=config.password, dbname=config.database
+        )
+    raise ValueError(f"不支持的数据库类型: {config.type}")
+
+
+class DatabaseConnectionPool:
+    """同一数据库配置共享的连接池"""
+
+    def __init__(self, config: DatabaseConfig, size: int):
+        self.config = config
+        self.size = size
+        self._idle = []
+        self._created = 0
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def connection(self):
+        """借用一个连接，归还前回滚未提交的事务"""
+        with self._cond:
+            while not self._idle and self._created >= self.size:
+                self._cond.wait()
+            if self._idle:
+                conn = self._idle.pop()
+            else:
+                self._created += 1
+                conn = None
+        if conn is None:
+            try:
+                conn = open_db_connection(self.config)
+            except Exception:
+                with self._cond:
+                    self._created -= 1
+                    self._cond.notify()
+                raise
+        broken = False
+        try:
+            yield conn
+        except Exception:
+            broken = True
+            raise
+        finally:
+            try:
+                conn.rollback()
+            except Exception:
+                broken = True
+            with self._cond:
+                if broken:
+                    self._created -= 1
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+                else:
+                    self._idle.append(conn)
+                self._cond.notify()
+
+
+db_pools = {}
+db_pools_lock = threading.Lock()
+db_watermark_lock = threading.Lock()
+
+
+def get_db_pool(config: DatabaseConfig) -> DatabaseConnectionPool:
+    """按数据库配置获取（或创建）连接池"""
+    key = (database_key(config), hashlib.sha256(config.password.encode('utf-8')).hexdigest())
+    with db_pools_lock:
+        pool = db_pools.get(key)
+        if pool is None:
+            pool = db_pools[key] = DatabaseConnectionPool(config, DB_POOL_SIZE)
+        return pool
+
+
+def quote_identifier(config: DatabaseConfig, name: str) -> str:
+    quote = '`' if config.type == "mysql" else '"'
+    return quote + name.replace(quote, quote * 2) + quote
+
+
+def list_db_tables(conn, config: DatabaseConfig) -> List[str]:
+    cursor = conn.cursor()
+    if config.type == "sqlite":
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%' ORDER BY name")
+    elif config.type == "mysql":
+        cursor.execute("SELECT table_name FROM information_schema.tables WHERE table_schema = DATABASE() AND table_type = 'BASE TABLE' ORDER BY table_name")
+    else:
+        cursor.execute("SELECT table_name FROM information_schema.tables WHERE table_schema = current_schema() AND table_type = 'BASE TABLE' ORDER BY table_name")
+    tables = [row[0] for row in cursor.fetchall()]
+    cursor.close()
+    return tables
+
+
+def db_table_columns(conn, config: DatabaseConfig, table: str):
+    """返回(列名列表, 主键列名或None)"""
+    cursor = conn.cursor()
+    if config.type == "sqlite":
+        cursor.execute(f"PRAGMA table_info({quote_identifier(config, table)})")
+        rows = cursor.fetchall()
+        columns = [row[1] for row in rows]
+        primary = [row[1] for row in sorted(rows, key=lambda r: r[5]) if row[5]]
+    else:
+        param = "%s"
+        schema = "DATABASE()" if config.type == "mysql" else "current_schema()"
+        cursor.execute(
+            f"SELECT column_name FROM information_schema.columns WHERE table_schema = {schema} "
+            f"AND table_name = {param} ORDER BY ordinal_position", (table,)
+        )
+        columns = [row[0] for row in cursor.fetchall()]
+        cursor.execute(
+            "SELECT kcu.column_name FROM information_schema.table_constraints tc "
+            "JOIN information_schema.key_column_usage kcu ON tc.constraint_name = kcu.constraint_name "
+            f"AND tc.table_schema = kcu.table_schema WHERE tc.constraint_type = 'PRIMARY KEY' "
+            f"AND tc.table_schema = {schema} AND tc.table_name = {param} ORDER BY kcu.ordinal_position", (table,)
+        )
+        primary = [row[0] for row in cursor.fetchall()]
+    cursor.close()
+    return columns, (primary[0] if len(primary) == 1 else None)
+
+
+def open_stream_cursor(conn, config: DatabaseConfig):
+    """打开逐批取数的游标：MySQL/PostgreSQL使用服务端游标，SQLite游标本身按需读取"""
+    if config.type == "mysql":
+        import pymysql.cursors
+        return conn.cursor(pymysql.cursors.SSCursor)
+    elif config.type == "postgresql":
+        cursor = conn.cursor(name=f"kb_import_{threading.get_ident()}")
+        cursor.itersize = DB_IMPORT_BATCH_SIZE
+        return cursor
+    return conn.cursor()
+
+
+def load_db_watermarks() -> dict:
+    if os.path.exists(DB_WATERMARK_PATH):
+        with open(DB_WATERMARK_PATH, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    return {}
+
+
+def watermark_value(value):
+    """水位值以JSON保存，数字以外的类型（日期时间等）转为字符串"""
+    return value if isinstance(value, (int, float)) or value is None else str(value)
+
+
+def save_db_watermark(key: str, column: str, value, row_key=None):
+    """持久化一张表的同步水位：水位列的值和该值下最后一行的主键"""
+    with db_watermark_lock:
+        watermarks = load_db_watermarks()
+        watermarks[key] = {"column": column, "value": value, "key": row_key}
+        tmp_path = DB_WATERMARK_PATH + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(watermarks, f, ensure_ascii=False)
+        os.replace(tmp_path, DB_WATERMARK_PATH)
+
+
+def row_to_text(table: str, columns: List[str], row) -> str:
+    """把一行数据转为"列: 值"形式的文本"""
+    return f"[{table}] " + "; ".join(
+        f"{column}: {value}" for column, value in zip(columns, row) if value is not None
+    )
+
+
+def import_db_table(conn, config: DatabaseConfig, table: str, job=None) -> dict:
+    """按水位增量导入一张表，每次只在内存中保留一批行
+
+    有单列主键时按(水位列, 主键)排序并从上次的(值, 主键)之后继续，水位相同、上次导入后才提交的行不会漏掉；
+    没有主键（或旧版本只记录了水位值）时取水位列>=上次的值，重复取到的行按下面的方式去重。
+    再次导入的行先删除知识库中同一来源、同一行的旧文本块再写入，更新过的行不会新旧内容并存。
+    """
+    columns, primary = db_table_columns(conn, config, table)
+    column = config.watermark_column or ("updated_at" if "updated_at" in columns else primary)
+    if column not in columns:
+        return {"table": table, "rows": 0, "chunks": 0, "error": "未找到可用于增量同步的列（updated_at或单列主键）"}
+    key = f"{database_key(config)}/{table}"
+    state = load_db_watermarks().get(key)
+    watermark = state["value"] if state and state["column"] == column else None
+    last_key = state.get("key") if watermark is not None else None
+    # 水位列就是主键时值唯一，不需要复合游标
+    tiebreak = primary if primary and primary != column else None
+    row_key_index = columns.index(primary) if primary else columns.index(column)
+    watermark_index = columns.index(column)
+
+    placeholder = '?' if config.type == 'sqlite' else '%s'
+    quoted = quote_identifier(config, column)
+    select = ", ".join(quote_identifier(config, c) for c in columns)
+    sql = f"SELECT {select} FROM {quote_identifier(config, table)}"
+    params = ()
+    if watermark is not None:
+        if tiebreak and last_key is not None:
+            sql += (f" WHERE {quoted} > {placeholder} OR ({quoted} = {placeholder} "
+                    f"AND {quote_identifier(config, tiebreak)} > {placeholder})")
+            params = (watermark, watermark, last_key)
+        elif column == primary:
+            sql += f" WHERE {quoted} > {placeholder}"
+            params = (watermark,)
+        else:
+            sql += f" WHERE {quoted} >= {placeholder}"
+            params = (watermark,)
+    sql += f" ORDER BY {quoted}"
+    if tiebreak:
+        sql += f", {quote_identifier(config, tiebreak)}"
+
+    rows = 0
+    chunks = 0
+    source = f"{config.database}.{table}"
+    # 首次导入且知识库中没有该表的文本块时不需要删除旧块
+    existing = any(source in segment.sources() for segment, _ in get_knowledge_base().snapshot().segments)
+    locator = RowLocator(source) if watermark is not None or existing else None
+    cursor = open_stream_cursor(conn, config)
+    try:
+        cursor.execute(sql, params)
+        while True:
+            batch = cursor.fetchmany(DB_IMPORT_BATCH_SIZE)
+            if not batch:
+                break
+            documents = []
+            row_keys = []
+            for row in batch:
+                row_key = str(row[row_key_index])
+                row_keys.append(row_key)
+                for i, text in enumerate(split_text_stream([row_to_text(table, columns, row)])):
+                    documents.append((text, {"source": source, "row": row_key, "chunk": i}))
+            if locator is not None:
+                get_knowledge_base().delete_rows(source, row_keys, locator)
+            batch_chunks = ingest_documents(documents)
+            chunks += batch_chunks
+            rows += len(batch)
+            last = batch[-1]
+            save_db_watermark(key, column, watermark_value(last[watermark_index]),
+                              watermark_value(last[columns.index(tiebreak)]) if tiebreak else None)
+            if job is not None:
+                job.checkpoint(rows=len(batch), chunks=batch_chunks)
+    finally:
+        cursor.close()
+        if locator is not None:
+            locator.close()
+    return {"table": table, "rows": rows, "chunks": chunks, "watermark_column": column}
+
+
+def import_database(config: DatabaseConfig, job=None) -> dict:
+    """导入数据库中的表到知识库，只拉取上次同步后新增或更新的行"""
+    start = time.perf_counter()
+    with get_db_pool(config).connection() as conn:
+        existing = list_db_tables(conn, config)
+        if config.tables:
+            missing = [t for t in config.tables if t not in existing]
+            if missing:
+                raise ValueError(f"表不存在: {', '.join(missing)}")
+            tables = config.tables
+        else:
+            tables = existing
+        results = [import_db_table(conn, config, table, job) for table in tables]
+    elapsed = time.perf_counter() - start
+    rows = sum(r["rows"] for r in results)
+    return {
+        "tables": results,
+        "rows": rows,
+        "chunks": sum(r["chunks"] for r in results),
+        "elapsed": round(elapsed, 3),
+        "rowsPerSecond": round(rows / elapsed, 2) if elapsed > 0 else 0.0
+    }
+
+
+def check_db_connection(config: DatabaseConfig) -> List[str]:
+    """借用连接执行一次查询，返回表名列表"""
+    with get_db_pool(config).connection() as conn:
+        return list_db_tables(conn, config)
+
+
+# 后台任务配置
+JOB_DB_PATH = os.path.join(KB_DIR, "jobs.sqlite")
+JOB_SPOOL_DIR = os.path.join(KB_DIR, "spool")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_POLL_INTERVAL = 1.0
+JOB_TERMINAL_STATUSES = ("completed", "failed", "cancelled")
+
+
+class JobCancelled(Exception):
+    """任务在工作进程中响应取消请求"""
+
+
+class JobStore:
+    """SQLite持久化任务队列
+
+    主进程按优先级领取任务并记录结果，工作进程直接写入进度、读取取消标记。
+    """
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            name TEXT,
+            payload TEXT NOT NULL,
+            priority INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL,
+            cancel_requested INTEGER NOT NULL DEFAULT 0,
+            rows INTEGER NOT NULL DEFAULT 0,
+            chunks INTEGER NOT NULL DEFAULT 0,
+            total INTEGER,
+            result TEXT,
+            error TEXT,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            finished_at REAL
+        )""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, priority, created_at)")
+        self._db.commit()
+
+    def _execute(self, sql: str, params=()):
+        with self._lock:
+            cursor = self._db.execute(sql, params)
+            self._db.commit()
+            return cursor
+
+    def _query(self, sql: str, params=()) -> List[dict]:
+        with self._lock:
+            return [dict(row) for row in self._db.execute(sql, params).fetchall()]
+
+    def enqueue(self, kind: str, name: str, payload: dict, priority: int = 0, job_id: Optional[str] = None) -> str:
+        job_id = job_id or uuid.uuid4().hex
+        self._execute(
+            "INSERT INTO jobs (id, kind, name, payload, priority, status, max_attempts, created_at) "
+            "VALUES (?, ?, ?, ?, ?, 'pending', ?, ?)",
+            (job_id, kind, name, json.dumps(payload, ensure_ascii=False), priority, JOB_MAX_ATTEMPTS, time.time())
+        )
+        return job_id
+
+    def claim_next(self) -> Optional[dict]:
+        """领取优先级最高、最早提交的待执行任务"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT * FROM jobs WHERE status = 'pending' ORDER BY priority DESC, created_at LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            self._db.execute(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1, "
+                "started_at = COALESCE(started_at, ?) WHERE id = ?",
+                (time.time(), row["id"])
+            )
+            self._db.commit()
+            return dict(row)
+
+    def complete(self, job_id: str, result: dict):
+        self._execute(
+            "UPDATE jobs SET status = 'completed', result = ?, finished_at = ? WHERE id = ?",
+            (json.dumps(result, ensure_ascii=False, default=str), time.time(), job_id)
+        )
+
+    def fail(self, job_id: str, error: str, retry: bool = True) -> str:
+        """记录失败，未超过重试次数时重新排队，返回新状态"""
+        with self._lock:
+            row = self._db.execute("SELECT attempts, max_attempts FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            status = "pending" if retry and row["attempts"] < row["max_attempts"] else "failed"
+            self._db.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE id = ?",
+                (status, error, time.time() if status == "failed" else None, job_id)
+            )
+            self._db.commit()
+            return status
+
+    def mark_cancelled(self, job_id: str):
+        self._execute("UPDATE jobs SET status = 'cancelled', finished_at = ? WHERE id = ?", (time.time(), job_id))
+
+    def request_cancel(self, job_id: str) -> Optional[str]:
+        """待执行任务直接取消，运行中的任务设置取消标记，返回当前状态"""
+        with self._lock:
+            row = self._db.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return None
+            status = row["status"]
+            if status == "pending":
+                status = "cancelled"
+                self._db.execute(
+                    "UPDATE jobs SET status = 'cancelled', cancel_requested = 1, finished_at = ? WHERE id = ?",
+                    (time.time(), job_id)
+                )
+            elif status == "running":
+                self._db.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ?", (job_id,))
+            self._db.commit()
+            return status
+
+    def add_progress(self, job_id: str, rows: int = 0, chunks: int = 0) -> bool:
+        """累加进度，返回是否已请求取消"""
+        with self._lock:
+            self._db.execute("UPDATE jobs SET rows = rows + ?, chunks = chunks + ? WHERE id = ?", (rows, chunks, job_id))
+            self._db.commit()
+            row = self._db.execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            return bool(row and row["cancel_requested"])
+
+    def set_total(self, job_id: str, total: Optional[int]):
+        self._execute("UPDATE jobs SET total = ? WHERE id = ?", (total, job_id))
+
+    def requeue_interrupted(self) -> int:
+        """服务重启后把上次未完成的任务重新排队"""
+        return self._execute("UPDATE jobs SET status = 'pending' WHERE status = 'running'").rowcount
+
+    def get(self, job_id: str) -> Optional[dict]:
+        rows = self._query("SELECT * FROM jobs WHERE id = ?", (job_id,))
+        return job_snapshot(rows[0]) if rows else None
+
+    def get_payload(self, job_id: str) -> Optional[tuple]:
+        """返回任务的(类型, 参数)"""
+        rows = self._query("SELECT kind, payload FROM jobs WHERE id = ?", (job_id,))
+        return (rows[0]["kind"], json.loads(rows[0]["payload"])) if rows else None
+
+    def list(self, status: Optional[str] = None, limit: int = 50) -> List[dict]:
+        if status:
+            rows = self._query("SELECT * FROM jobs WHERE status = ? ORDER BY created_at DESC LIMIT ?", (status, limit))
+        else:
+            rows = self._query("SELECT * FROM jobs ORDER BY created_at DESC LIMIT ?", (limit,))
+        return [job_snapshot(row) for row in rows]
+
+
+def job_snapshot(row: dict) -> dict:
+    """任务状态及速率、预计剩余时间"""
+    end = row["finished_at"] or time.time()
+    elapsed = end - row["started_at"] if row["started_at"] else 0.0
+    rate = row["rows"] / elapsed if elapsed > 0 else 0.0
+    eta = None
+    if row["status"] == "running" and row["total"] and rate > 0:
+        eta = round(max(row["total"] - row["rows"], 0) / rate, 1)
+    return {
+        "job_id": row["id"],
+        "kind": row["kind"],
+        "name": row["name"],
+        "status": row["status"],
+        "priority": row["priority"],
+        "attempts": row["attempts"],
+        "cancelRequested": bool(row["cancel_requested"]),
+        "rows": row["rows"],
+        "chunks": row["chunks"],
+        "total": row["total"],
+        "progress": round(row["rows"] / row["total"], 4) if row["total"] else None,
+        "rowsPerSecond": round(rate, 2),
+        "etaSeconds": eta,
+        "elapsed": round(elapsed, 3),
+        "result": json.loads(row["result"]) if row["result"] else None,
+        "error": row["error"],
+    }
+
+
+def create_job_store() -> JobStore:
+    """任务表与上传文件的暂存目录一同创建"""
+    os.makedirs(JOB_SPOOL_DIR, exist_ok=True)
+    return JobStore(JOB_DB_PATH)
+
+
+get_job_store = lazy_singleton(create_job_store)
+
+
+class JobContext:
+    """工作进程中的任务句柄：汇报进度、响应取消、提供断点续传位置"""
+
+    def __init__(self, job_id: str, resume_rows: int, resume_chunks: int):
+        self.job_id = job_id
+        self.resume_rows = resume_rows
+        self.resume_chunks = resume_chunks
+
+    def set_total(self, total: Optional[int]):
+        get_job_store().set_total(self.job_id, total)
+
+    def checkpoint(self, rows: int = 0, chunks: int = 0):
+        """记录已写入知识库的进度，任务被取消时抛出JobCancelled"""
+        if get_job_store().add_progress(self.job_id, rows, chunks):
+            raise JobCancelled()
+
+
+def run_job(job_id: str, kind: str, payload: dict, resume_rows: int, resume_chunks: int) -> dict:
+    """工作进程入口，异常统一转换为可跨进程传递的RuntimeError"""
+    job = JobContext(job_id, resume_rows, resume_chunks)
+    try:
+        if kind == "upload":
+            return ingest_file(payload["path"], payload["filename"], job)
+        elif kind == "database":
+            return import_database(DatabaseConfig(**payload), job)
+        elif kind == "modelscope":
+            return import_modelscope_dataset(ModelScopeConfig(**payload), job)
+        elif kind == "rebuild":
+            return get_knowledge_base().rebuild(job)
+        raise ValueError(f"未知的任务类型: {kind}")
+    except JobCancelled:
+        return {"cancelled": True}
+    except Exception as e:
+        raise RuntimeError(f"{type(e).__name__}: {e}") from None
+
+
+class JobScheduler:
+    """在事件循环中调度任务到进程池，任务表读写放到线程池，不阻塞处理请求的事件循环"""
+
+    def __init__(self, store: JobStore, workers: int):
+        self.store = store
+        self.workers = workers
+        self._executor = None
+        self._running = {}
+        # 数据库密码只保存在内存中，不写入任务表
+        self._secrets = {}
+        self._wakeup = None
+        self._task = None
+
+    async def start(self):
+        requeued = await run_in_threadpool(self.store.requeue_interrupted)
+        if requeued:
+            print(f"Requeued {requeued} interrupted jobs")
+        self._executor = self._create_executor()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._loop())
+
+    def _create_executor(self) -> ProcessPoolExecutor:
+        # spawn避免子进程继承父进程的SQLite连接和线程状态
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def _replace_executor(self, broken: ProcessPoolExecutor):
+        """进程池损坏时所有运行中的任务都会收到BrokenProcessPool，只由第一个重建并关闭旧池"""
+        if self._executor is broken:
+            self._executor = self._create_executor()
+            broken.shutdown(wait=False)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+    async def submit(self, kind: str, name: str, payload: dict, priority: int = 0, secret: Optional[str] = None) -> str:
+        job_id = uuid.uuid4().hex
+        if secret:
+            # 只记录需要密码，服务重启后据此识别无法继续的任务；先登记密码再入队
+            payload = dict(payload, secret_required=True)
+            self._secrets[job_id] = secret
+        try:
+            await run_in_threadpool(self.store.enqueue, kind, name, payload, priority, job_id)
+        except BaseException:
+            self._secrets.pop(job_id, None)
+            raise
+        self.notify()
+        return job_id
+
+    async def cancel(self, job_id: str) -> Optional[str]:
+        status = await run_in_threadpool(self.store.request_cancel, job_id)
+        if status == "cancelled":
+            await self._cleanup(job_id)
+        return status
+
+    def notify(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _loop(self):
+        while True:
+            while len(self._running) < self.workers:
+                job = await run_in_threadpool(self.store.claim_next)
+                if job is None:
+                    break
+                await self._dispatch(job)
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=JOB_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _dispatch(self, job: dict):
+        payload = json.loads(job["payload"])
+        secret_required = payload.pop("secret_required", False)
+        if secret_required and job["id"] not in self._secrets:
+            await run_in_threadpool(self.store.fail, job["id"], "服务重启后数据库密码已丢失，请重新提交导入任务", False)
+            await self._cleanup(job["id"])
+            return
+        if job["kind"] == "database":
+            payload["password"] = self._secrets.get(job["id"], "")
+        args = (run_job, job["id"], job["kind"], payload, job["rows"], job["chunks"])
+        executor = self._executor
+        try:
+            future = executor.submit(*args)
+        except BrokenProcessPool:
+            # 进程池已损坏但还没有任务结束时发现
+            self._replace_executor(executor)
+            executor = self._executor
+            future = executor.submit(*args)
+        self._running[job["id"]] = asyncio.create_task(self._finish(job["id"], executor, asyncio.wrap_future(future)))
+
+    async def _finish(self, job_id: str, executor: ProcessPoolExecutor, future):
+        try:
+            try:
+                result = await future
+            except BrokenProcessPool as e:
+                print(f"Job worker crashed: {e}")
+                self._replace_executor(executor)
+                status = await run_in_threadpool(self.store.fail, job_id, f"工作进程异常退出: {e}")
+            except Exception as e:
+                status = await run_in_threadpool(self.store.fail, job_id, str(e))
+            else:
+                status = await run_in_threadpool(self._record_result, job_id, result)
+            if status in JOB_TERMINAL_STATUSES:
+                await self._cleanup(job_id)
+        finally:
+            self._running.pop(job_id, None)
+            self.notify()
+
+    def _record_result(self, job_id: str, result: dict) -> str:
+        if result.get("cancelled"):
+            self.store.mark_cancelled(job_id)
+            return "cancelled"
+        if result.get("error"):
+            # 文件类型不支持等确定性错误无需重试
+            return self.store.fail(job_id, result["error"], retry=False)
+        self.store.complete(job_id, result)
+        return "completed"
+
+    async def _cleanup(self, job_id: str):
+        """任务结束后删除上传的暂存文件"""
+        self._secrets.pop(job_id, None)
+        await run_in_threadpool(self._remove_spool, job_id)
+
+    def _remove_spool(self, job_id: str):
+        job = self.store.get_payload(job_id)
+        if job is not None and job[0] == "upload":
+            path = job[1]["path"]
+            if os.path.exists(path):
+                os.remove(path)
+
+
+get_job_scheduler = lazy_singleton(lambda: JobScheduler(get_job_store(), JOB_WORKERS))
+
+
+def dataset_row_text(row: dict, text_fields: Optional[List[str]]) -> str:
+    """从数据集的一行中提取文本字段"""
+    fields = text_fields or [k for k, v in row.items() if isinstance(v, str)]
+    return "\n".join(f"{k}: {row[k]}" for k in fields if isinstance(row.get(k), str) and row[k].strip())
+
+
+def import_modelscope_dataset(config: ModelScopeConfig, job=None) -> dict:
+    """以流式模式遍历ModelScope数据集，分批向量化写入知识库"""
+    from modelscope.msdatasets import MsDataset
+
+    start = time.perf_counter()
+    dataset_params = {
+        'dataset_name': config.dataset_name,
+        'split': config.split,
+        'use_streaming': True
+    }
+    if config.subset_name:
+        dataset_params['subset_name'] = config.subset_name
+    if config.cache_dir:
+        dataset_params['cache_dir'] = config.cache_dir
+    ds = MsDataset.load(**dataset_params)
+
+    total = None
+    try:
+        total = len(ds)
+    except Exception:
+        pass
+    if config.max_rows:
+        total = min(total, config.max_rows) if total else config.max_rows
+    if job is not None:
+        job.set_total(total)
+
+    # 重试时跳过上次已写入的行
+    skip = job.resume_rows if job is not None else 0
+    source = f"modelscope:{config.dataset_name}"
+    documents = []
+    pending_rows = 0
+    rows = 0
+    chunks = 0
+    for row in ds:
+        if config.max_rows and rows >= config.max_rows:
+            break
+        rows += 1
+        if rows <= skip:
+            continue
+        text = dataset_row_text(dict(row), config.text_fields)
+        for i, chunk in enumerate(split_text_stream([text]) if text else []):
+            documents.append((chunk, {"source": source, "row": str(rows - 1), "chunk": i}))
+        pending_rows += 1
+        if len(documents) >= KB_SEGMENT_ROWS:
+            batch_chunks = ingest_documents(documents)
+            chunks += batch_chunks
+            if job is not None:
+                job.checkpoint(rows=pending_rows, chunks=batch_chunks)
+            documents = []
+            pending_rows = 0
+    batch_chunks = ingest_documents(documents)
+    chunks += batch_chunks
+    if job is not None:
+        job.checkpoint(rows=pending_rows, chunks=batch_chunks)
+    elapsed = time.perf_counter() - start
+    return {
+        "rows": rows,
+        "chunks": chunks,
+        "elapsed": round(elapsed, 3),
+        "rowsPerSecond": round((rows - skip) / elapsed, 2) if elapsed > 0 else 0.0
+    }
+
+
+async def start_job_scheduler():
+    """启动后台任务调度"""
+    await get_job_scheduler().start()
+
+
+async def stop_job_scheduler():
+    await get_job_scheduler().stop()
+
+
+async def start_kb_watcher():
+    """后台发现知识库新版本并预加载，定期合并分段"""
+    get_knowledge_base().start_watcher()
+
+
+async def stop_kb_watcher():
+    await run_in_threadpool(get_knowledge_base().stop_watcher)
+
+
+async def poll_quote_watchlist():
+    """定时查询关注列表中的股票，行情快照随之写入本地时间序列"""
+    while True:
+        for code in QUOTE_WATCHLIST:
+            try:
+                await asyncio.get_running_loop().run_in_executor(tool_executor, get_quote, code)
+            except Exception as e:
+                print(f"Quote poll failed for {code}: {e}")
+        await asyncio.sleep(QUOTE_POLL_INTERVAL)
+
+
+_quote_poll_task = None
+
+
+async def start_quote_poll():
+    global _quote_poll_task
+    if QUOTE_WATCHLIST:
+        _quote_poll_task = asyncio.create_task(poll_quote_watchlist())
+
+
+async def stop_quote_poll():
+    if _quote_poll_task is not None:
+        _quote_poll_task.cancel()
+
+
+# 外部HTTP调用配置
+MAIRUI_API_KEY = os.getenv("MAIRUI_API_KEY", "00F373EB-1FC8-4F31-A34C-F496BA4B87C2")
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "20"))
+# (连接超时, 读取超时)
+HTTP_TIMEOUT = (float(os.getenv("HTTP_CONNECT_TIMEOUT", "3")), float(os.getenv("HTTP_READ_TIMEOUT", "10")))
+MAIRUI_QUOTE_TTL = float(os.getenv("MAIRUI_QUOTE_TTL", "5"))
+MAIRUI_BATCH_MAX = 20
+QUOTE_STORE_DIR = os.getenv("QUOTE_STORE_DIR", os.path.join(KB_DIR, "quotes"))
+QUOTE_WATCHLIST = [code for code in re.split(r"[,，\s]+", os.getenv("QUOTE_WATCHLIST", "")) if code]
+QUOTE_POLL_INTERVAL = float(os.getenv("QUOTE_POLL_INTERVAL", "60"))
+QUOTE_HISTORY_MAX_BARS = int(os.getenv("QUOTE_HISTORY_MAX_BARS", "2000"))
+# mairui_history工具返回给Agent的K线根数
+QUOTE_TOOL_BARS = 30
+TAVILY_API_KEY = os.getenv("TAVILY_API_KEY", "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")
+TAVILY_MAX_RESULTS = 3
+TAVILY_CACHE_TTL = float(os.getenv("TAVILY_CACHE_TTL", "300"))
+
+
+class TTLCache:
+    """线程安全的TTL + LRU缓存
+
+    同一个键的并发加载合并为一次（single-flight），其余调用方等待同一结果。
+    """
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get_or_load(self, key, loader, cacheable=None):
+        """命中则直接返回，否则调用loader；cacheable(value)为False的结果不缓存"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._inflight[key] = future
+                self.misses += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            return future.result()
+
+        try:
+            value = loader()
+        except BaseException as e:
+            with self._lock:
+                self._inflight.pop(key, None)
+            future.set_exception(e)
+            raise
+        with self._lock:
+            self._inflight.pop(key, None)
+            if cacheable is None or cacheable(value):
+                self._data[key] = (time.monotonic() + self.ttl, value)
+                self._data.move_to_end(key)
+                while len(self._data) > self.max_entries:
+                    self._data.popitem(last=False)
+        future.set_result(value)
+        return value
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses + self.coalesced
+            return {
+                "entries": len(self._data),
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "hit_ratio": round((self.hits + self.coalesced) / lookups, 4) if lookups else 0.0,
+            }
+
+
+def create_http_session():
+    """创建带keep-alive连接池的共享会话"""
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+
+def get_http_session():
+    """首次调用外部API时创建共享会话"""
+    global _http_session
+    if _http_session is None:
+        with _http_session_lock:
+            if _http_session is None:
+                _http_session = create_http_session()
+    return _http_session
+
+
+QUOTE_CODE_PATTERN = re.compile(r"^[0-9A-Za-z]{1,16}$")
+QUOTE_INTERVAL_PATTERN = re.compile(r"^(\d+)([smhd])$")
+QUOTE_INTERVAL_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+# 列名 -> (文件后缀, dtype, 美瑞API字段)
+QUOTE_COLUMNS = {
+    "time": ("i8", "int64", "t"),
+    "price": ("f8", "float64", "p"),
+    "open": ("f8", "float64", "o"),
+    "high": ("f8", "float64", "h"),
+    "low": ("f8", "float64", "l"),
+    "prev_close": ("f8", "float64", "yc"),
+    "volume": ("f8", "float64", "v"),
+    "amount": ("f8", "float64", "cje"),
+}
+
+
+def parse_quote_interval(interval: str) -> int:
+    """把5m、1h、1d这样的区间解析为秒数"""
+    match = QUOTE_INTERVAL_PATTERN.match(interval.strip().lower())
+    if not match or int(match.group(1)) == 0:
+        raise ValueError(f"不支持的区间: {interval}，格式如30s、5m、1h、1d")
+    return int(match.group(1)) * QUOTE_INTERVAL_UNITS[match.group(2)]
+
+
+def parse_quote_time(value: str) -> int:
+    """把'YYYY-MM-DD[ HH:MM[:SS]]'解析为挂钟秒数（按UTC计数的本地时间，日线边界即本地零点）"""
+    import numpy as np
+    return int(np.datetime64(value.strip().replace(" ", "T"), 's').astype(np.int64))
+
+
+def format_quote_times(seconds: np.ndarray) -> List[str]:
+    import numpy as np
+    return np.char.replace(np.datetime_as_string(seconds.astype('datetime64[s]')), "T", " ").tolist()
+
+
+def interval_deltas(cumulative: np.ndarray, times: np.ndarray, previous: Optional[tuple] = None) -> np.ndarray:
+    """把当日累计量（成交量、成交额）换算为相邻快照之间的增量
+
+    跨日或累计值回落时从新的累计值重新开始；previous为区间前一个快照的(时间, 累计值)。
+    """
+    import numpy as np
+    days = times // 86400
+    prev_values = np.empty_like(cumulative)
+    prev_days = np.empty_like(days)
+    prev_values[1:] = cumulative[:-1]
+    prev_days[1:] = days[:-1]
+    if previous is None:
+        prev_days[0], prev_values[0] = -1, 0.0
+    else:
+        prev_days[0], prev_values[0] = previous[0] // 86400, previous[1]
+    deltas = cumulative - prev_values
+    restart = (days != prev_days) | (deltas < 0)
+    deltas[restart] = cumulative[restart]
+    return deltas
+
+
+def resample_ohlc(times: np.ndarray, prices: np.ndarray, volumes: np.ndarray, amounts: np.ndarray,
+                  interval: int) -> dict:
+    """按区间把价格快照聚合为OHLC，成交量和成交额为区间内增量之和
+
+    times必须递增；每个区间的边界用一次diff找出，各列用reduceat一次聚合完。
+    """
+    import numpy as np
+    buckets = times // interval * interval
+    if len(times) == 0:
+        empty = prices[:0]
+        return {"time": buckets, "open": empty, "high": empty, "low": empty, "close": empty,
+                "volume": empty, "amount": empty, "samples": np.zeros(0, dtype=np.int64)}
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(buckets)) + 1))
+    ends = np.append(starts[1:], len(times))
+    return {
+        "time": buckets[starts],
+        "open": prices[starts],
+        "high": np.maximum.reduceat(prices, starts),
+        "low": np.minimum.reduceat(prices, starts),
+        "close": prices[ends - 1],
+        "volume": np.add.reduceat(volumes, starts),
+        "amount": np.add.reduceat(amounts, starts),
+        "samples": ends - starts,
+    }
+
+
+class QuoteStore:
+    """本地行情时间序列，每只股票一个目录，每列一个只追加的二进制文件
+
+    每次从美瑞API取到的快照追加一行，更新时间不晚于上一行的快照（行情未变化）跳过。
+    读取时按列内存映射，用二分查找定位时间范围，只触及范围内的数据。
+    各列长度不一致（追加中途崩溃）时以最短的列为准，下次追加前截齐。
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self._lock = FileLock(os.path.join(root, ".lock"))
+        self._last_time = {}
+        self.appends = 0
+        self.unchanged = 0
+
+    def _path(self, code: str, column: str) -> str:
+        return os.path.join(self.root, code, f"{column}.{QUOTE_COLUMNS[column][0]}")
+
+    def _rows(self, code: str) -> int:
+        import numpy as np
+        sizes = []
+        for column, (_, dtype, _) in QUOTE_COLUMNS.items():
+            try:
+                sizes.append(os.path.getsize(self._path(code, column)) // np.dtype(dtype).itemsize)
+            except FileNotFoundError:
+                return 0
+        return min(sizes)
+
+    def _column(self, code: str, column: str, rows: int) -> np.ndarray:
+        import numpy as np
+        if rows == 0:
+            return np.empty(0, dtype=QUOTE_COLUMNS[column][1])
+        return np.memmap(self._path(code, column), dtype=QUOTE_COLUMNS[column][1], mode='r', shape=(rows,))
+
+    def append(self, code: str, data: dict) -> bool:
+        """追加一条美瑞API原始快照，返回是否写入"""
+        import numpy as np
+        if not QUOTE_CODE_PATTERN.match(code):
+            return False
+        try:
+            row = {"time": parse_quote_time(str(data["t"]))}
+        except (KeyError, ValueError):
+            row = {"time": parse_quote_time(datetime.now().strftime('%Y-%m-%d %H:%M:%S'))}
+        for column, (_, _, field) in QUOTE_COLUMNS.items():
+            if column != "time":
+                try:
+                    row[column] = float(data.get(field))
+                except (TypeError, ValueError):
+                    row[column] = math.nan
+        if not row["price"] > 0:
+            return False
+        with self._lock:
+            last = self._last_time.get(code)
+            if last is None:
+                rows = self._rows(code)
+                self._repair(code, rows)
+                last = int(self._column(code, "time", rows)[-1]) if rows else None
+            if last is not None and row["time"] <= last:
+                self.unchanged += 1
+                return False
+            os.makedirs(os.path.join(self.root, code), exist_ok=True)
+            for column, (_, dtype, _) in QUOTE_COLUMNS.items():
+                with open(self._path(code, column), 'ab') as f:
+                    f.write(np.asarray([row[column]], dtype=dtype).tobytes())
+            self._last_time[code] = row["time"]
+            self.appends += 1
+        return True
+
+    def _repair(self, code: str, rows: int):
+        import numpy as np
+        for column, (_, dtype, _) in QUOTE_COLUMNS.items():
+            path = self._path(code, column)
+            if os.path.exists(path) and os.path.getsize(path) > rows * np.dtype(dtype).itemsize:
+                os.truncate(path, rows * np.dtype(dtype).itemsize)
+
+    def history(self, code: str, interval: int, start: Optional[int] = None, end: Optional[int] = None,
+                limit: int = 0) -> Optional[dict]:
+        """返回[start, end]内按interval秒聚合的K线（列式），limit>0时只保留最后limit根；没有记录时为None"""
+        import numpy as np
+        rows = self._rows(code) if QUOTE_CODE_PATTERN.match(code) else 0
+        if rows == 0:
+            return None
+        times = self._column(code, "time", rows)
+        lo = 0 if start is None else int(np.searchsorted(times, start, side='left'))
+        hi = rows if end is None else int(np.searchsorted(times, end, side='right'))
+        if limit <= 0 or hi <= lo:
+            return self._aggregate(code, rows, times, lo, hi, interval)
+        # 只需最后limit根时从末尾的limit个区间开始聚合；休市、停牌等空档使K线不够时按已得根数的比例扩大时间窗口，
+        # 剩余部分不比已聚合的多时直接聚合到lo
+        last_bucket = int(times[hi - 1]) // interval * interval
+        span = limit
+        while True:
+            first = max(lo, int(np.searchsorted(times, last_bucket - (span - 1) * interval, side='left')))
+            if first - lo < hi - first:
+                first = lo
+            bars = self._aggregate(code, rows, times, first, hi, interval)
+            count = len(bars["time"])
+            if count >= limit or first == lo:
+                return {name: values[-limit:] for name, values in bars.items()}
+            span *= max(2, math.ceil(limit * 1.2 / max(count, 1)))
+
+    def _aggregate(self, code: str, rows: int, times: np.ndarray, lo: int, hi: int, interval: int) -> dict:
+        import numpy as np
+        window = np.asarray(times[lo:hi])
+        columns = {"price": np.asarray(self._column(code, "price", rows)[lo:hi])}
+        for column in ("volume", "amount"):
+            values = self._column(code, column, rows)
+            # 区间前一个快照用于计算第一个快照的增量
+            previous = (int(times[lo - 1]), float(np.nan_to_num(values[lo - 1]))) if lo > 0 else None
+            columns[column] = interval_deltas(np.nan_to_num(values[lo:hi]), window, previous)
+        return resample_ohlc(window, columns["price"], columns["volume"], columns["amount"], interval)
+
+    def stats(self) -> dict:
+        symbols = [name for name in os.listdir(self.root) if QUOTE_CODE_PATTERN.match(name)]
+        return {
+            "symbols": len(symbols),
+            "rows": sum(self._rows(code) for code in symbols),
+            "appends": self.appends,
+            "unchanged": self.unchanged,
+        }
+
+
+def quote_bars_json(bars: dict) -> List[dict]:
+    """列式K线转为逐根的JSON对象"""
+    columns = {name: values.tolist() for name, values in bars.items() if name != "time"}
+    columns["time"] = format_quote_times(bars["time"])
+    names = ["time", "open", "high", "low", "close", "volume", "amount", "samples"]
+    return [dict(zip(names, values)) for values in zip(*(columns[name] for name in names))]
+
+
+get_quote_store = lazy_singleton(lambda: QuoteStore(QUOTE_STORE_DIR))
+
+
+quote_cache = TTLCache(MAIRUI_QUOTE_TTL, 1024)
+tool_executor = ThreadPoolExecutor(max_workers=HTTP_POOL_SIZE, thread_name_prefix="tool")
+
+
+def fetch_mairui_quote(code: str) -> dict:
+    """通过共享连接池请求美瑞API获取一只股票的实时行情"""
+    import requests
+    url = f"http://api.mairui.club/hsrl/ssjy/{code}/{MAIRUI_API_KEY}"
+    try:
+        response = get_http_session().get(url, timeout=HTTP_TIMEOUT)
+        result = response.json()
+
+        if not isinstance(result, dict):
+            return {"error": "API返回格式错误"}
+
+        if result.get('msg') == 'ok' and result.get('data'):
+            data = result['data']
+            try:
+                get_quote_store().append(code, data)
+            except OSError as e:
+                print(f"Quote store append failed: {e}")
+            return {
+                "股票名称": data.get('name', '未知'),
+                "当前价格": f"{data.get('p', 0)}元",
+                "涨跌幅": f"{data.get('pc', 0)}%",
+                "涨跌额": f"{data.get('ud', 0)}元",
+                "成交量": f"{data.get('v', 0)}手",
+                "成交额": f"{data.get('cje', 0)}元",
+                "振幅": f"{data.get('zf', 0)}%",
+                "最高": f"{data.get('h', 0)}元",
+                "最低": f"{data.get('l', 0)}元",
+                "今开": f"{data.get('o', 0)}元",
+                "昨收": f"{data.get('yc', 0)}元",
+                "量比": f"{data.get('lb', 0)}",
+                "换手率": f"{data.get('hs', 0)}%",
+                "市盈率": data.get('pe', 0),
+                "总市值": f"{data.get('sz', 0)}元",
+                "流通市值": f"{data.get('lt', 0)}元",
+                "涨速": f"{data.get('zs', 0)}%",
+                "60日涨跌幅": f"{data.get('zdf60', 0)}%",
+                "年初至今涨跌幅": f"{data.get('zdfnc', 0)}%",
+                "更新时间": data.get('t', datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+            }
+        return {"error": "获取数据失败，API返回错误"}
+
+    except requests.RequestException as e:
+        return {"error": f"网络请求失败: {str(e)}"}
+    except json.JSONDecodeError as e:
+        return {"error": f"数据解析失败: {str(e)}"}
+    except Exception as e:
+        return {"error": f"未知错误: {str(e)}"}
+
+
+search_cache = TTLCache(TAVILY_CACHE_TTL, 512)
+# 复用的Tavily客户端，测试时可替换为本地桩对象
+_tavily_client = None
+
+
+def get_tavily_client():
+    """延迟创建并复用Tavily客户端"""
+    global _tavily_client
+    if _tavily_client is None:
+        from tavily import TavilyClient
+        _tavily_client = TavilyClient(api_key=TAVILY_API_KEY)
+    return _tavily_client
+
+
+def cached_search(query: str, max_results: int = TAVILY_MAX_RESULTS) -> dict:
+    """按(规范化查询, max_results)缓存搜索结果，并发的相同查询只请求一次上游"""
+    query = normalize_text(query)
+    return search_cache.get_or_load(
+        (query.lower(), max_results),
+        lambda: get_tavily_client().search(query, max_results=max_results)
+    )
+
+
+def get_quote(code: str) -> dict:
+    """带TTL缓存的行情查询，并发查询同一代码只请求一次上游"""
+    code = code.strip().strip('"\'')
+    return quote_cache.get_or_load(code, lambda: fetch_mairui_quote(code), cacheable=lambda r: "error" not in r)
+
+
+# 当前Agent运行的取消标记，运行被取消后尚未开始的工具调用直接放弃
+run_cancel_event = contextvars.ContextVar("run_cancel_event", default=None)
+
+
+class RunCancelled(Exception):
+    """Agent运行已取消"""
+
+
+def check_cancelled(tool_name: str):
+    event = run_cancel_event.get()
+    if event is not None and event.is_set():
+        TOOL_CALLS_SKIPPED.inc(tool=tool_name)
+        raise RunCancelled(f"运行已取消，跳过{tool_name}")
+
+
+def note_abandoned(tool_name: str, event: Optional[threading.Event]):
+    """工具返回时运行已取消，结果不会被使用（已写入共享缓存的部分仍可复用）"""
+    if event is not None and event.is_set():
+        ABANDONED_TOOL_RESULTS.inc(tool=tool_name)
+
+
+# 定义工具
+@tool("knowledge_base_search")
+def knowledge_base_search(query: str) -> dict:
+    """检索本地知识库中与问题相关的文档片段.
+    query: 检索问题
+    """
+    check_cancelled("knowledge_base_search")
+    knowledge_base = get_knowledge_base()
+    if knowledge_base.count == 0:
+        return {"error": "知识库为空，请先上传文档"}
+    try:
+        query_vector = embed_texts([query])[0]
+    except Exception as e:
+        # 向量化模型不可用时仍可按关键词检索
+        print(f"Query embedding failed, using BM25 only: {e}")
+        query_vector = None
+    try:
+        results = knowledge_base.hybrid_search(query, query_vector, KB_TOP_K)
+    except Exception as e:
+        return {"error": f"知识库检索失败: {str(e)}"}
+    note_abandoned("knowledge_base_search", run_cancel_event.get())
+    return {
+        "results": [
+            {"来源": item.get("source", "未知"), "内容": item["text"], "相似度": item["score"], "关键词得分": item["bm25"]}
+            for item in results
+        ]
+    }
+
+
+@tool("tavily_search")
+def tavily_search(query: str) -> dict:
+    """使用Tavily搜索引擎搜索信息.
+    query: 搜索查询词
+    """
+    check_cancelled("tavily_search")
+    result = cached_search(query, TAVILY_MAX_RESULTS)
+    note_abandoned("tavily_search", run_cancel_event.get())
+    return result
+
+
+@tool("mairui")
+def mairui_api(code: str) -> dict:
+    """查询股票实时行情.
+    code: 股票代码(如000001)
+    字段说明：
+    fm: 五分钟涨跌幅（%）
+    h: 最高价（元）
+    hs: 换手（%）
+    lb: 量比（%）
+    l: 最低价（元）
+    lt: 流通市值（元）
+    o: 开盘价（元）
+    pe: 市盈率
+    pc: 涨跌幅（%）
+    p: 当前价格（元）
+    sz: 总市值（元）
+    cje: 成交额（元）
+    ud: 涨跌额（元）
+    v: 成交量（手）
+    yc: 昨日收盘价（元）
+    zf: 振幅（%）
+    zs: 涨速（%）
+    """
+    check_cancelled("mairui")
+    result = get_quote(code)
+    note_abandoned("mairui", run_cancel_event.get())
+    return result
+
+
+@tool("mairui_batch")
+def mairui_batch(codes: str) -> dict:
+    """批量查询多只股票实时行情，并发请求.
+    codes: 以逗号分隔的股票代码(如600519,000001)，字段含义同mairui工具
+    """
+    code_list = list(dict.fromkeys(c for c in re.split(r"[,，\s]+", codes) if c))[:MAIRUI_BATCH_MAX]
+    if not code_list:
+        return {"error": "未提供股票代码"}
+    check_cancelled("mairui_batch")
+    # 线程池中的任务拿不到contextvar，取消标记通过闭包传入
+    event = run_cancel_event.get()
+
+    def load(code: str) -> dict:
+        if event is not None and event.is_set():
+            TOOL_CALLS_SKIPPED.inc(tool="mairui_batch")
+            return {"error": "运行已取消"}
+        return get_quote(code)
+
+    result = dict(zip(code_list, tool_executor.map(load, code_list)))
+    note_abandoned("mairui_batch", event)
+    return result
+
+
+@tool("mairui_history")
+def mairui_history(query: str) -> dict:
+    """查询本地记录的股票历史行情K线（不请求上游），只有查询过实时行情或在关注列表中的股票才有记录.
+    query: 股票代码和K线周期，以逗号分隔(如600519,5m)，周期可用30s、5m、1h、1d，默认5m
+    """
+    check_cancelled("mairui_history")
+    parts = [p for p in re.split(r"[,，\s]+", query.strip().strip('"\'')) if p]
+    if not parts:
+        return {"error": "未提供股票代码"}
+    try:
+        interval = parse_quote_interval(parts[1] if len(parts) > 1 else "5m")
+    except ValueError as e:
+        return {"error": str(e)}
+    bars = get_quote_store().history(parts[0], interval, limit=QUOTE_TOOL_BARS)
+    if bars is None:
+        return {"error": f"本地没有{parts[0]}的历史行情，请先使用mairui工具查询实时行情"}
+    return {"代码": parts[0], "周期": parts[1] if len(parts) > 1 else "5m", "K线": quote_bars_json(bars)}
+
+
+FINAL_ANSWER_MARKER = "Final Answer:"
+
+
+class QueueCallback(AsyncCallbackHandler):
+    """自定义回调处理器，队列满时等待消费端（背压）
+
+    final_only为True时只转发每次LLM输出中"Final Answer:"之后的token，
+    被过滤的推理token改为发送空字符串心跳，避免推理较长时被判为空闲超时。
+    """
+
+    def __init__(self, q: asyncio.Queue, final_only: bool = False):
+        self.q = q
+        self.final_only = final_only
+        self.final_streamed = False
+        self._in_final = False
+        self._tail = ""
+        self._last_heartbeat = 0.0
+
+    async def on_llm_start(self, serialized: dict, prompts: List[str], **kwargs: Any) -> None:
+        # 每轮ReAct迭代都是一次新的LLM调用，重新检测标记
+        self._in_final = False
+        self._tail = ""
+
+    async def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        if not self.final_only:
+            await self.q.put(token)
+            return
+        if self._in_final:
+            await self._put_final(token)
+            return
+        # 标记可能被拆分在多个token中，保留末尾不足一个标记长度的文本
+        text = self._tail + token
+        idx = text.find(FINAL_ANSWER_MARKER)
+        if idx >= 0:
+            self._in_final = True
+            self._tail = ""
+            await self._put_final(text[idx + len(FINAL_ANSWER_MARKER):])
+        else:
+            self._tail = text[-(len(FINAL_ANSWER_MARKER) - 1):]
+            self._heartbeat()
+
+    def _heartbeat(self) -> None:
+        now = time.monotonic()
+        if now - self._last_heartbeat < STREAM_HEARTBEAT_INTERVAL or self.q.full():
+            return
+        self._last_heartbeat = now
+        self.q.put_nowait("")
+
+    async def _put_final(self, text: str) -> None:
+        if not self.final_streamed:
+            text = text.lstrip()
+            if not text:
+                return
+            self.final_streamed = True
+        await self.q.put(text)
+
+
+# 监控指标配置
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TOKEN_BUCKETS = (8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096)
+ITERATION_BUCKETS = (1, 2, 3, 4, 5, 6, 8, 10)
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(KB_DIR, "profiles"))
+
+
+def format_labels(names, values) -> str:
+    if not names:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, escaped)) + "}"
+
+
+class Counter:
+    """单调递增计数器"""
+
+    def __init__(self, name: str, help_text: str, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    """累计分桶直方图"""
+
+    def __init__(self, name: str, help_text: str, buckets, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        names = self.labelnames + ("le",)
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                for bound, n in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{format_labels(names, key + (bound,))} {n}")
+                lines.append(f"{self.name}_bucket{format_labels(names, key + ('+Inf',))} {count}")
+                lines.append(f"{self.name}_sum{format_labels(self.labelnames, key)} {total}")
+                lines.append(f"{self.name}_count{format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class CallbackMetric:
+    """抓取时从现有统计中读取的指标，fn返回{标签值元组: 数值}"""
+
+    def __init__(self, name: str, help_text: str, kind: str, fn, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.kind = kind
+        self.fn = fn
+        self.labelnames = tuple(labelnames)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        try:
+            values = self.fn()
+        except Exception as e:
+            print(f"Metric {self.name} collection failed: {e}")
+            return lines
+        for key, value in sorted(values.items()):
+            lines.append(f"{self.name}{format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class MetricsRegistry:
+    """最小的Prometheus文本格式指标注册表"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help_text: str, labelnames=()) -> Counter:
+        return self.register(Counter(name, help_text, labelnames))
+
+    def histogram(self, name: str, help_text: str, buckets=LATENCY_BUCKETS, labelnames=()) -> Histogram:
+        return self.register(Histogram(name, help_text, buckets, labelnames))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+CHAT_REQUESTS = metrics.counter("rag_chat_requests_total", "聊天请求数", ["outcome"])
+CHAT_DURATION = metrics.histogram("rag_chat_request_seconds", "聊天请求总耗时")
+CHAT_FIRST_BYTE = metrics.histogram("rag_chat_first_byte_seconds", "聊天请求首个输出块耗时")
+LLM_FIRST_TOKEN = metrics.histogram("rag_llm_first_token_seconds", "LLM调用开始到首个token的耗时")
+LLM_GENERATION = metrics.histogram("rag_llm_generation_seconds", "单次LLM调用耗时")
+LLM_TOKENS = metrics.histogram("rag_llm_tokens", "单次LLM调用输出的token数", TOKEN_BUCKETS)
+LLM_TOKENS_TOTAL = metrics.counter("rag_llm_tokens_total", "LLM输出的token总数")
+LLM_ERRORS = metrics.counter("rag_llm_errors_total", "LLM调用失败次数")
+TOOL_DURATION = metrics.histogram("rag_tool_seconds", "工具调用耗时", labelnames=["tool", "status"])
+TOOL_ERRORS = metrics.counter("rag_tool_errors_total", "工具调用失败次数", ["tool"])
+AGENT_ITERATIONS = metrics.histogram("rag_agent_iterations", "每次请求的ReAct迭代次数", ITERATION_BUCKETS)
+AGENT_ITERATIONS_TOTAL = metrics.counter("rag_agent_iterations_total", "ReAct迭代总数")
+AGENT_PARSE_ERRORS = metrics.counter("rag_agent_parse_errors_total", "LLM输出无法解析的次数")
+CANCELLED_RUNS = metrics.counter("rag_cancelled_runs_total", "被取消的Agent运行", ["reason"])
+CANCELLED_RUN_SECONDS = metrics.histogram("rag_cancelled_run_seconds", "被取消的Agent运行已执行的时间")
+CANCELLED_LLM_CALLS = metrics.counter("rag_cancelled_llm_calls_total", "取消时正在生成的LLM调用", ["reason"])
+CANCELLED_TOOL_CALLS = metrics.counter("rag_cancelled_tool_calls_total", "取消时正在执行的工具调用", ["reason"])
+CANCELLED_TOKENS = metrics.counter("rag_cancelled_tokens_total", "被取消的运行中已生成、不会被读取的token")
+POST_CANCEL_TOKENS = metrics.counter("rag_post_cancel_tokens_total", "取消之后仍然收到的token（应接近0）")
+TOOL_CALLS_SKIPPED = metrics.counter("rag_tool_calls_skipped_total", "因运行已取消而未执行的工具调用", ["tool"])
+ABANDONED_TOOL_RESULTS = metrics.counter("rag_abandoned_tool_results_total", "运行取消后才完成、结果被丢弃的工具调用", ["tool"])
+metrics.register(CallbackMetric(
+    "rag_agent_pool_agents", "Agent池占用", "gauge",
+    lambda: {(state,): agent_pool.stats()[state] for state in ("in_use", "idle", "waiting")},
+    ["state"],
+))
+def embedding_cache_hits() -> int:
+    embedding_cache = get_embedding_cache()
+    return embedding_cache.memory_hits + embedding_cache.disk_hits
+
+
+metrics.register(CallbackMetric(
+    "rag_cache_hits_total", "各缓存命中次数", "counter",
+    lambda: {
+        ("answer",): answer_cache.exact_hits + answer_cache.semantic_hits,
+        ("embedding",): embedding_cache_hits(),
+        ("mairui",): quote_cache.hits,
+        ("tavily_search",): search_cache.hits,
+        ("render",): render_cache.hits,
+    },
+    ["cache"],
+))
+
+
+class TracingCallback(AsyncCallbackHandler):
+    """记录单次请求各阶段耗时的回调，与QueueCallback一起通过config传入"""
+
+    def __init__(self):
+        self._llm = {}
+        self._tools = {}
+        self.iterations = 0
+        self.parse_errors = 0
+        self.tokens = 0
+        self.cancelled = False
+
+    def record_cancel(self, reason: str, elapsed: float):
+        """取消运行时记录正在进行、将被丢弃的工作"""
+        self.cancelled = True
+        CANCELLED_RUNS.inc(reason=reason)
+        CANCELLED_RUN_SECONDS.observe(elapsed)
+        CANCELLED_LLM_CALLS.inc(len(self._llm), reason=reason)
+        CANCELLED_TOOL_CALLS.inc(len(self._tools), reason=reason)
+        CANCELLED_TOKENS.inc(self.tokens)
+
+    async def on_llm_start(self, serialized: dict, prompts: List[str], **kwargs: Any) -> None:
+        self.iterations += 1
+        AGENT_ITERATIONS_TOTAL.inc()
+        self._llm[kwargs.get("run_id")] = {"start": time.perf_counter(), "tokens": 0}
+
+    async def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        state = self._llm.get(kwargs.get("run_id"))
+        if state is None:
+            return
+        if self.cancelled:
+            POST_CANCEL_TOKENS.inc()
+            return
+        if state["tokens"] == 0:
+            LLM_FIRST_TOKEN.observe(time.perf_counter() - state["start"])
+        state["tokens"] += 1
+        self.tokens += 1
+
+    async def on_llm_end(self, response, **kwargs: Any) -> None:
+        state = self._llm.pop(kwargs.get("run_id"), None)
+        if state is None:
+            return
+        LLM_GENERATION.observe(time.perf_counter() - state["start"])
+        tokens = state["tokens"]
+        if not tokens:
+            # 非流式调用时使用模型报告的输出token数
+            try:
+                tokens = (response.generations[0][0].generation_info or {}).get("eval_count", 0)
+            except (IndexError, AttributeError):
+                tokens = 0
+        LLM_TOKENS.observe(tokens)
+        LLM_TOKENS_TOTAL.inc(tokens)
+
+    async def on_llm_error(self, error: BaseException, **kwargs: Any) -> None:
+        self._llm.pop(kwargs.get("run_id"), None)
+        if not isinstance(error, asyncio.CancelledError):
+            LLM_ERRORS.inc()
+
+    async def on_tool_start(self, serialized: dict, input_str: str, **kwargs: Any) -> None:
+        name = (serialized or {}).get("name") or kwargs.get("name") or "unknown"
+        # handle_parsing_errors时解析失败以_Exception工具的形式出现
+        if name == "_Exception":
+            self.parse_errors += 1
+            AGENT_PARSE_ERRORS.inc()
+        self._tools[kwargs.get("run_id")] = (name, time.perf_counter())
+
+    async def on_tool_end(self, output: Any, **kwargs: Any) -> None:
+        entry = self._tools.pop(kwargs.get("run_id"), None)
+        if entry is not None:
+            TOOL_DURATION.observe(time.perf_counter() - entry[1], tool=entry[0], status="ok")
+
+    async def on_tool_error(self, error: BaseException, **kwargs: Any) -> None:
+        entry = self._tools.pop(kwargs.get("run_id"), None)
+        if entry is not None:
+            TOOL_DURATION.observe(time.perf_counter() - entry[1], tool=entry[0], status="error")
+            TOOL_ERRORS.inc(tool=entry[0])
+
+    def finish(self):
+        """请求结束时记录迭代次数"""
+        if self.iterations:
+            AGENT_ITERATIONS.observe(self.iterations)
+
+
+class SamplingProfiler:
+    """按占空比对事件循环线程进行cProfile采样，累计结果可导出
+
+    每隔interval秒开启window秒，只覆盖事件循环线程（Agent流式输出、回调和响应合并），
+    线程池中的工具调用不在采样范围内。
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.window = 1.0
+        self.interval = 10.0
+        self.samples = 0
+        self._stats = None
+        self._task = None
+
+    def start(self, window: float, interval: float):
+        self.window = window
+        self.interval = max(interval, window)
+        self.enabled = True
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self):
+        self.enabled = False
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        import cProfile
+        import pstats
+        while self.enabled:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError as e:
+                # 已有其他profiler在运行
+                print(f"Profiler unavailable: {e}")
+                self.enabled = False
+                return
+            try:
+                await asyncio.sleep(self.window)
+            finally:
+                profiler.disable()
+            if self._stats is None:
+                self._stats = pstats.Stats(profiler)
+            else:
+                self._stats.add(profiler)
+            self.samples += 1
+            await asyncio.sleep(self.interval - self.window)
+
+    def dump(self, limit: int, sort: str) -> dict:
+        """写出.prof文件并返回按sort排序的前limit个函数"""
+        if self._stats is None:
+            return {"samples": 0, "path": None, "report": ""}
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}.prof")
+        self._stats.dump_stats(path)
+        out = io.StringIO()
+        self._stats.stream = out
+        self._stats.sort_stats(sort).print_stats(limit)
+        return {"samples": self.samples, "path": path, "report": out.getvalue()}
+
+    def reset(self):
+        self._stats = None
+        self.samples = 0
+
+
+sampling_profiler = SamplingProfiler()
+
+
+class ProfilingRequest(BaseModel):
+    enabled: bool
+    window: float = 1.0
+    interval: float = 10.0
+
+
+def require_admin(http_request: Request):
+    """管理接口需要请求头X-Admin-Token与环境变量ADMIN_TOKEN一致"""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="未配置ADMIN_TOKEN，管理接口已禁用")
+    if http_request.headers.get("x-admin-token", "") != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="管理令牌无效")
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Prometheus指标"""
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.post("/api/admin/profiling")
+async def set_profiling(request: ProfilingRequest, http_request: Request):
+    """开启或关闭采样profiling"""
+    require_admin(http_request)
+    if request.window <= 0:
+        raise HTTPException(status_code=400, detail="window必须大于0")
+    if request.enabled:
+        sampling_profiler.start(request.window, request.interval)
+    else:
+        sampling_profiler.stop()
+    return {"success": True, "enabled": sampling_profiler.enabled, "samples": sampling_profiler.samples}
+
+@app.get("/api/admin/profiling/dump")
+async def dump_profiling(http_request: Request, limit: int = 30, sort: str = "cumulative", reset: bool = False):
+    """导出累计的采样结果"""
+    require_admin(http_request)
+    try:
+        result = sampling_profiler.dump(limit, sort)
+    except KeyError:
+        raise HTTPException(status_code=400, detail=f"不支持的排序方式: {sort}")
+    if reset:
+        sampling_profiler.reset()
+    return result
+
+
+# 工具执行配置
+AGENT_PARALLEL_TOOLS = os.getenv("AGENT_PARALLEL_TOOLS", "1") == "1"
+# 一次Agent运行内的工具结果备忘录，由create_streaming_response为每次运行设置，批量请求内的各运行共享同一个
+tool_run_memo = contextvars.ContextVar("tool_run_memo", default=None)
+tool_memo_stats = {"calls": 0, "memo_hits": 0}
+# 一组Action/Action Input，输入截止到下一个Thought或Action
+MULTI_ACTION_PATTERN = re.compile(
+    r"Action\s*\d*\s*:[\s]*(.*?)\n\s*Action\s*\d*\s*Input\s*\d*\s*:[ \t]*(.*?)"
+    r"(?=\n\s*(?:Thought\s*:|Action\s*\d*\s*:)|$)",
+    re.DOTALL,
+)
+
+
+def tool_memo_key(agent_action: AgentAction) -> tuple:
+    tool_input = agent_action.tool_input
+    if isinstance(tool_input, str):
+        tool_input = normalize_text(tool_input)
+    return agent_action.tool, json.dumps(tool_input, sort_keys=True, ensure_ascii=False, default=str)
+
+
+_agent_classes = None
+
+
+def agent_classes():
+    """延迟导入langchain.agents，返回(MultiActionOutputParser, ParallelAgentExecutor)"""
+    global _agent_classes
+    if _agent_classes is not None:
+        return _agent_classes
+    from langchain.agents import AgentExecutor
+    from langchain.agents.output_parsers import ReActSingleInputOutputParser
+
+    class MultiActionOutputParser(ReActSingleInputOutputParser):
+        """允许模型在一次思考中给出多组Action/Action Input，解析为多个AgentAction
+
+        AgentExecutor的异步路径会用asyncio.gather同时执行同一步中的多个动作。
+        """
+
+        def parse(self, text: str):
+            matches = list(MULTI_ACTION_PATTERN.finditer(text))
+            if len(matches) <= 1 or FINAL_ANSWER_MARKER in text:
+                return super().parse(text)
+            actions = []
+            start = 0
+            for match in matches:
+                tool_input = match.group(2).strip().strip('"')
+                # 每个动作只记录自己那一段，拼接scratchpad时不重复
+                actions.append(AgentAction(match.group(1).strip(), tool_input, text[start:match.end()]))
+                start = match.end()
+            return actions
+
+    class ParallelAgentExecutor(AgentExecutor):
+        """同一步的多个工具调用并发执行，相同工具和参数在一次运行内只执行一次"""
+
+        async def _aperform_agent_action(self, name_to_tool_map, color_mapping, agent_action, run_manager=None):
+            memo = tool_run_memo.get()
+            tool_memo_stats["calls"] += 1
+            if memo is None or agent_action.tool not in name_to_tool_map:
+                return await super()._aperform_agent_action(name_to_tool_map, color_mapping, agent_action, run_manager)
+            key = tool_memo_key(agent_action)
+            task = memo.get(key)
+            if task is not None:
+                tool_memo_stats["memo_hits"] += 1
+                # 共享的调用由首个调用方负责，其余调用方取消时不影响它
+                try:
+                    step = await asyncio.shield(task)
+                    return AgentStep(action=agent_action, observation=step.observation)
+                except (asyncio.CancelledError, RunCancelled):
+                    # 批量请求共享备忘录时，首个调用方所在的运行可能先被取消；本运行未取消时自己重新执行
+                    event = run_cancel_event.get()
+                    if not task.done() or (event is not None and event.is_set()):
+                        raise
+            task = asyncio.ensure_future(
+                super()._aperform_agent_action(name_to_tool_map, color_mapping, agent_action, run_manager)
+            )
+            memo[key] = task
+            return await task
+
+    _agent_classes = (MultiActionOutputParser, ParallelAgentExecutor)
+    return _agent_classes
 
 
 def create_agent():
-    """创建Agent"""
-    q = queue.Queue()
-    callback = QueueCallback(q)
+    """创建Agent
 
+    回调不再绑定在LLM上，由每次调用通过config={"callbacks": [...]}传入，
+    因此同一个AgentExecutor可以在请求之间复用。
+    """
     # from vllm import LLM
     # llm = LLM(model="qwen2.5:7b")
 
@@ -575,12 +4337,9 @@ def create_agent():
     # _ = load_dotenv(find_dotenv())
     # llm = ChatOpenAI(model="gpt-4", temperature=0)
     from langchain_ollama import OllamaLLM
-    llm = OllamaLLM(
-        model="qwen2.5:7b",
-        callback_manager=CallbackManager([callback])
-    )
+    llm = OllamaLLM(model=LLM_MODEL, keep_alive=OLLAMA_KEEP_ALIVE)
 
-    tools = [mairui_api, tavily_search]
+    tools = [mairui_api, mairui_batch, mairui_history, tavily_search, knowledge_base_search]
 
     prompt = PromptTemplate.from_template(
         """尽可能简约和准确地使用中文回应如下问题。您可以使用以下工具:
@@ -593,12 +4352,15 @@ Action: 要采取的操作名称（可用工具：{tool_names}）
 Action Input: 要传递给工具的参数
 Observation: 工具返回的结果
 ... (这个思考/行动/观察可以重复多次)
+需要多项互不依赖的数据时（例如同时需要行情和新闻），可以在一次Thought后连续写出多组Action/Action Input，它们会被同时执行
 Thought: 我现在知道最终答案了
 Final Answer: 原始输入问题的最终答案
 
 对于股票查询，你可以：
-1. 使用mairui工具获取股票的实时行情数据
+1. 使用mairui工具获取股票的实时行情数据，需要同时查询多只股票时使用mairui_batch工具（代码以逗号分隔）
+   需要走势时使用mairui_history工具读取本地记录的K线（如600519,1h）
 2. 使用tavily_search工具搜索相关新闻和分析
+3. 使用knowledge_base_search工具检索用户上传到知识库的文档
 
 注意事项：
 - 股票代码必须是6位数字，不要加任何引号或其他字符
@@ -616,8 +4378,14 @@ Thought: {agent_scratchpad}
 提醒！务必使用中文回答，并对数据进行合理的解读和总结。
 """)
 
-    agent = create_react_agent(llm, tools, prompt)
-    agent_executor = AgentExecutor(
+    from langchain.agents import create_react_agent, AgentExecutor
+    if AGENT_PARALLEL_TOOLS:
+        output_parser_class, executor_class = agent_classes()
+        agent = create_react_agent(llm, tools, prompt, output_parser=output_parser_class())
+    else:
+        agent = create_react_agent(llm, tools, prompt)
+        executor_class = AgentExecutor
+    agent_executor = executor_class(
         agent=agent,
         tools=tools,
         verbose=True,
@@ -625,7 +4393,528 @@ Thought: {agent_scratchpad}
         max_iterations=5  # 限制最大迭代次数
     )
 
-    return agent_executor, q
+    return agent_executor
+
+
+# Agent池配置
+LLM_MODEL = os.getenv("LLM_MODEL", "qwen2.5:7b")
+# 模型在Ollama中常驻的秒数（-1为一直常驻），避免空闲后被卸载导致下一次请求冷启动
+OLLAMA_KEEP_ALIVE = int(os.getenv("OLLAMA_KEEP_ALIVE", "1800"))
+AGENT_POOL_SIZE = int(os.getenv("AGENT_POOL_SIZE", "4"))
+AGENT_POOL_TIMEOUT = float(os.getenv("AGENT_POOL_TIMEOUT", "30"))
+
+
+class AgentPoolTimeout(asyncio.TimeoutError):
+    """等待空闲Agent超时"""
+
+
+class AgentPool:
+    """预构建AgentExecutor池，请求借用后归还，避免每条消息重复构建"""
+
+    def __init__(self, size: int, timeout: float):
+        self.size = size
+        self.timeout = timeout
+        self._idle = asyncio.Queue()
+        self._created = 0
+        self._in_use = 0
+        self._waiting = 0
+        self._borrowed = 0
+        self._timeouts = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    async def _try_create(self):
+        """池未满时在线程池中构建一个新的Agent（首次构建会导入重模块），不阻塞事件循环"""
+        if self._created >= self.size:
+            return None
+        self._created += 1
+        try:
+            return await run_in_threadpool(create_agent)
+        except BaseException:
+            self._created -= 1
+            raise
+
+    async def warm(self):
+        """启动时预热，构建满池的Agent"""
+        while True:
+            agent_executor = await self._try_create()
+            if agent_executor is None:
+                break
+            self._idle.put_nowait(agent_executor)
+
+    @asynccontextmanager
+    async def borrow(self):
+        """借用一个Agent，超时抛出AgentPoolTimeout"""
+        start = time.perf_counter()
+        self._waiting += 1
+        try:
+            try:
+                agent_executor = self._idle.get_nowait()
+            except asyncio.QueueEmpty:
+                agent_executor = await self._try_create()
+                if agent_executor is None:
+                    try:
+                        agent_executor = await asyncio.wait_for(self._idle.get(), timeout=self.timeout)
+                    except asyncio.TimeoutError:
+                        self._timeouts += 1
+                        raise AgentPoolTimeout() from None
+        finally:
+            self._waiting -= 1
+
+        waited = time.perf_counter() - start
+        self._in_use += 1
+        self._borrowed += 1
+        self._total_wait += waited
+        self._max_wait = max(self._max_wait, waited)
+        try:
+            yield agent_executor
+        finally:
+            self._in_use -= 1
+            self._idle.put_nowait(agent_executor)
+
+    def stats(self) -> dict:
+        """池占用与等待时间"""
+        return {
+            "size": self.size,
+            "created": self._created,
+            "in_use": self._in_use,
+            "idle": self._idle.qsize(),
+            "waiting": self._waiting,
+            "borrowed_total": self._borrowed,
+            "timeouts": self._timeouts,
+            "avg_wait_ms": round(self._total_wait / self._borrowed * 1000, 3) if self._borrowed else 0.0,
+            "max_wait_ms": round(self._max_wait * 1000, 3),
+        }
+
+
+agent_pool = AgentPool(AGENT_POOL_SIZE, AGENT_POOL_TIMEOUT)
+
+
+# 启动预热配置
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "1") == "1"
+WARMUP_RETRY_INTERVAL = float(os.getenv("WARMUP_RETRY_INTERVAL", "30"))
+startup_state = {"ready": False, "stage": "pending", "error": None, "stages_ms": {}}
+_started_at = time.perf_counter()
+
+
+def import_agent_modules():
+    """导入Agent依赖的重模块（在线程池中执行，不阻塞事件循环）"""
+    import langchain.agents  # noqa: F401
+    import langchain_ollama  # noqa: F401
+    agent_classes()
+
+
+async def warm_ollama_models():
+    """用一次只生成1个token的请求把模型加载进显存，并按keep_alive常驻"""
+    from ollama import AsyncClient
+    client = AsyncClient()
+    await client.generate(model=LLM_MODEL, prompt="你好", options={"num_predict": 1}, keep_alive=OLLAMA_KEEP_ALIVE)
+    try:
+        await client.embed(model=EMBEDDING_MODEL, input="warmup", keep_alive=OLLAMA_KEEP_ALIVE)
+    except Exception as e:
+        # 向量化模型只影响知识库，不阻止服务就绪
+        print(f"Embedding model warm-up failed: {e}")
+
+
+async def build_agent_pool():
+    """构建满池的Agent"""
+    await agent_pool.warm()
+
+
+async def run_warm_up_stage(name: str, stage):
+    """执行一个预热阶段，失败时按间隔重试直到成功"""
+    while True:
+        startup_state["stage"] = name
+        start = time.perf_counter()
+        try:
+            await stage()
+            break
+        except Exception as e:
+            startup_state["error"] = f"{name}: {e}"
+            print(f"Warm-up stage {name} failed: {e}, retrying in {WARMUP_RETRY_INTERVAL}s")
+            await asyncio.sleep(WARMUP_RETRY_INTERVAL)
+    startup_state["stages_ms"][name] = round((time.perf_counter() - start) * 1000, 1)
+
+
+async def warm_up():
+    """导入依赖、构建Agent池并预热模型，全部完成后/health才报告就绪"""
+    await run_warm_up_stage("imports", lambda: run_in_threadpool(import_agent_modules))
+    await run_warm_up_stage("agent_pool", build_agent_pool)
+    await run_warm_up_stage("lexical_index", lambda: run_in_threadpool(get_knowledge_base().refresh))
+    await run_warm_up_stage("model", warm_ollama_models)
+    startup_state.update(ready=True, stage="ready", error=None)
+    startup_state["ready_ms"] = round((time.perf_counter() - _started_at) * 1000, 1)
+    print(f"Service ready in {startup_state['ready_ms']}ms: {startup_state['stages_ms']}")
+
+
+_warm_up_task = None
+
+
+async def start_warm_up():
+    """启动后在后台预热，服务立即开始接受连接"""
+    global _warm_up_task
+    if not WARMUP_ENABLED:
+        startup_state.update(ready=True, stage="ready")
+        return
+    _warm_up_task = asyncio.create_task(warm_up())
+
+
+async def stop_warm_up():
+    if _warm_up_task is not None and not _warm_up_task.done():
+        _warm_up_task.cancel()
+
+
+# 聊天准入控制配置
+CHAT_MAX_IN_FLIGHT = int(os.getenv("CHAT_MAX_IN_FLIGHT", str(AGENT_POOL_SIZE)))
+CHAT_MAX_QUEUE = int(os.getenv("CHAT_MAX_QUEUE", "32"))
+CHAT_MAX_QUEUE_PER_CLIENT = int(os.getenv("CHAT_MAX_QUEUE_PER_CLIENT", "4"))
+CHAT_QUEUE_TIMEOUT = float(os.getenv("CHAT_QUEUE_TIMEOUT", "60"))
+# 排队位置的检查间隔（秒）
+CHAT_QUEUE_POLL = 0.5
+CHAT_BATCH_MAX = int(os.getenv("CHAT_BATCH_MAX", "50"))
+# 一个批量请求同时运行的问题数，每个问题占用一个准入槽位
+CHAT_BATCH_CONCURRENCY = min(int(os.getenv("CHAT_BATCH_CONCURRENCY", str(CHAT_MAX_IN_FLIGHT))), CHAT_MAX_IN_FLIGHT)
+
+
+def batch_client(client: str) -> str:
+    """批量请求的问题在准入队列中单独排成一组，排队上限为CHAT_BATCH_CONCURRENCY，不占用该客户端普通聊天的配额"""
+    return f"{client}#batch"
+
+
+class AdmissionRejected(Exception):
+    """等待队列已满，请求被拒绝"""
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionTicket:
+    """一个聊天请求的准入凭证"""
+
+    def __init__(self, client: str):
+        self.client = client
+        self.future = asyncio.get_running_loop().create_future()
+        self.state = "queued"
+        self.enqueued_at = time.perf_counter()
+        self.admitted_at = None
+
+
+class AdmissionController:
+    """限制同时生成的请求数，超出的请求进入有界等待队列
+
+    等待队列按客户端分组轮询出队，单个客户端的突发请求不会挤占其他客户端。
+    只在事件循环线程中使用，不需要加锁。
+    """
+
+    def __init__(self, max_in_flight: int, max_queue: int, max_per_client: int):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.max_per_client = max_per_client
+        self.in_flight = 0
+        self._queues = OrderedDict()
+        self._queued = 0
+        # 单个请求占用生成槽位的平均时长（指数滑动平均），用于估算Retry-After
+        self._avg_service = 5.0
+        self.admitted = 0
+        self.queue_timeouts = 0
+        self.abandoned = 0
+
+    def retry_after(self) -> int:
+        return max(1, math.ceil(self._avg_service * (self._queued + 1) / self.max_in_flight))
+
+    def check(self, client: str, quota: Optional[int] = None):
+        """请求无法排队时抛出AdmissionRejected，quota为该组的排队上限（默认max_per_client）"""
+        if self.in_flight < self.max_in_flight and not self._queued:
+            return
+        if self._queued >= self.max_queue:
+            ADMISSION_REJECTED.inc(reason="queue_full")
+            raise AdmissionRejected("queue_full", self.retry_after())
+        if len(self._queues.get(client, ())) >= (quota or self.max_per_client):
+            ADMISSION_REJECTED.inc(reason="client_limit")
+            raise AdmissionRejected("client_limit", self.retry_after())
+
+    def enqueue(self, client: str, quota: Optional[int] = None) -> AdmissionTicket:
+        self.check(client, quota)
+        ticket = AdmissionTicket(client)
+        self._queues.setdefault(client, deque()).append(ticket)
+        self._queued += 1
+        self._dispatch()
+        return ticket
+
+    def _dispatch(self):
+        while self.in_flight < self.max_in_flight and self._queues:
+            client, waiters = next(iter(self._queues.items()))
+            ticket = waiters.popleft()
+            self._queued -= 1
+            if waiters:
+                self._queues.move_to_end(client)
+            else:
+                del self._queues[client]
+            ticket.state = "admitted"
+            ticket.admitted_at = time.perf_counter()
+            self.in_flight += 1
+            self.admitted += 1
+            ADMISSION_WAIT.observe(ticket.admitted_at - ticket.enqueued_at)
+            ticket.future.set_result(True)
+
+    def position(self, ticket: AdmissionTicket) -> int:
+        """按轮询出队顺序计算的排队位置，从1开始，已准入为0"""
+        if ticket.state != "queued":
+            return 0
+        position = 0
+        queues = list(self._queues.values())
+        for depth in range(max(len(q) for q in queues)):
+            for waiters in queues:
+                if depth < len(waiters):
+                    position += 1
+                    if waiters[depth] is ticket:
+                        return position
+        return 0
+
+    def release(self, ticket: AdmissionTicket):
+        """请求结束（或放弃排队）时释放"""
+        if ticket.state == "admitted":
+            self.in_flight -= 1
+            self._avg_service = 0.8 * self._avg_service + 0.2 * (time.perf_counter() - ticket.admitted_at)
+        elif ticket.state == "queued":
+            waiters = self._queues.get(ticket.client)
+            if waiters is not None and ticket in waiters:
+                waiters.remove(ticket)
+                self._queued -= 1
+                if not waiters:
+                    del self._queues[ticket.client]
+            self.abandoned += 1
+        ticket.state = "released"
+        self._dispatch()
+
+    async def wait(self, ticket: AdmissionTicket):
+        """等待准入，排队位置变化时产出新位置；超过CHAT_QUEUE_TIMEOUT抛出asyncio.TimeoutError"""
+        deadline = ticket.enqueued_at + CHAT_QUEUE_TIMEOUT
+        last = None
+        while ticket.state == "queued":
+            position = self.position(ticket)
+            if position != last:
+                last = position
+                yield position
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                self.queue_timeouts += 1
+                raise asyncio.TimeoutError()
+            await asyncio.wait({ticket.future}, timeout=min(CHAT_QUEUE_POLL, remaining))
+
+    def stats(self) -> dict:
+        return {
+            "max_in_flight": self.max_in_flight,
+            "in_flight": self.in_flight,
+            "queued": self._queued,
+            "max_queue": self.max_queue,
+            "clients_waiting": len(self._queues),
+            "admitted_total": self.admitted,
+            "queue_timeouts": self.queue_timeouts,
+            "abandoned": self.abandoned,
+            "avg_service_s": round(self._avg_service, 3),
+        }
+
+
+admission = AdmissionController(CHAT_MAX_IN_FLIGHT, CHAT_MAX_QUEUE, CHAT_MAX_QUEUE_PER_CLIENT)
+ADMISSION_REJECTED = metrics.counter("rag_admission_rejected_total", "因等待队列已满被拒绝的聊天请求", ["reason"])
+ADMISSION_WAIT = metrics.histogram("rag_admission_wait_seconds", "聊天请求排队等待时间")
+metrics.register(CallbackMetric(
+    "rag_admission_requests", "正在生成和排队的聊天请求数", "gauge",
+    lambda: {("in_flight",): admission.in_flight, ("queued",): admission.stats()["queued"]},
+    ["state"],
+))
+
+
+def client_id(http_request: Request) -> str:
+    """客户端标识：优先使用X-Client-Id请求头，否则使用来源地址"""
+    header = http_request.headers.get("x-client-id")
+    if header:
+        return header[:128]
+    return http_request.client.host if http_request.client else "unknown"
+
+
+# 回答缓存配置
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1000"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "600"))
+# 用到实时行情时回答很快过期，用到搜索结果时次之
+ANSWER_CACHE_QUOTE_TTL = float(os.getenv("ANSWER_CACHE_QUOTE_TTL", "30"))
+ANSWER_CACHE_SEARCH_TTL = float(os.getenv("ANSWER_CACHE_SEARCH_TTL", "300"))
+ANSWER_SEMANTIC_THRESHOLD = float(os.getenv("ANSWER_SEMANTIC_THRESHOLD", "0.95"))
+ANSWER_SEMANTIC_ENABLED = os.getenv("ANSWER_SEMANTIC_ENABLED", "1") == "1"
+ANSWER_TOOL_TTLS = {
+    "mairui": ANSWER_CACHE_QUOTE_TTL,
+    "mairui_batch": ANSWER_CACHE_QUOTE_TTL,
+    "mairui_history": ANSWER_CACHE_QUOTE_TTL,
+    "tavily_search": ANSWER_CACHE_SEARCH_TTL,
+}
+TRAILING_PUNCTUATION = "?？!！。.，,~～ "
+# 股票代码、数字和大写代号：语义相近但这些不同的问题不能共用回答
+ANSWER_ANCHOR_PATTERN = re.compile(r"[0-9]+(?:\.[0-9]+)?|(?<![A-Za-z])[A-Z]{1,5}(?![A-Za-z])")
+
+
+def normalize_question(message: str) -> str:
+    """规范化问题用于精确匹配：全半角、空白、大小写和句末标点"""
+    return normalize_text(message).lower().rstrip(TRAILING_PUNCTUATION)
+
+
+def question_anchors(message: str) -> tuple:
+    """问题中的数字和代码，语义层命中要求两者完全一致"""
+    return tuple(sorted(set(ANSWER_ANCHOR_PATTERN.findall(normalize_text(message)))))
+
+
+def answer_ttl(tools_used) -> float:
+    """回答的有效期取决于用到的工具数据，取其中最短的"""
+    return min([ANSWER_CACHE_TTL] + [ANSWER_TOOL_TTLS.get(name, ANSWER_CACHE_TTL) for name in tools_used])
+
+
+class AnswerCache:
+    """Agent回答缓存：精确层按规范化问题的哈希匹配，语义层按问题向量的余弦相似度匹配
+
+    语义层还要求问题中的数字和股票代码一致，避免用一只股票的行情回答另一只。
+    用到knowledge_base_search的回答记录知识库内容版本，知识库变化后不再命中。
+    """
+
+    def __init__(self, max_entries: int, threshold: float, semantic: bool):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.semantic = semantic
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # 语义层向量按槽位存放，淘汰时回收槽位
+        self._matrix = None
+        self._slot_keys = [None] * max_entries
+        self._free_slots = list(range(max_entries - 1, -1, -1))
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.stores = 0
+        self.skipped = 0
+
+    @staticmethod
+    def key(message: str) -> str:
+        return hashlib.sha256(normalize_question(message).encode("utf-8")).hexdigest()
+
+    def embed(self, message: str) -> Optional[np.ndarray]:
+        """问题向量，向量模型不可用时只使用精确层"""
+        if not self.semantic:
+            return None
+        try:
+            return normalize_vectors(embed_texts([normalize_question(message)]))[0]
+        except Exception as e:
+            print(f"Answer cache embedding failed: {e}")
+            return None
+
+    def _valid(self, entry: dict) -> bool:
+        if entry["expires"] <= time.monotonic():
+            return False
+        return entry["kb_version"] is None or entry["kb_version"] == get_knowledge_base().version
+
+    def _drop(self, key: str):
+        entry = self._entries.pop(key)
+        if entry["slot"] is not None:
+            self._slot_keys[entry["slot"]] = None
+            self._free_slots.append(entry["slot"])
+
+    def lookup(self, message: str):
+        """返回(缓存的回答, 问题向量)，未命中时回答为None，向量留给store复用"""
+        import numpy as np
+        key = self.key(message)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if self._valid(entry):
+                    self._entries.move_to_end(key)
+                    self.exact_hits += 1
+                    return entry["answer"], None
+                self._drop(key)
+                self.expired += 1
+        vector = self.embed(message)
+        with self._lock:
+            if vector is not None and self._matrix is not None and len(vector) == self._matrix.shape[1]:
+                scores = self._matrix @ vector
+                anchors = question_anchors(message)
+                for slot in np.argsort(-scores)[:4]:
+                    if scores[slot] < self.threshold:
+                        break
+                    match = self._slot_keys[slot]
+                    if match is None:
+                        continue
+                    entry = self._entries[match]
+                    if entry["anchors"] != anchors:
+                        continue
+                    if not self._valid(entry):
+                        self._drop(match)
+                        self.expired += 1
+                        continue
+                    self._entries.move_to_end(match)
+                    self.semantic_hits += 1
+                    return entry["answer"], vector
+            self.misses += 1
+        return None, vector
+
+    def store(self, message: str, answer: str, tools_used, vector: Optional[np.ndarray] = None):
+        """缓存一次Agent运行的最终回答"""
+        import numpy as np
+        ttl = answer_ttl(tools_used)
+        if ttl <= 0 or not answer:
+            with self._lock:
+                self.skipped += 1
+            return
+        kb_version = get_knowledge_base().version if "knowledge_base_search" in tools_used else None
+        key = self.key(message)
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            slot = None
+            if vector is not None:
+                if self._matrix is None:
+                    self._matrix = np.zeros((self.max_entries, len(vector)), dtype=np.float32)
+                if len(vector) == self._matrix.shape[1]:
+                    if not self._free_slots:
+                        self._drop(next(iter(self._entries)))
+                    slot = self._free_slots.pop()
+                    self._matrix[slot] = vector
+                    self._slot_keys[slot] = key
+            self._entries[key] = {
+                "answer": answer,
+                "expires": time.monotonic() + ttl,
+                "kb_version": kb_version,
+                "anchors": question_anchors(message),
+                "slot": slot,
+            }
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+            self.stores += 1
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                self._drop(key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits = self.exact_hits + self.semantic_hits
+            lookups = hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "exact_hits": self.exact_hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "expired": self.expired,
+                "stores": self.stores,
+                "skipped": self.skipped,
+                "hit_ratio": round(hits / lookups, 4) if lookups else 0.0,
+                "semantic_enabled": self.semantic,
+                "semantic_threshold": self.threshold,
+            }
+
+
+answer_cache = AnswerCache(ANSWER_CACHE_SIZE, ANSWER_SEMANTIC_THRESHOLD, ANSWER_SEMANTIC_ENABLED)
 
 
 # bot_response函数已移除，使用FastAPI的流式响应替代
@@ -633,27 +4922,226 @@ Thought: {agent_scratchpad}
 
 # FastAPI后端已配置完成，移除Gradio界面
 
-# 挂载静态文件目录（在所有API路由定义之后）
-# 注意：根路径挂载必须放在最后，避免拦截API请求
-app.mount("/static", StaticFiles(directory="build/static"), name="static")
-# 移除根路径挂载，改为在根路径返回index.html
+# 静态资源配置（React构建产物）
+BUILD_DIR = os.getenv("BUILD_DIR", "build")
+STATIC_INLINE_MAX = int(os.getenv("STATIC_INLINE_MAX", str(2 * 1024 * 1024)))
+STATIC_COMPRESS_MIN = 1024
+STATIC_COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml")
+STATIC_IMMUTABLE = "public, max-age=31536000, immutable"
+# CRA构建产物文件名中的内容哈希，如 main.94f72dd6.js
+HASHED_ASSET = re.compile(r"\.[0-9a-f]{8,}\.")
+# 压缩版本的ETag后缀
+STATIC_ETAG_SUFFIXES = {"gzip": "gz", "br": "br"}
+
+
+def load_brotli():
+    """brotli为可选依赖，未安装时只提供gzip"""
+    try:
+        import brotli
+        return brotli
+    except ImportError:
+        print("brotli库未安装，静态资源只提供gzip压缩：pip install brotli")
+        return None
+
+
+def accepted_encodings(accept_encoding: Optional[str]) -> set:
+    """解析Accept-Encoding，忽略q=0的编码"""
+    encodings = set()
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.strip().partition(";")
+        if not name:
+            continue
+        if params.strip().replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        encodings.add(name.strip().lower())
+    return encodings
+
+
+class StaticBundle:
+    """启动时索引一次build目录，index.html常驻内存，按需生成并缓存gzip/brotli版本"""
+
+    def __init__(self, root: str):
+        self.root = root
+        self.brotli = load_brotli()
+        self.files = {}
+        self.index_html = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.not_modified = 0
+        self.compressed_bytes_saved = 0
+        self._index()
+
+    def _index(self):
+        if not os.path.isdir(self.root):
+            print(f"静态资源目录不存在: {self.root}，请先执行 npm run build")
+            return
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                rel = os.path.relpath(path, self.root).replace(os.sep, "/")
+                if rel.endswith((".gz", ".br")) and os.path.exists(path[:-3]):
+                    continue
+                stat = os.stat(path)
+                media_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+                if rel == "index.html":
+                    cache_control = "no-cache"
+                elif rel.startswith("static/") and HASHED_ASSET.search(filename):
+                    cache_control = STATIC_IMMUTABLE
+                else:
+                    cache_control = "public, max-age=3600"
+                entry = {
+                    "path": path,
+                    "size": stat.st_size,
+                    "media_type": media_type,
+                    "etag": f'"{stat.st_size:x}-{int(stat.st_mtime_ns):x}"',
+                    "cache_control": cache_control,
+                    "compressible": stat.st_size >= STATIC_COMPRESS_MIN and media_type.startswith(STATIC_COMPRESSIBLE_TYPES),
+                    "raw": None,
+                    "variants": {},
+                }
+                # 构建时已生成的预压缩文件直接使用
+                for encoding, suffix in (("gzip", ".gz"), ("br", ".br")):
+                    if entry["compressible"] and os.path.exists(path + suffix):
+                        with open(path + suffix, "rb") as f:
+                            entry["variants"][encoding] = f.read()
+                self.files[rel] = entry
+        self.index_html = self.files.get("index.html")
+        if self.index_html is not None:
+            self._load(self.index_html)
+            for encoding in ("br", "gzip"):
+                self._variant(self.index_html, encoding)
+        print(f"Static bundle indexed: {len(self.files)} files from {self.root}")
+
+    def _load(self, entry: dict) -> bytes:
+        if entry["raw"] is None:
+            with open(entry["path"], "rb") as f:
+                entry["raw"] = f.read()
+        return entry["raw"]
+
+    def _variant(self, entry: dict, encoding: str) -> Optional[bytes]:
+        if encoding in entry["variants"]:
+            return entry["variants"][encoding]
+        if encoding == "br" and self.brotli is None:
+            return None
+        raw = self._load(entry)
+        if encoding == "br":
+            body = self.brotli.compress(raw, quality=11)
+        else:
+            body = gzip.compress(raw, compresslevel=9, mtime=0)
+        with self._lock:
+            entry["variants"][encoding] = body
+        return body
+
+    def _ready(self, entry: dict) -> bool:
+        """响应所需内容是否都已在内存中"""
+        if entry["size"] > STATIC_INLINE_MAX:
+            return True
+        if entry["raw"] is None:
+            return False
+        if not entry["compressible"]:
+            return True
+        encodings = ("br", "gzip") if self.brotli is not None else ("gzip",)
+        return all(encoding in entry["variants"] for encoding in encodings)
+
+    def choose(self, entry: dict, accept_encoding: Optional[str]):
+        """选择编码并返回(编码, 响应体)，超过内联上限的大文件返回(None, None)由磁盘发送"""
+        if entry["size"] > STATIC_INLINE_MAX:
+            return None, None
+        if entry["compressible"]:
+            accepted = accepted_encodings(accept_encoding)
+            for encoding in ("br", "gzip"):
+                if encoding in accepted:
+                    body = self._variant(entry, encoding)
+                    if body is not None and len(body) < entry["size"]:
+                        return encoding, body
+        return None, self._load(entry)
+
+    @staticmethod
+    def etag(entry: dict, encoding: Optional[str]) -> str:
+        """不同编码的响应体不同，各自使用独立的强ETag"""
+        if encoding is None:
+            return entry["etag"]
+        return f'{entry["etag"][:-1]}-{STATIC_ETAG_SUFFIXES[encoding]}"'
+
+    def respond(self, entry: dict, body: Optional[bytes], encoding: Optional[str], if_none_match: Optional[str]) -> Response:
+        etag = self.etag(entry, encoding)
+        headers = {"ETag": etag, "Cache-Control": entry["cache_control"]}
+        if entry["compressible"]:
+            headers["Vary"] = "Accept-Encoding"
+        if etag_matches(if_none_match, etag):
+            with self._lock:
+                self.not_modified += 1
+            return Response(status_code=304, headers=headers)
+        with self._lock:
+            self.hits += 1
+            if encoding:
+                self.compressed_bytes_saved += entry["size"] - len(body)
+        if body is None:
+            return FileResponse(entry["path"], media_type=entry["media_type"], headers=headers)
+        if encoding:
+            headers["Content-Encoding"] = encoding
+        return Response(content=body, media_type=entry["media_type"], headers=headers)
+
+    async def serve(self, entry: dict, request: Request) -> Response:
+        accept_encoding = request.headers.get("accept-encoding")
+        if self._ready(entry):
+            encoding, body = self.choose(entry, accept_encoding)
+        else:
+            # 首次请求时压缩（或读盘）放到线程池，避免阻塞事件循环
+            encoding, body = await run_in_threadpool(self.choose, entry, accept_encoding)
+        return self.respond(entry, body, encoding, request.headers.get("if-none-match"))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "files": len(self.files),
+                "cached_bytes": sum(len(e["raw"] or b"") + sum(len(v) for v in e["variants"].values()) for e in self.files.values()),
+                "brotli": self.brotli is not None,
+                "hits": self.hits,
+                "not_modified": self.not_modified,
+                "compressed_bytes_saved": self.compressed_bytes_saved,
+            }
+
+
+get_static_bundle = lazy_singleton(lambda: StaticBundle(BUILD_DIR))
 
+
+@app.get("/api/static/stats")
+async def static_stats():
+    """静态资源缓存统计"""
+    return get_static_bundle().stats()
+
+def is_asset_path(path: str) -> bool:
+    """是否为资源文件请求（static目录、API路径或带扩展名），其余视为前端路由"""
+    if path.startswith(("static/", "api/")):
+        return True
+    return "." in path.rsplit("/", 1)[-1]
+
+# 前端路由放在所有API路由定义之后，避免拦截API请求
 @app.get("/")
-async def read_index():
+async def read_index(request: Request):
     """返回React应用的index.html"""
-    return FileResponse('build/index.html')
+    static_bundle = get_static_bundle()
+    if static_bundle.index_html is None:
+        raise HTTPException(status_code=404, detail="前端尚未构建，请先执行 npm run build")
+    return await static_bundle.serve(static_bundle.index_html, request)
 
 @app.get("/{full_path:path}")
-async def serve_spa(full_path: str):
-    """为React SPA提供fallback路由"""
-    # 如果是静态资源请求，直接返回文件
-    if full_path.startswith('static/'):
-        file_path = f"build/{full_path}"
-        if os.path.exists(file_path):
-            return FileResponse(file_path)
-    
-    # 对于其他路径，返回index.html让React Router处理
-    return FileResponse('build/index.html')
+async def serve_spa(full_path: str, request: Request):
+    """为React SPA提供静态资源和fallback路由"""
+    # 构建产物中存在的文件直接从索引返回
+    static_bundle = get_static_bundle()
+    entry = static_bundle.files.get(full_path)
+    if entry is None:
+        if is_asset_path(full_path):
+            # 缺失的资源文件返回404，避免浏览器把index.html当作脚本或样式解析
+            raise HTTPException(status_code=404, detail=f"静态资源不存在: {full_path}")
+        # 对于前端路由，返回index.html让React Router处理
+        entry = static_bundle.index_html
+    if entry is None:
+        raise HTTPException(status_code=404, detail="前端尚未构建，请先执行 npm run build")
+    return await static_bundle.serve(entry, request)
 
 if __name__ == "__main__":
+    import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000, reload=False)
\ No newline at end of file